@@ -1,8 +1,9 @@
 # Standard imports
+import heapq
 import logging
 import math
 import random
-from typing import List, Dict
+from typing import Callable, Dict, List
 
 # First party imports
 from vector import Vector
@@ -10,6 +11,8 @@ from vector import Vector
 from layout import ConstructionSite
 
 from node import Node
+import budget
+import profiling
 
 
 #
@@ -17,6 +20,86 @@ from node import Node
 #
 log = logging.getLogger(__name__)
 
+# Expanded nodes between checks of the time budget
+BUDGET_CHECK_INTERVAL = 64
+
+# Estimates of the cost from a node to the nearest end node:
+# - euclidean: straight line distance, computed for each node
+# - manhattan: grid distance, ignoring obstacles, computed for each tile
+# - obstacles: grid distance around obstacles, or under them with
+#   underground belts, computed for all tiles of the site before a search
+HEURISTICS = ('euclidean', 'manhattan', 'obstacles')
+
+# Most tiles between the entry and exit of an underground belt, for each
+# tier of belt, like solver.connect_machines
+UNDERGROUND_MAX_GAP = {
+    'transport-belt': 4,
+    'fast-transport-belt': 6,
+    'express-transport-belt': 8,
+}
+
+# Longest underground belt, from the tile before the entry to the exit,
+# and its cost
+UNDERGROUND_REACH = UNDERGROUND_MAX_GAP['transport-belt'] + 2
+UNDERGROUND_COST = 7
+
+# Heuristic of tiles that cannot reach an end node
+UNREACHABLE = 999999999
+
+# Headings of belts in the directional search, as steps. A start position
+# has no heading.
+HEADINGS = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+NO_HEADING = len(HEADINGS)
+
+#
+#  Heuristics
+#
+
+def manhattan_estimate(end_positions) -> Callable[[int, int], int]:
+    '''Return a function of the grid distance from a tile to the nearest
+    end position, remembered for the tiles asked for'''
+    ends = list(set(end_positions))
+    known = {}
+    def estimate(x, y):
+        h = known.get((x, y))
+        if h is None:
+            h = known[(x, y)] = min(abs(x - ex) + abs(y - ey) for ex, ey in ends)
+        return h
+    return estimate
+
+def obstacle_field(free: List[List[bool]], end_positions, reach=UNDERGROUND_REACH) -> List[List[int]]:
+    '''Return the cost of the cheapest route from each free tile to the
+    nearest end position, with belts around obstacles or underground belts
+    under them, as rows of a list indexed [y][x].
+
+    The rules for underground belts are relaxed, so the cost is never more
+    than that of a path the search can find. Tiles that cannot reach an end
+    position get UNREACHABLE.
+    '''
+    height, width = len(free), len(free[0])
+    field = [[UNREACHABLE] * width for _ in range(height)]
+    queue = []
+    for x, y in set(end_positions):
+        field[y][x] = 0
+        queue.append((0, x, y))
+    while queue:
+        cost, x, y = heapq.heappop(queue)
+        if cost > field[y][x]:
+            continue
+        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+            for step in range(1, reach + 1):
+                nx, ny = x + dx*step, y + dy*step
+                if not (0 <= nx < width and 0 <= ny < height):
+                    break
+                if not free[ny][nx]:
+                    continue
+                next_cost = cost + (1 if step == 1 else UNDERGROUND_COST)
+                if next_cost < field[ny][nx]:
+                    field[ny][nx] = next_cost
+                    heapq.heappush(queue, (next_cost, nx, ny))
+    return field
+
+
 
 # for implementation:
 # https://academy.finxter.com/python-a-search-algorithm/
@@ -28,7 +111,15 @@ class A_star:
         end_positions: List["tuple"],
         start_node_illegal_neighbors: Dict["tuple", "tuple"] = None,
         end_node_illegal_neighbors: Dict["tuple", List["tuple"]] = None,
+        belt="transport-belt",
+        start_headings: Dict["tuple", "tuple"] = None,
     ):
+        """
+        :param start_headings:  (heading, exit) of the belt that comes to a
+            start position, when the path extends a belt: the step (dx, dy)
+            it comes in by, and whether it is the exit of an underground
+            belt. Only the directional search follows them.
+        """
         if not isinstance(site, ConstructionSite):
             raise TypeError("site must be an instance of ConstructionSite")
         if not isinstance(start_positions, list) or not all(
@@ -43,43 +134,49 @@ class A_star:
             raise TypeError("start_node_illegal_neighbors must be a dictionary")
         if not isinstance(end_node_illegal_neighbors, dict):
             raise TypeError("start_node_illegal_neighbors must be a dictionary")
+        if not site.is_bounded():
+            raise ValueError("site must be bounded, search windows of an unbounded site with windowed.find_path")
 
         self.site = site
+        # Runs of free tiles, to find the exits of underground belts
+        self.runs = site.free_runs()
+        self.underground_reach = UNDERGROUND_MAX_GAP[belt] + 2
         self.start_positions = start_positions
         self.end_positions = end_positions
+        self.start_headings = start_headings or {}
+        self.start_set = set(start_positions)
+        self.end_set = set(end_positions)
         self.underground_belts = False
-        self.queue = []
-        # creates a grid of all nodes.
-        height = site.size()[1]
-        width = site.size()[0]
-        self.nodes: List[List["Node"]] = [
-            [Node((x, y)) for x in range(width)] for y in range(height)
-        ]
-        log.debug("Nodes initialized")
-        for position in start_positions:
-            self.nodes[position[1]][position[0]].set_as_start_node()
-            self.queue.append(self.nodes[position[1]][position[0]])
-        log.debug("Start nodes initialized")
-
-        for position in end_positions:
-            self.nodes[position[1]][position[0]].set_as_end_node()
-        log.debug("End nodes initialized")
-
-        if start_node_illegal_neighbors:
-            for key, value in start_node_illegal_neighbors.items():
-                for pair in value:
-                    self.nodes[key[1]][key[0]].add_illegal_neighbor(pair)
-
-        if end_node_illegal_neighbors:
-            for key, value in end_node_illegal_neighbors.items():
-                for pair in value:
-                    self.nodes[key[1]][key[0]].add_illegal_neighbor(pair)
+        self.free = None
+        # Tiles a path may not use after each start or end position, like the
+        # inserters there
+        self.illegal: Dict["tuple", List["tuple"]] = {}
+        for illegal_neighbors in [start_node_illegal_neighbors, end_node_illegal_neighbors]:
+            for position, tiles in illegal_neighbors.items():
+                self.illegal.setdefault(position, []).extend(tiles)
+        # Nodes of the tiles reached so far, by position. Nodes are made when
+        # first reached, so setting up a search does not depend on the size
+        # of the site.
+        self.nodes: Dict["tuple", "Node"] = {}
+        self.queue = [self.node(*position) for position in start_positions]
+
+    def node(self, x, y) -> "Node":
+        '''Return the node of a tile, made when first asked for'''
+        node = self.nodes.get((x, y))
+        if node is None:
+            node = self.nodes[(x, y)] = Node((x, y))
+            if (x, y) in self.start_set:
+                node.set_as_start_node()
+            if (x, y) in self.end_set:
+                node.set_as_end_node()
+            for tile in self.illegal.get((x, y), ()):
+                node.add_illegal_neighbor(tile)
+        return node
 
     def find_entrance_node(self, current_node: "Node", exit_node: "Node") -> "Node":
         normalized_direction = self.find_normalized_direction(current_node, exit_node)
-        return self.nodes[current_node.position[1] + normalized_direction[1]][
-            current_node.position[0] + normalized_direction[0]
-        ]
+        return self.node(current_node.position[0] + normalized_direction[0],
+                         current_node.position[1] + normalized_direction[1])
 
     def find_normalized_direction(
         self, current_node: "Node", exit_node: "Node"
@@ -93,100 +190,396 @@ class A_star:
             distance[1] // abs(distance[1]) if distance[1] != 0 else 0,
         )
 
-    def find_path(self, underground_belts=False, visualizer=None) -> List["Node"]:
+    def find_path(self, underground_belts=False, visualizer=None, heuristic='euclidean',
+                  directional=False, straight_runs=False) -> List["Node"]:
         """
         Runs the A* algorithm
+
+        :param heuristic:  One of HEURISTICS. Other than euclidean, it is
+            computed for all tiles before the search.
+        :param directional:  Search tiles by heading, see find_path_directional.
+        :param straight_runs:  Expand straight runs of free tiles in one step,
+            see jump. Only the directional search does.
         """
+        if directional:
+            return self.find_path_directional(underground_belts, visualizer, heuristic, straight_runs)
         log.debug("finding path")
-        self.underground_belts = underground_belts
+        if not self.start_search(underground_belts, heuristic):
+            log.debug("No end node can be reached")
+            self.record_search(0, 0, found=False)
+            return None
 
-        # Initialize the open and closed lists
-        open_list: List["Node"] = self.queue.copy()
-        closed_list: List["Node"] = []
+        open_list = self.open_list
+        closed_list = self.closed_list
         if visualizer != None:
             visualizer.set_closed_list(closed_list)
             visualizer.set_open_list(open_list)
             visualizer.set_start_squares(self.start_positions)
             visualizer.set_end_squares(self.end_positions)
             visualizer.reset()
+        # Search statistics, reported to profiling when done
+        expanded = 0
+        open_peak = len(open_list)
         while open_list:
-            # Get the node in the open list with the lowest f score (f = g + h)
-            current_node = min(
-                open_list,
-                key=lambda node: node.cost_to_node
-                + node.heuristic_function(self.end_positions),
-            )
-            if current_node.is_underground_exit:
-                log.debug("Underground used")
-            # Move the current node from the open list to the closed list
-            open_list.remove(current_node)
-            closed_list.append(current_node)
-
-            # If the current node is an end node and the inserter node to the exit node,
-            # isn't part of the the path to get here, we've found a valid path.
-            if current_node.is_end_node:
-                illegal_nodes = current_node.get_illegal_neighbors()
-                backtraced = self.backtrace(current_node, visualizer)
-                can_return = True
-                for illegal_node in illegal_nodes:
-                    if backtraced.__contains__(illegal_node):
-                        can_return = False
-                        break
+            open_peak = max(open_peak, len(open_list))
+            current_node = self.pop_node()
+            expanded += 1
+            if expanded % BUDGET_CHECK_INTERVAL == 0:
+                budget.check('find_path', expanded=expanded)
 
-                if can_return:
+            if current_node.is_end_node:
+                backtraced = self.end_path(current_node, visualizer)
+                if backtraced is not None:
+                    self.record_search(expanded, open_peak, found=True)
                     return backtraced
 
-            #TODO fix that closed list isn't a perfect list of nodes that can't be visited.
-            # This is because there might be two ways to get to the next node, and these two ways
-            # Result in different possible underground belt directions.
-            # If the wrong one is chosen, underground directions leading to the exit
-            # might be missed, resulting in no path found.
-            neighbors = self.get_neighbors(current_node, closed_list)
-            for neighbor in neighbors:
-                if neighbor in closed_list:
-                    continue  # Ignore this neighbor since it's already been evaluated
-
-                # Calculate the tentative g score for the neighbor
-                if neighbor.is_observed_as_underground_exit:
-                    # start node have weird underground neigbors - look at the neighbor function
-                    if (
-                        current_node.is_start_node
-                        and neighbor.distance(neighbor.position, current_node.position)
-                        < 6
-                    ):
-                        # if the distance is 6, it is too far for direct underground, thus this must be the edge case described
-                        # by the neighbor function
-                        cost_to_neighbor = (
-                            current_node.cost_to_node
-                            + current_node.weight_between_nodes(current_node, neighbor)
-                        )
-                        if cost_to_neighbor <= neighbor.cost_to_node:
-                            # This path is the best so far, so record it. Also record if the
-                            # Node was an underground node, then tell it to store it.
-                            neighbor.set_parent(current_node, True)
-                            neighbor.cost_to_node = cost_to_neighbor
+            self.expand(current_node)
+            if visualizer:
+                visualizer.show_frame()
+
+        self.record_search(expanded, open_peak, found=False)
+        return None  # No path was found
+
+    def find_path_directional(self, underground_belts=False, visualizer=None,
+                              heuristic='euclidean', straight_runs=False) -> List["tuple"]:
+        """
+        Runs the A* algorithm on search states of a tile, the heading of the
+        belt on it, and whether it is the exit of an underground belt.
+
+        Closing a tile closes it for one heading only, so a tile reached
+        first in the wrong heading can still be reached in the right one.
+        An underground exit must be followed by a belt in line with it,
+        which may be the entry of the next underground belt.
+
+        States are packed into integers, as
+        ((y * width + x) * (NO_HEADING + 1) + heading) * 2 + exit.
+
+        A start position has no heading, unless given in start_headings.
+        A belt from a start position with a heading turns or goes on like
+        any other, and is only the entry of an underground belt in line
+        with it.
+
+        The search only tracks states, not whole paths, so a path could use
+        a tile twice. Such paths, and paths over the inserters at either
+        end, are only checked with is_belt_path when they reach an end
+        position, and skipped. Each state keeps one parent, so a valid path
+        through the states of a skipped one can still be missed, though far
+        fewer paths are missed than by the search of tiles.
+
+        With straight_runs, a belt goes on to the end of its straight run,
+        see jump, and the tiles along the run get no states of their own.
+        """
+        log.debug("finding path by heading")
+        if straight_runs:
+            self.prepare_straight_runs()
+        width, height = self.site.size()
+        runs = self.runs
+        free = runs.free
+        run_lists = [runs.runs[heading] for heading in HEADINGS]
+        reach = self.underground_reach
+        end_set = set(self.end_positions)
+        tile_estimate = self.tile_heuristic(heuristic)
+        if tile_estimate is None:
+            ends = list(end_set)
+            def tile_estimate(x, y):
+                return min(math.dist((x, y), end) for end in ends)
+        illegal = {position: set(tiles) for position, tiles in self.illegal.items()}
+
+        headings = NO_HEADING + 1
+        def pack(x, y, heading, exit):
+            return ((y * width + x) * headings + heading) * 2 + exit
+        def unpack(state):
+            tile, exit = divmod(state, 2)
+            tile, heading = divmod(tile, headings)
+            y, x = divmod(tile, width)
+            return x, y, heading, exit
+
+        costs = {}
+        # State to (parent state, underground entry tile between them or None)
+        parents = {}
+        closed = set()
+        open_heap = []
+        for x, y in self.start_positions:
+            heading, exit = NO_HEADING, 0
+            if (x, y) in self.start_headings:
+                step, exit = self.start_headings[(x, y)]
+                heading = HEADINGS.index(step)
+            state = pack(x, y, heading, int(exit))
+            costs[state] = 0
+            parents[state] = (None, None)
+            h = tile_estimate(x, y)
+            if h < UNREACHABLE:
+                heapq.heappush(open_heap, (h, h, state))
+        if not open_heap:
+            log.debug("No end node can be reached")
+
+        def push(state, cost, parent, entry, x, y):
+            if state in closed or cost >= costs.get(state, UNREACHABLE):
+                return
+            h = tile_estimate(x, y)
+            if h >= UNREACHABLE:
+                # No end node can be reached from here
+                return
+            costs[state] = cost
+            parents[state] = (parent, entry)
+            # Many states tie on cost, so prefer those closest to the end
+            heapq.heappush(open_heap, (cost + h, h, state))
+
+        def backtrace(state):
+            path = []
+            while state is not None:
+                x, y, heading, exit = unpack(state)
+                path.append((x, y))
+                state, entry = parents[state]
+                if entry is not None:
+                    path.append(entry)
+                elif state is not None and not exit:
+                    # The belts along a straight run
+                    dx, dy = HEADINGS[heading]
+                    px, py, _, _ = unpack(state)
+                    for k in range(1, abs(x - px) + abs(y - py)):
+                        path.append((x - dx*k, y - dy*k))
+            return path[::-1]
+
+        def is_free(x, y):
+            return 0 <= x < width and 0 <= y < height and free[y * width + x]
+
+        closed_nodes = []
+        if visualizer != None:
+            visualizer.set_closed_list(closed_nodes)
+            visualizer.set_open_list([])
+            visualizer.set_start_squares(self.start_positions)
+            visualizer.set_end_squares(self.end_positions)
+            visualizer.reset()
+        expanded = 0
+        open_peak = len(open_heap)
+        while open_heap:
+            open_peak = max(open_peak, len(open_heap))
+            _, _, state = heapq.heappop(open_heap)
+            if state in closed:
+                continue
+            closed.add(state)
+            expanded += 1
+            if expanded % BUDGET_CHECK_INTERVAL == 0:
+                budget.check('find_path', expanded=expanded)
+            x, y, heading, exit = unpack(state)
+            if visualizer:
+                closed_nodes.append(self.node(x, y))
+                visualizer.show_frame()
+
+            if (x, y) in end_set:
+                path = backtrace(state)
+                if is_belt_path(path, illegal.get(path[0], set()) | illegal.get(path[-1], set()), reach):
+                    self.record_search(expanded, open_peak, found=True)
+                    return path
+
+            cost = costs[state]
+            tile_illegal = illegal.get((x, y), ())
+            if exit:
+                # A belt in line with the underground belt
+                directions = [heading]
+            elif heading == NO_HEADING:
+                directions = range(len(HEADINGS))
+            else:
+                # Going back would use the same tile twice
+                directions = [d for d in range(len(HEADINGS)) if d != (heading + 2) % 4]
+            for d in directions:
+                dx, dy = HEADINGS[d]
+                nx, ny = x + dx, y + dy
+                entry_free = is_free(nx, ny)
+                if entry_free and (nx, ny) not in tile_illegal:
+                    if straight_runs:
+                        length = self.jump(nx, ny, d)
+                        if length is not None:
+                            rx, ry = nx + dx*length, ny + dy*length
+                            push(pack(rx, ry, d, 0), cost + 1 + length, state, None, rx, ry)
                     else:
-                        underground_entry_node = self.find_entrance_node(
-                            current_node, neighbor
-                        )
-                        cost_to_neighbor = (
-                            underground_entry_node.cost_to_node
-                            + underground_entry_node.weight_between_nodes(
-                                underground_entry_node, neighbor
-                            )
-                            + current_node.cost_to_node
-                            + current_node.weight_between_nodes(
-                                current_node, underground_entry_node
-                            )
-                        )
-                        if cost_to_neighbor <= neighbor.cost_to_node:
-                            # This path is the best so far, so record it. Also record if the
-                            # Node was an underground node, then tell it to store it.
-                            # We deliberatly ignore the entry node. This should be taken care of in backtrace
-                            neighbor.set_parent(current_node, True)
-                            neighbor.cost_to_node = cost_to_neighbor
+                        push(pack(nx, ny, d, 0), cost + 1, state, None, nx, ny)
+                if not underground_belts:
+                    continue
+                # Underground belts, from the entry on the next tile, or from
+                # this tile at a start position, in line with the belt that
+                # comes to it. The tile after the exit must be free, unless
+                # the path ends at the exit.
+                direct = not exit and (heading == NO_HEADING or heading == d and parents[state][0] is None)
+                run_list = run_lists[d]
+                distance = 2
+                while distance <= reach:
+                    ux, uy = x + dx*distance, y + dy*distance
+                    if not (0 <= ux < width and 0 <= uy < height):
+                        break
+                    i = uy * width + ux
+                    if not free[i]:
+                        # Past the reserved tiles in one step
+                        distance += run_list[i]
+                        continue
+                    if (ux, uy) not in tile_illegal and (is_free(ux + dx, uy + dy) or (ux, uy) in end_set):
+                        exit_state = pack(ux, uy, d, 1)
+                        if distance >= 3 and entry_free and (nx, ny) not in tile_illegal:
+                            push(exit_state, cost + 1 + UNDERGROUND_COST, state, (nx, ny), ux, uy)
+                        if direct and distance < reach:
+                            push(exit_state, cost + UNDERGROUND_COST, state, None, ux, uy)
+                    distance += 1
+
+        self.record_search(expanded, open_peak, found=False)
+        return None  # No path was found
 
-                else:
+    def prepare_straight_runs(self):
+        '''Find what straight runs must stop at, before a search'''
+        self.run_lists = [self.runs.runs[heading] for heading in HEADINGS]
+        # End positions, and the tiles that a path may not use after the
+        # start and end positions, by row and by column
+        stops = set(self.end_positions) | set(self.illegal)
+        for tiles in self.illegal.values():
+            stops.update(tiles)
+        self.stops_in_row = {}
+        self.stops_in_column = {}
+        for x, y in stops:
+            self.stops_in_row.setdefault(y, []).append(x)
+            self.stops_in_column.setdefault(x, []).append(y)
+        # Known results of jump, as runs cross the same tiles
+        self.jumps = {}
+
+    def jump(self, x, y, heading) -> int:
+        """
+        Follow a straight run of belts in HEADINGS[heading], from the free
+        tile (x, y), like jump point search on a grid. Return the number of
+        tiles after (x, y) to the tile where the path may need to do
+        something else than go straight, or None if the run ends at the
+        border of the site without any such tile.
+
+        Paths go horizontally first. A vertical run stops:
+
+        - at end positions, and at tiles a path may not use after a start or
+          end position
+        - where the free tiles within underground reach on either side
+          change, as turns and underground belts to the side change there
+        - within underground reach of an obstacle ahead, where underground
+          belts can cross it
+
+        A horizontal run also stops where a vertical run from it would stop,
+        so the path can turn there. Tiles within a run need no expansion of
+        their own, which saves most expansions on open sites.
+        """
+        key = (x, y, heading)
+        if key in self.jumps:
+            return self.jumps[key]
+        width, height = self.runs.width, self.runs.height
+        run_list = self.run_lists[heading]
+        dx, dy = HEADINGS[heading]
+        reach = self.underground_reach
+        # Free tiles ahead, and the last tile of the run
+        ahead = run_list[y * width + x]
+        last = ahead - 1
+        stop = None
+        if 0 <= x + dx*ahead < width and 0 <= y + dy*ahead < height:
+            # An obstacle, not the border, ends the run
+            stop = max(0, ahead - 1 - reach)
+        # Each lane beside the run changes after its run, counted from the
+        # tile before (x, y)
+        px, py = abs(dy), abs(dx)
+        bx, by = x - dx, y - dy
+        for lane in range(1, reach + 2):
+            for sx, sy in ((bx + px*lane, by + py*lane), (bx - px*lane, by - py*lane)):
+                if 0 <= sx < width and 0 <= sy < height:
+                    change = run_list[sy * width + sx] - 1
+                    if change <= last and (stop is None or change < stop):
+                        stop = change
+        if dx == 0:
+            along = [(sy - y) * dy for sy in self.stops_in_column.get(x, ())]
+        else:
+            along = [(sx - x) * dx for sx in self.stops_in_row.get(y, ())]
+        for distance in along:
+            if 0 <= distance <= last and (stop is None or distance < stop):
+                stop = distance
+        if dx != 0:
+            # Where a vertical run would stop
+            end = last if stop is None else stop
+            for distance in range(end + 1):
+                tx, ty = x + dx*distance, y
+                if any(self.runs.is_free(tx, ty + vy) and self.jump(tx, ty + vy, HEADINGS.index((0, vy))) is not None
+                       for vy in (1, -1)):
+                    stop = distance
+                    break
+        self.jumps[key] = stop
+        return stop
+
+    def start_search(self, underground_belts, heuristic) -> bool:
+        """
+        Prepare the open and closed lists, and the heuristic, for a search
+
+        :return:  False if no end node can be reached from any start node
+        """
+        self.underground_belts = underground_belts
+        tile_estimate = self.tile_heuristic(heuristic)
+        if tile_estimate is None:
+            def heuristic_value(node):
+                return node.heuristic_function(self.end_positions)
+            self.estimate = lambda node: node.cost_to_node + heuristic_value(node)
+        else:
+            def heuristic_value(node):
+                return tile_estimate(*node.position)
+            def estimate(node):
+                # Many nodes tie on grid distance, so prefer those closest to the end
+                h = tile_estimate(*node.position)
+                return (node.cost_to_node + h, h)
+            self.estimate = estimate
+        self.heuristic_value = heuristic_value
+
+        # Initialize the open and closed lists
+        self.open_list: List["Node"] = self.queue.copy()
+        self.closed_list: List["Node"] = []
+        return tile_estimate is None or not all(tile_estimate(x, y) == UNREACHABLE for x, y in self.start_positions)
+
+    def pop_node(self) -> "Node":
+        '''Move the open node with the lowest f score (f = g + h) to the
+        closed list, and return it'''
+        current_node = min(self.open_list, key=self.estimate)
+        if current_node.is_underground_exit:
+            log.debug("Underground used")
+        self.open_list.remove(current_node)
+        self.closed_list.append(current_node)
+        current_node.visited = True
+        return current_node
+
+    def end_path(self, current_node: "Node", visualizer=None):
+        '''Return the path to an end node, or None if the path uses the
+        inserter of the end node'''
+        # If the current node is an end node and the inserter node to the exit node,
+        # isn't part of the the path to get here, we've found a valid path.
+        illegal_nodes = current_node.get_illegal_neighbors()
+        backtraced = self.backtrace(current_node, visualizer)
+        for illegal_node in illegal_nodes:
+            if backtraced.__contains__(illegal_node):
+                return None
+        return backtraced
+
+    def expand(self, current_node: "Node") -> List["Node"]:
+        '''Add the neighbors of a node to the open list, and update their
+        cost and parent when this is a cheaper way to them
+
+        :return:  The neighbors
+        '''
+        #TODO fix that closed list isn't a perfect list of nodes that can't be visited.
+        # This is because there might be two ways to get to the next node, and these two ways
+        # Result in different possible underground belt directions.
+        # If the wrong one is chosen, underground directions leading to the exit
+        # might be missed, resulting in no path found.
+        neighbors = self.get_neighbors(current_node, self.closed_list)
+        for neighbor in neighbors:
+            if neighbor in self.closed_list:
+                continue  # Ignore this neighbor since it's already been evaluated
+
+            # Calculate the tentative g score for the neighbor
+            if neighbor.is_observed_as_underground_exit:
+                # start node have weird underground neigbors - look at the neighbor function
+                if (
+                    current_node.is_start_node
+                    and neighbor.distance(neighbor.position, current_node.position)
+                    < self.underground_reach
+                ):
+                    # if the distance is the reach, it is too far for direct underground, thus this must be the edge
+                    # case described by the neighbor function
                     cost_to_neighbor = (
                         current_node.cost_to_node
                         + current_node.weight_between_nodes(current_node, neighbor)
@@ -194,28 +587,66 @@ class A_star:
                     if cost_to_neighbor <= neighbor.cost_to_node:
                         # This path is the best so far, so record it. Also record if the
                         # Node was an underground node, then tell it to store it.
-
-                        neighbor.set_parent(current_node, False)
+                        neighbor.set_parent(current_node, True)
+                        neighbor.cost_to_node = cost_to_neighbor
+                else:
+                    underground_entry_node = self.find_entrance_node(
+                        current_node, neighbor
+                    )
+                    cost_to_neighbor = (
+                        underground_entry_node.cost_to_node
+                        + underground_entry_node.weight_between_nodes(
+                            underground_entry_node, neighbor
+                        )
+                        + current_node.cost_to_node
+                        + current_node.weight_between_nodes(
+                            current_node, underground_entry_node
+                        )
+                    )
+                    if cost_to_neighbor <= neighbor.cost_to_node:
+                        # This path is the best so far, so record it. Also record if the
+                        # Node was an underground node, then tell it to store it.
+                        # We deliberatly ignore the entry node. This should be taken care of in backtrace
+                        neighbor.set_parent(current_node, True)
                         neighbor.cost_to_node = cost_to_neighbor
 
-                if neighbor not in open_list:
-                    # This neighbor hasn't been evaluated yet, so add it to the open list
-                    open_list.append(neighbor)
-            if visualizer:
-                visualizer.show_frame()
+            else:
+                cost_to_neighbor = (
+                    current_node.cost_to_node
+                    + current_node.weight_between_nodes(current_node, neighbor)
+                )
+                if cost_to_neighbor <= neighbor.cost_to_node:
+                    # This path is the best so far, so record it. Also record if the
+                    # Node was an underground node, then tell it to store it.
+
+                    neighbor.set_parent(current_node, False)
+                    neighbor.cost_to_node = cost_to_neighbor
+
+            if neighbor not in self.open_list:
+                # This neighbor hasn't been evaluated yet, so add it to the open list
+                self.open_list.append(neighbor)
+        return neighbors
 
-        return None  # No path was found
+    def record_search(self, expanded, open_peak, found):
+        '''Report search statistics to the active profile'''
+        profiling.count('astar.searches')
+        profiling.count('astar.expanded', expanded)
+        profiling.observe('astar.expanded', expanded)
+        profiling.maximum('astar.open_peak', open_peak)
+        if not found:
+            profiling.count('astar.not_found')
 
     def get_neighbors(self, node: "Node", illegal_nodes: List["Node"]) -> List["Node"]:
         """
         Asks the Constructionside whether non-visited tiles directly around it has been visited.
 
         Also uses self.undergroundbelts to possibly check neighbors further away. A possible underground
-        neighbor, is a neighbor at a distance [(2)3-6] blocks away from current node in a straight line. The node
+        neighbor, is a neighbor at a distance [(2)3-reach] blocks away from current node in a straight line, where
+        reach is self.underground_reach, 6 for transport belts. The free tiles are found with self.runs. The node
         directly next to the current node, must be empty in that direction, as must the exit node.
         Note - while an underground to a node two nodes away is possible, it is a waste of underground, as the result
         would be the same as just two normal belts
-        An underground belt will start one node away from the current node, and terminate up to 6 nodes away.
+        An underground belt will start one node away from the current node, and terminate up to reach nodes away.
 
         example of underground belt:
 
@@ -234,11 +665,12 @@ class A_star:
         Desipite the last neigbour being too far away, since it then could reach it by placing a normal belt fist.
         """
         neighbors = []
+        reach = self.underground_reach
         if node.is_underground_exit:
             direction = self.find_normalized_direction(node.parent, node)
             x, y = node.position[0] + direction[0], node.position[1] + direction[1]
-            self.nodes[y][x].is_observed_as_underground_exit = False
-            neighbors.append(self.nodes[y][x])
+            self.node(x, y).is_observed_as_underground_exit = False
+            neighbors.append(self.node(x, y))
         else:
             directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]  # Up, Right, Down, Left
             for dx, dy in directions:
@@ -246,10 +678,11 @@ class A_star:
 
                 if self.node_is_empty(x, y):
                     # Normal neighbors
-                    neighbors.append(self.nodes[y][x])
+                    neighbor = self.node(x, y)
+                    neighbors.append(neighbor)
                     # Some nodes might previously have been set to underground neighbors
                     # But if we can see them normally now, then they shouldn't be.
-                    self.nodes[y][x].is_observed_as_underground_exit = False
+                    neighbor.is_observed_as_underground_exit = False
 
                     # Underground neighbors
                     # Requires that the adjacent neighbor is empty for underground entry
@@ -258,7 +691,9 @@ class A_star:
                     if (
                         self.underground_belts and not node.is_start_node
                     ):  # start nodes handled below
-                        for underground_distance in [3, 4, 5, 6]:
+                        for underground_distance in self.runs.free_cells(
+                            node.position[0], node.position[1], dx, dy, 3, reach
+                        ):
                             nx, ny = (
                                 node.position[0] + dx * underground_distance,
                                 node.position[1] + dy * underground_distance,
@@ -267,23 +702,22 @@ class A_star:
                             # The entry and exit should be empty. The entry and exit must not be illegal (in closed list),
                             # which also makes sure, it's not its parent. Also the node after the exit should be clear, except for end nodes
                             if (
-                                self.node_is_empty(nx, ny)
-                                and not illegal_nodes.__contains__(self.nodes[y][x])
+                                not illegal_nodes.__contains__(self.node(x, y))
                                 and (
                                     self.node_is_empty(nx + dx, ny + dy)
-                                    or self.nodes[ny][nx].is_end_node
+                                    or self.node(nx, ny).is_end_node
                                 )
                             ):
-                                neighbors.append(self.nodes[ny][nx])
-                                self.nodes[ny][
-                                    nx
-                                ].is_observed_as_underground_exit = True
+                                neighbors.append(self.node(nx, ny))
+                                self.node(nx, ny).is_observed_as_underground_exit = True
 
                 # Start node underground nodes
                 if self.underground_belts and node.is_start_node:
                     # if we are at a start node, it is allowed and preferred to do a direct underground
                     # This must therefore also be checked when using neighbors
-                    for underground_distance in [2, 3, 4, 5]:
+                    for underground_distance in self.runs.free_cells(
+                        node.position[0], node.position[1], dx, dy, 2, reach - 1
+                    ):
                         nx, ny = (
                             node.position[0] + dx * underground_distance,
                             node.position[1] + dy * underground_distance,
@@ -293,31 +727,28 @@ class A_star:
                         # Again it is important that the node after the end node is empty, else its no use as an underground
                         # except for the case where the exit node is a finish node.
                         if (
-                            not self.site.is_reserved(nx, ny)
-                            and self.is_in_bounds(nx, ny, self.nodes)
-                            and not illegal_nodes.__contains__(self.nodes[ny][nx])
+                            not illegal_nodes.__contains__(self.node(nx, ny))
                             and (
                                 self.node_is_empty(nx + dx, ny + dy)
-                                or self.nodes[ny][nx].is_end_node
+                                or self.node(nx, ny).is_end_node
                             )
                         ):
-                            neighbors.append(self.nodes[ny][nx])
-                            self.nodes[ny][nx].is_observed_as_underground_exit = True
+                            neighbors.append(self.node(nx, ny))
+                            self.node(nx, ny).is_observed_as_underground_exit = True
 
-                    nx, ny = (node.position[0] + dx * 6, node.position[1] + dy * 6)
-                    # Add 6th distance as usual
+                    nx, ny = (node.position[0] + dx * reach, node.position[1] + dy * reach)
+                    # Add the longest distance as usual
                     if (
-                        not self.site.is_reserved(nx, ny)
-                        and self.is_in_bounds(nx, ny, self.nodes)
-                        and not illegal_nodes.__contains__(self.nodes[y][x])
-                        and not self.site.is_reserved(x, y)
+                        self.node_is_empty(nx, ny)
+                        and not illegal_nodes.__contains__(self.node(x, y))
+                        and self.node_is_empty(x, y)
                         and (
                             self.node_is_empty(nx + dx, ny + dy)
-                            or self.nodes[ny][nx].is_end_node
+                            or self.node(nx, ny).is_end_node
                         )
                     ):
-                        neighbors.append(self.nodes[ny][nx])
-                        self.nodes[ny][nx].is_observed_as_underground_exit = True
+                        neighbors.append(self.node(nx, ny))
+                        self.node(nx, ny).is_observed_as_underground_exit = True
 
         # removing all illegal neigbors specific to this node.
         # This could be done while finding them to save performance
@@ -329,11 +760,27 @@ class A_star:
 
         return neighbors
 
-    def is_in_bounds(self, x, y, map):
-        return x >= 0 and y >= 0 and x < len(map[0]) and y < len(map)
+    def tile_heuristic(self, heuristic) -> Callable[[int, int], int]:
+        '''Return a function of the heuristic of a tile, or None when it is
+        computed for each node'''
+        if heuristic == 'euclidean':
+            return None
+        if heuristic == 'manhattan':
+            return manhattan_estimate(self.end_positions)
+        if heuristic == 'obstacles':
+            field = obstacle_field(self.free_grid(), self.end_positions, self.underground_reach)
+            return lambda x, y: field[y][x]
+        raise ValueError(f'Unknown heuristic {heuristic}, expected one of {HEURISTICS}')
+
+    def free_grid(self) -> List[List[bool]]:
+        '''Return whether each tile is free, indexed [y][x]'''
+        if self.free is None:
+            width, height = self.site.size()
+            self.free = [[not self.site.is_reserved(x, y) for x in range(width)] for y in range(height)]
+        return self.free
 
     def node_is_empty(self, x, y):
-        return self.is_in_bounds(x, y, self.nodes) and not self.site.is_reserved(x, y)
+        return self.runs.is_free(x, y)
 
     def backtrace(self, node: "Node", path_visualizer=None):
         """
@@ -351,10 +798,10 @@ class A_star:
                 and node.distance(node.parent.position, node.position) > 1
             ):
                 # This is an underground belt, and entries aren't taken care of, so we do this here
-                # if there is an entry. There are no entries on start_nodes (except for 1 case, with distance = 6)
+                # if there is an entry. There are no entries on start_nodes (except for 1 case, with distance = reach)
                 if (
                     not node.parent.is_start_node
-                    or node.distance(node.position, node.parent.position) == 6
+                    or node.distance(node.position, node.parent.position) == self.underground_reach
                 ):
                     entrance_node = self.find_entrance_node(
                         node.parent, node
@@ -367,3 +814,147 @@ class A_star:
             path.append((node.position[0], node.position[1]))
             node = node.parent
         return path[::-1]  # Reversed reversed path = normal path
+
+#
+#  Bidirectional search
+#
+
+def is_belt_path(path: List["tuple"], illegal_positions=(), reach=UNDERGROUND_REACH) -> bool:
+    '''Check that a path can be built with belts and underground belts.
+
+    Neighbors in the path are next to each other, or the entry and exit of
+    an underground belt, in line with the tiles before and after them. No
+    tile is used twice, nor any of the illegal positions, like the tiles of
+    the inserters at both ends.
+
+    :param reach:  Longest underground belt, from the tile before the entry
+        to the exit, as UNDERGROUND_REACH for other tiers of belt
+    '''
+    if len(set(path)) != len(path) or any(p in illegal_positions for p in path):
+        return False
+    for i in range(len(path) - 1):
+        (ax, ay), (bx, by) = path[i], path[i + 1]
+        distance = abs(bx - ax) + abs(by - ay)
+        if distance == 1:
+            continue
+        if (ax != bx and ay != by) or distance >= reach:
+            return False
+        dx, dy = (bx - ax) // distance, (by - ay) // distance
+        if i > 0 and path[i - 1] != (ax - dx, ay - dy):
+            return False
+        if i + 2 < len(path) and path[i + 2] != (bx + dx, by + dy):
+            return False
+    return True
+
+def find_path_bidirectional(
+    site: ConstructionSite,
+    start_positions: List["tuple"],
+    end_positions: List["tuple"],
+    start_node_illegal_neighbors: Dict["tuple", List["tuple"]],
+    end_node_illegal_neighbors: Dict["tuple", List["tuple"]],
+    underground_belts=False,
+    visualizer=None,
+    heuristic='euclidean',
+) -> List["tuple"]:
+    """
+    Find a path by searching from the start and the end positions at once,
+    until the two searches meet.
+
+    Belts are the same in both directions, so the backward search is a
+    plain A* from the end positions to the start positions. Where they meet,
+    the forward path is joined with the reversed backward path. The rules
+    for underground belts differ a little at the start nodes, and the
+    inserter tiles are only excluded at the ends of each search, so joined
+    paths are checked with is_belt_path before they are used.
+
+    Both sides order their open nodes by balanced keys, and the search stops
+    when no open node on either side can lead to a cheaper path than the
+    best one found. Like the forward search, the path is short, but not
+    always the shortest.
+
+    :param visualizer:  Shows the forward search
+    :return:  List of positions from a start to an end position, or None
+    """
+    log.debug("finding path from both ends")
+    forward = A_star(site, start_positions, end_positions,
+                     start_node_illegal_neighbors, end_node_illegal_neighbors)
+    backward = A_star(site, end_positions, start_positions,
+                      end_node_illegal_neighbors, start_node_illegal_neighbors)
+    reachable = forward.start_search(underground_belts, heuristic)
+    if not reachable or not backward.start_search(underground_belts, heuristic):
+        log.debug("No end node can be reached")
+        forward.record_search(0, 0, found=False)
+        return None
+
+    # Balanced keys: the cost to a node, plus half the difference of the
+    # estimates to both ends. No path through the open nodes is cheaper
+    # than the sum of the lowest keys on both sides.
+    def balance(finder: A_star, other: A_star):
+        def key(node):
+            x, y = node.position
+            h = finder.heuristic_value(node)
+            return ((node.cost_to_node + (h - other.heuristic_value(other.node(x, y))) / 2), h)
+        finder.estimate = key
+    balance(forward, backward)
+    balance(backward, forward)
+
+    if visualizer != None:
+        visualizer.set_closed_list(forward.closed_list)
+        visualizer.set_open_list(forward.open_list)
+        visualizer.set_start_squares(start_positions)
+        visualizer.set_end_squares(end_positions)
+        visualizer.reset()
+
+    best_cost = UNREACHABLE
+    best_path = None
+    def consider(forward_node: "Node", backward_node: "Node"):
+        '''Join the paths to a node reached from both sides, if it is the best yet'''
+        nonlocal best_cost, best_path
+        cost = forward_node.cost_to_node + backward_node.cost_to_node
+        if cost >= best_cost:
+            return
+        forward_path = forward.backtrace(forward_node) if forward_node.parent else [forward_node.position]
+        backward_path = backward.backtrace(backward_node) if backward_node.parent else [backward_node.position]
+        path = forward_path + backward_path[::-1][1:]
+        illegal = (start_node_illegal_neighbors.get(path[0], [])
+                   + end_node_illegal_neighbors.get(path[-1], []))
+        if is_belt_path(path, illegal):
+            best_cost = cost
+            best_path = path
+
+    expanded = 0
+    open_peak = 0
+    def lowest_key(finder: A_star):
+        return min(finder.estimate(node)[0] for node in finder.open_list)
+    while forward.open_list and backward.open_list:
+        if best_cost <= lowest_key(forward) + lowest_key(backward):
+            break
+        open_peak = max(open_peak, len(forward.open_list) + len(backward.open_list))
+        # Grow the smaller frontier
+        if len(forward.open_list) <= len(backward.open_list):
+            finder, other = forward, backward
+        else:
+            finder, other = backward, forward
+        current_node = finder.pop_node()
+        expanded += 1
+        if expanded % BUDGET_CHECK_INTERVAL == 0:
+            budget.check('find_path', expanded=expanded)
+
+        # Meet the other side at this node, or at one of its neighbors
+        for node in [current_node] + finder.expand(current_node):
+            x, y = node.position
+            other_node = other.node(x, y)
+            if node.parent is None and not node.is_start_node or other_node.cost_to_node >= UNREACHABLE:
+                continue
+            if finder is forward:
+                consider(node, other_node)
+            else:
+                consider(other_node, node)
+        if visualizer:
+            visualizer.show_frame()
+
+    found = best_path is not None
+    forward.record_search(expanded, open_peak, found)
+    if visualizer and found:
+        visualizer.show_frame(best_path)
+    return best_path
@@ -1,20 +1,51 @@
 '''
 This module has a number of functions to analyse a blueprint
     - extract the flow graph
-    - [TODO] find flow bottlenecks
+    - find flow bottlenecks
     - [TODO] expand flow graph for desired production
 '''
 
+import logging
+import math
+from collections import deque
+
 from vector import Vector
 import flow
+import layout
+from tiers import BELT_SPEED, INSERTER_SPEED
+
+#
+#  Logging
+#
+log = logging.getLogger(__name__)
 
+#
+#  Game constants
+#
 
+# Information from https://wiki.factorio.com/
+# Underground belt kind: (belt speed, max tiles under ground)
+UNDERGROUND_BELT = {
+    'underground-belt': (15, 4),
+    'fast-underground-belt': (30, 6),
+    'express-underground-belt': (45, 8),
+}
+# Distance from inserter to pickup and drop position
+INSERTER_REACH = {
+    'long-handed-inserter': 2,
+}
+CRAFTING_MACHINES = set([
+    'assembling-machine-1',
+    'assembling-machine-2',
+    'assembling-machine-3',
+])
 
 # Categorize entity types
 # TODO: This should be removed once all types are supported
-SUPPORTED_ENTITY_TYPES = set(['transport-belt'])
+SUPPORTED_ENTITY_TYPES = (set(BELT_SPEED) | set(UNDERGROUND_BELT)
+                          | set(INSERTER_SPEED) | CRAFTING_MACHINES)
 IGNORED_ENTITY_TYPES = set([
-    'se-electric-boiler', 'inserter', 'medium-electric-pole','aai-strongbox',
+    'se-electric-boiler', 'medium-electric-pole','aai-strongbox',
     'electric-mining-drill',
     # Ignored
     'gate', 
@@ -23,8 +54,6 @@ IGNORED_ENTITY_TYPES = set([
     'display-panel', 
 
     # Item transport
-    'assembling-machine-1', 
-    'assembling-machine-2', 
     'steel-furnace', 
     'electric-furnace', 
 
@@ -33,16 +62,8 @@ IGNORED_ENTITY_TYPES = set([
     'iron-chest', 
     'steel-chest', 
 
-    'burner-inserter', 
     'bulk-inserter', 
-    'fast-inserter', 
     'stack-inserter', 
-    'long-handed-inserter', 
-
-    'fast-transport-belt', 
-
-    'fast-underground-belt', 
-    'underground-belt', 
 
     'splitter', 
     'fast-splitter',
@@ -92,61 +113,227 @@ def vec_from_xydict(xydict):
     '''Convert a blueprint position to a Vector'''
     return Vector(xydict['x'], xydict['y'])
 
-def vec_from_dir(dir):
-    return Vector(1, 0)
+def vec_from_dir(dir, directions=8):
+    '''Convert a blueprint direction to a unit step on the grid
 
-def extract_flow_from_site(site):
-    '''Extract flow graph from construction site
-    :param site: A construction site with machines and belts
+    :param dir:  Blueprint direction, north is 0 and it increments clockwise
+    :param directions:  Number of directions in a full turn. This is 8 before
+        Factorio 2.0 and 16 from 2.0 on.
+    '''
+    quarter = directions // 4
+    if dir % quarter != 0:
+        raise ValueError(f'Direction {dir} is not along the grid')
+    return [Vector(0, -1), Vector(1, 0), Vector(0, 1), Vector(-1, 0)][dir // quarter % 4]
 
-    :return:  A flow.Graph with constraints set from entity prototype values. You can use this as input to flow.
+def blueprint_directions(blueprint):
+    '''Number of directions in a full turn, for the Factorio version
+    that made the blueprint'''
+    factorio_major_version = blueprint.get('version', 0) >> 48
+    return 16 if factorio_major_version >= 2 else 8
+
+def _crafting_node(enr, kind, recipe_name):
+    '''Create a flow node for a crafting machine from recipe data'''
+    import factoriocalc
+    node = flow.Node(id=enr, name=kind)
+    recipe = factoriocalc.rcpByName.get(recipe_name)
+    if recipe is None:
+        raise ValueError(f'Unknown recipe {recipe_name} in entity {enr}')
+    machine = factoriocalc.mchByName[kind]()
+    node.set_transformation(
+        inputs={c.item.name: float(c.num) for c in recipe.inputs},
+        outputs={c.item.name: float(c.num) for c in recipe.outputs},
+        crafting_speed=float(machine.craftingSpeed),
+        time=float(recipe.time))
+    return node
+
+def extract_flow_from_entities(entities, blueprint=None):
+    '''Extract flow graph from blueprint entities
+
+    Entities that are not in SUPPORTED_ENTITY_TYPES are left out.
+    Item types carried by belts and inserters are found from the recipes
+    of the machines they connect. Inputs not delivered to a machine, and
+    outputs not taken from it, are connected to extra nodes named "input"
+    and "output".
+
+    :param entities:  Iterable of entity dicts as found in a blueprint.
+        Entities are consumed one at a time, and only what is needed for
+        the flow graph is kept.
+    :param blueprint:  The other blueprint members, used to find the
+        Factorio version. It is read after all entities are consumed, so a
+        streaming reader may fill it in while delivering entities.
+    :return:  A flow.Graph with constraints set from entity prototype values.
     '''
     G = flow.Graph()
-    entity_type = {}
-    entity_center = {}
-    center_entity = {}
-    entity_dir = {}
-    for entity in site.get_entity_list():
+
+    # Keep what is needed from each entity
+    entity_info = {}
+    for entity in entities:
         try:
+            kind = entity['name']
+            if kind not in SUPPORTED_ENTITY_TYPES:
+                continue
             enr = int(entity['entity_number'])
-            entity_type[enr] = entity['name']
-            pos = vec_from_xydict(entity['position'])
-            entity_center[enr] = pos
-            center_entity[pos] = enr
-            entity_dir[enr] = entity.get('direction', 0)
-            node = flow.Node(id=enr, name=entity_type[enr])
-            G.add_node(node)
+            entity_info[enr] = dict(kind=kind, center=entity['position'],
+                                    direction=entity.get('direction', 0),
+                                    type=entity.get('type'))
+            if kind in CRAFTING_MACHINES:
+                if 'recipe' not in entity:
+                    continue
+                G.add_node(_crafting_node(enr, kind, entity['recipe']))
+            else:
+                G.add_node(flow.Node(id=enr, name=kind))
         except KeyError as ex:
             raise ValueError(f'Entity is incomplete: {entity}') from ex
-        except:
-            print(entity)
-            raise
-    print(G)
-
-    # Group entities by type
-    entity_kind_list = {}
-    for enr, kind in entity_type.items():
-        ekl = entity_kind_list.get(kind)
-        if ekl is None:
-            ekl = []
-            entity_kind_list[kind] = ekl
-        ekl.append(enr)
-
-    # Link transport belts
-    for belt in entity_kind_list.get('transport-belt', []):
-        flow_dir = vec_from_dir(entity_dir[belt])
-        next_pos = entity_center[belt] + flow_dir
-        next_belt = center_entity.get(next_pos)
-        print(f'belt {belt} at {entity_center[belt]} reach for {next_pos}, found belt {next_belt}')
-        if next_belt:
-            G.add_edge(belt, next_belt)
-
-    print('---- after belt linked up ----')
-    print(G)
-
-    raise NotImplementedError()
+    log.debug(f'Found {len(G.nodes)} flow nodes')
+
+    # Find the tiles covered by each entity
+    directions = blueprint_directions(blueprint or {})
+    tile_entity = {}
+    for enr, info in entity_info.items():
+        kind, direction = info['kind'], info['direction']
+        # Sizes are in 8-way directions
+        size_dir = direction * 8 // directions
+        pos = layout.top_left_pos(kind, size_dir, info.pop('center'))
+        info['pos'] = (round(pos[0]), round(pos[1]))
+        info['step'] = vec_from_dir(direction, directions) if kind not in CRAFTING_MACHINES else None
+        for ofs in layout.iter_entity_area(kind, size_dir):
+            tile_entity[(info['pos'][0] + ofs[0], info['pos'][1] + ofs[1])] = enr
+
+    def entity_at(pos):
+        enr = tile_entity.get((int(pos[0]), int(pos[1])))
+        return enr if enr in G.nodes else None
+
+    def accepts_belt(enr, step):
+        '''Test if a belt moving along step can move items into entity'''
+        info = entity_info[enr]
+        if info['kind'] in BELT_SPEED:
+            return info['step'] != step * -1
+        if info['kind'] in UNDERGROUND_BELT:
+            return info['type'] == 'input' and info['step'] == step
+        return False
+
+    # Link entities
+    links = []
+    for enr, info in entity_info.items():
+        kind, step = info['kind'], info['step']
+        pos = Vector(*info['pos'])
+        if enr not in G.nodes:
+            continue
+        if kind in BELT_SPEED or (kind in UNDERGROUND_BELT and info['type'] == 'output'):
+            next_belt = entity_at(pos + step)
+            if next_belt is not None and accepts_belt(next_belt, step):
+                links.append((enr, next_belt))
+        elif kind in UNDERGROUND_BELT:
+            max_length = UNDERGROUND_BELT[kind][1]
+            for distance in range(1, max_length + 2):
+                other = entity_at(pos + step * distance)
+                if other is None:
+                    continue
+                other_info = entity_info[other]
+                if other_info['kind'] == kind and other_info['step'] == step:
+                    if other_info['type'] == 'output':
+                        links.append((enr, other))
+                    break
+        elif kind in INSERTER_SPEED:
+            # The inserter direction points towards the pickup position
+            reach = INSERTER_REACH.get(kind, 1)
+            pickup = entity_at(pos + step * reach)
+            drop = entity_at(pos - step * reach)
+            if pickup is not None and entity_info[pickup]['kind'] not in INSERTER_SPEED:
+                links.append((pickup, enr))
+            if drop is not None and entity_info[drop]['kind'] not in INSERTER_SPEED:
+                links.append((enr, drop))
+    log.debug(f'Found {len(links)} links')
+
+    # Find the items moved by belts and inserters
+    predecessors = {n: [] for n in G.nodes}
+    successors = {n: [] for n in G.nodes}
+    for u, v in links:
+        successors[u].append(v)
+        predecessors[v].append(u)
+    transport = [n for n in G.nodes if entity_info[n]['kind'] not in CRAFTING_MACHINES]
+    def propagate(items, neighbours, dependents, known):
+        '''Add items found at neighbours to known until nothing changes'''
+        queue = deque(transport)
+        while queue:
+            n = queue.popleft()
+            found = set()
+            for m in neighbours[n]:
+                found |= items(m)
+            if not found <= known[n]:
+                known[n] |= found
+                queue.extend(m for m in dependents[n] if m in known)
+    def needed_by(n):
+        return needed[n] if n in needed else set(G.nodes[n].inputs)
+    def produced_by(n):
+        return produced[n] if n in produced else set(G.nodes[n].outputs)
+    # Forward pass: what machines deliver to the node
+    produced = {n: set() for n in transport}
+    propagate(produced_by, predecessors, successors, produced)
+    # Backward pass: what is needed after the node. Nodes without outputs
+    # deliver everything they get to the outside of the blueprint.
+    needed = {n: set() if successors[n] else set(produced[n]) for n in transport}
+    propagate(needed_by, successors, predecessors, needed)
+    # Forward pass again: Nodes without inputs are fed from the outside of
+    # the blueprint with whatever is needed.
+    for n in transport:
+        if len(predecessors[n]) == 0:
+            produced[n] = set(needed[n])
+    propagate(produced_by, predecessors, successors, produced)
+    for n in transport:
+        items = produced[n] & needed[n]
+        info = entity_info[n]
+        if info['kind'] in BELT_SPEED:
+            capacity = BELT_SPEED[info['kind']]
+        elif info['kind'] in UNDERGROUND_BELT:
+            capacity = UNDERGROUND_BELT[info['kind']][0]
+        else:
+            capacity = INSERTER_SPEED[info['kind']]
+        G.nodes[n].inputs = {item: capacity for item in items}
+        G.nodes[n].outputs = {item: capacity for item in items}
+
+    for u, v in links:
+        G.add_edge(u, v)
+
+    # Connect unused machine inputs and outputs to the outside
+    for n in list(G.nodes):
+        if entity_info.get(n, {}).get('kind') not in CRAFTING_MACHINES:
+            continue
+        node = G.nodes[n]
+        delivered = set()
+        for u in G.graph.predecessors(n):
+            delivered |= set(G.graph.edges[u, n].keys())
+        for item in set(node.inputs) - delivered:
+            port = G.add_node(flow.Node(id=f'input:{n}:{item}', name='input',
+                                        inputs={}, outputs={item: node.inputs[item]}))
+            G.add_edge(port, node)
+        taken = set()
+        for v in G.graph.successors(n):
+            taken |= set(G.graph.edges[n, v].keys())
+        for item in set(node.outputs) - taken:
+            port = G.add_node(flow.Node(id=f'output:{n}:{item}', name='output',
+                                        inputs={item: node.outputs[item]}, outputs={}))
+            G.add_edge(node, port)
+
+    log.debug(G)
     return G
 
+def extract_flow_from_site(site):
+    '''Extract flow graph from construction site
+    :param site: A construction site with machines and belts
+
+    :return:  A flow.Graph with constraints set from entity prototype values. You can use this as input to flow.
+    '''
+    return extract_flow_from_entities(site.get_entity_list())
+
+def _validated_entities(entities, invalid_entity_types):
+    '''Pass entities through, collecting the names of unknown entity types'''
+    ALLOWED_ENTITY_TYPES = SUPPORTED_ENTITY_TYPES | IGNORED_ENTITY_TYPES
+    for entity in entities:
+        if entity.get('name') not in ALLOWED_ENTITY_TYPES:
+            invalid_entity_types.add(entity.get('name'))
+        yield entity
+
 def extract_flow_from_blueprint(bp_dict):
     '''Extract flow graph from blueprint
     :param bp_dict: A blueprint dict as exported from
@@ -155,14 +342,103 @@ def extract_flow_from_blueprint(bp_dict):
     assert isinstance(bp_dict, dict)
     if not 'blueprint' in bp_dict:
         raise ValueError('Dict does not contain a blueprint')
-    print(f'Blueprint content: {bp_dict["blueprint"].keys()}')
+    log.debug(f'Blueprint content: {bp_dict["blueprint"].keys()}')
     if not 'entities' in bp_dict['blueprint']:
         raise ValueError('Not a valid blueprint dict. No entities found')
     entity_list = bp_dict['blueprint']['entities']
 
-    # Validate entity types
-    ALLOWED_ENTITY_TYPES = SUPPORTED_ENTITY_TYPES | IGNORED_ENTITY_TYPES
-    found_entity_types = set([entity['name'] for entity in entity_list])
-    invalid_entity_types = found_entity_types - ALLOWED_ENTITY_TYPES
+    invalid_entity_types = set()
+    G = extract_flow_from_entities(
+        _validated_entities(entity_list, invalid_entity_types), bp_dict['blueprint'])
+    if len(invalid_entity_types) > 0:
+        raise ValueError(f'Unsupported entity types: {invalid_entity_types}')
+    return G
+
+def extract_flow_from_exchange_string(source):
+    '''Extract flow graph from a blueprint exchange string. The blueprint
+    is decoded one entity at a time, so it is never held in memory as a whole.
+
+    :param source:  A blueprint exchange string, or a text file to read it from
+    :return:  A flow.Graph with constraints set from entity prototype values. You can use this as input to flow.
+    '''
+    blueprint = {}
+    def entities():
+        for path, value in layout.iter_blueprint_events(source):
+            if path[0] != 'blueprint':
+                raise ValueError('Exchange string does not contain a blueprint')
+            if len(path) == 1:
+                raise ValueError('Not a valid blueprint. Blueprint is not an object')
+            if path[1] == 'entities':
+                blueprint['entities'] = True
+                if len(path) == 3:
+                    yield value
+            else:
+                blueprint[path[1]] = value
+
+    invalid_entity_types = set()
+    G = extract_flow_from_entities(
+        _validated_entities(entities(), invalid_entity_types), blueprint)
+    if 'entities' not in blueprint:
+        raise ValueError('Not a valid blueprint. No entities found')
     if len(invalid_entity_types) > 0:
         raise ValueError(f'Unsupported entity types: {invalid_entity_types}')
+    return G
+
+def _is_port(node: flow.Node):
+    return node.name in ('input', 'output')
+
+def flow_report(G: flow.Graph):
+    '''Compute max flow and find bottlenecks in a flow graph
+
+    :param G:  flow.Graph, as extracted from a blueprint
+    :return:  A dict with the NodeFlow members "inputs" and "outputs",
+        and a "bottlenecks" list as described by flow.find_bottlenecks.
+    '''
+    import networkx
+    try:
+        flow.compute_max_flow(G)
+    except networkx.NetworkXUnfeasible as ex:
+        raise ValueError('Flow graph has loops, max flow cannot be computed') from ex
+
+    # Items enter at nodes without input, and leave at nodes without output
+    inputs = {}
+    outputs = {}
+    for n, node in G.nodes.items():
+        if G.graph.in_degree(n) == 0 and node.outputs:
+            for item, rate in node.outputs.items():
+                inputs[item] = inputs.get(item, 0) + rate * node.throttle
+        if G.graph.out_degree(n) == 0 and node.inputs:
+            for item, rate in node.inputs.items():
+                outputs[item] = outputs.get(item, 0) + rate * node.throttle
+
+    ports = [n for n, node in G.nodes.items() if _is_port(node)]
+    bottlenecks = flow.find_bottlenecks(G, ignore=ports)
+    return {
+        'inputs': [dict(kind=item, rate=rate) for item, rate in sorted(inputs.items())],
+        'outputs': [dict(kind=item, rate=rate) for item, rate in sorted(outputs.items())],
+        'bottlenecks': bottlenecks,
+    }
+
+def _page_flow_report(page):
+    '''Analyze one blueprint from a book, see analyze_blueprint_book'''
+    indexes, bp_dict = page
+    result = dict(index=list(indexes), label=bp_dict['blueprint'].get('label'))
+    try:
+        result['report'] = flow_report(extract_flow_from_blueprint(bp_dict))
+    except ValueError as ex:
+        result['error'] = str(ex)
+    return result
+
+def analyze_blueprint_book(bp_dict, processes=None):
+    '''Compute max flow and find bottlenecks in every blueprint of a book.
+    The blueprints are analyzed independently, in parallel.
+
+    :param bp_dict:  A decoded blueprint book, or a single blueprint
+    :param processes:  Number of worker processes, see layout.map_blueprints
+    :return:  A list with a dict for each blueprint, with members "index"
+        (the page index in each nested book), "label", and either "report"
+        as described by flow_report, or "error" if the blueprint could not
+        be analyzed.
+    '''
+    pages = list(layout.iter_book_blueprints(bp_dict))
+    return layout.map_blueprints(_page_flow_report, pages, processes)
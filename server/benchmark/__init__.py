@@ -0,0 +1,6 @@
+'''Benchmarks of the blueprint generator.
+
+Run a benchmark from the server folder, eg.
+    python -m benchmark.encode
+    python -m benchmark.suite --output results.json
+'''
@@ -0,0 +1,80 @@
+'''Benchmark blueprint encoding: time to encode versus length of the
+exchange string, for each compression level, strategy and JSON backend.
+
+Run from the server folder:
+    python -m benchmark.encode --size 32 --size 128
+'''
+
+import time
+
+import click
+
+import layout
+
+BELT = 'transport-belt'
+ASSEMBLER = 'assembling-machine-1'
+
+
+def mixed_site(side):
+    '''A square site with rows of assemblers separated by belts'''
+    site = layout.ConstructionSite(side, side)
+    for y in range(0, side - 3, 4):
+        for x in range(0, side - 2, 3):
+            site.add_entity(ASSEMBLER, (x, y), 0, recipe='iron-gear-wheel')
+        for x in range(side):
+            site.add_entity(BELT, (x, y + 3), 2)
+    return site
+
+def best_time(function, repeat):
+    '''Shortest time in seconds of repeated calls to function'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def encoders(site):
+    '''Yield (description, function) for each way to encode the site'''
+    def from_dict(**kwarg):
+        bp_dict = layout.empty_blueprint_dict()
+        bp_dict['blueprint']['entities'] = site.get_entity_list()
+        return layout.export_blueprint_dict(bp_dict, **kwarg)
+
+    def legacy():
+        # Encoding before compression options were added
+        import base64, json, zlib
+        bp_dict = layout.empty_blueprint_dict()
+        bp_dict['blueprint']['entities'] = site.get_entity_list()
+        return '0' + base64.b64encode(zlib.compress(json.dumps(bp_dict).encode('utf-8'), 9)).decode('utf-8')
+
+    yield 'legacy', legacy
+    for backend in ['json', 'orjson']:
+        try:
+            layout.json_encoder(backend)
+        except ImportError:
+            continue
+        for level in [1, 6, 9]:
+            yield (f'dict {backend} level {level}',
+                   lambda b=backend, l=level: from_dict(json_backend=b, level=l))
+            yield (f'site {backend} level {level}',
+                   lambda b=backend, l=level: layout.site_as_blueprint_string(site, json_backend=b, level=l))
+    for strategy in layout.COMPRESSION_STRATEGIES:
+        yield (f'site strategy {strategy}',
+               lambda s=strategy: layout.site_as_blueprint_string(site, strategy=s))
+
+@click.command
+@click.option('--size', 'sizes', type=int, multiple=True, default=[32, 128, 256], help='Site side length')
+@click.option('--repeat', default=3, help='Repeat each measurement, and use the best time')
+def main(sizes, repeat):
+    '''Measure encode time and exchange string length'''
+    click.echo(f'{"site":>9} {"entities":>8}  {"encoder":<26} {"time ms":>9} {"length":>9}')
+    for side in sizes:
+        site = mixed_site(side)
+        for description, encode in encoders(site):
+            seconds, bp_string = best_time(encode, repeat)
+            click.echo(f'{side:>4}x{side:<4} {len(site.entities):>8}  {description:<26}'
+                       f' {seconds*1000:>9.2f} {len(bp_string):>9}')
+
+if __name__ == '__main__':
+    main()
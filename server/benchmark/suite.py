@@ -0,0 +1,268 @@
+'''End-to-end benchmark of the blueprint generator on synthetic workloads.
+
+Each workload is run in stages, and every stage is timed and has its peak
+memory measured. Results are written as JSON, and can be compared with the
+results of an earlier run to find regressions.
+
+Workloads:
+
+- factory: electronic circuits from plates, solved by factoriocalc to get
+  a given number of machines, and laid out by spring on a square site. The
+  layout is then spread until machines are apart, and placed on a site
+  that fits it. Stages are solve, add_connections, spring, spread,
+  machines_to_int, place_on_site and export.
+- routing: a path between two machines in opposite corners of a square
+  site, with a given density of 1x1 obstacles. Stages are find_path,
+  find_path_tiles that searches tiles without the heading of belts,
+  find_path_bidirectional that searches from both machines at once, and
+  find_path_hierarchical that plans the route over 32x32 chunks first.
+
+Run from the server folder:
+    python -m benchmark.suite --output results.json
+    python -m benchmark.suite --machines 10 --machines 500 --side 1024 --baseline results.json
+
+Large workloads are slow. Spring layout is quadratic in the number of
+machines, so factories of thousands of machines take a long time.
+'''
+
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import click
+
+import hierarchy
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Constants
+#
+
+OBSTACLE = 'wooden-chest'
+MACHINE_SIZE = (3, 3)
+# Site area per machine in factory workloads, room for machines and belts
+AREA_PER_MACHINE = 30
+# Tiles between machines after the spring layout is spread, see
+# solver.spread_machines
+MACHINE_GAP = 3
+# Tiles around the machines of the site they are placed on
+SITE_MARGIN = 4
+
+#
+#  Workloads
+#
+
+def solve_factory(machine_count):
+    '''Solve for an electronic circuit factory of about machine_count machines'''
+    import factoriocalc as fc
+    import factoriocalc.presets as fcc
+    fc.config.machinePrefs.set(fcc.MP_LATE_GAME)
+    fc.config.machinePrefs.set([fc.mch.AssemblingMachine2()])
+    def produce(rate):
+        return fc.produce([fc.itm.electronic_circuit @ rate],
+                          using=[fc.itm.iron_plate, fc.itm.copper_plate], roundUp=True).factory
+    def count(factory):
+        return sum(m.num for m in factory.inner.machine.machines)
+
+    # Machine count is close to proportional to the rate
+    import fractions
+    rate = 10
+    return produce(fractions.Fraction(rate * machine_count, count(produce(rate))))
+
+def fitting_site(machines, margin=SITE_MARGIN) -> layout.ConstructionSite:
+    '''Move machines by whole tiles to a margin from the top left corner,
+    and return a site that fits them with the margin on all sides'''
+    x0 = min(math.floor(m.position[0]) for m in machines)
+    y0 = min(math.floor(m.position[1]) for m in machines)
+    offset = Vector(margin - x0, margin - y0)
+    for m in machines:
+        m.move(offset)
+    x1 = max(math.ceil(m.position[0]) + m.size()[0] for m in machines)
+    y1 = max(math.ceil(m.position[1]) + m.size()[1] for m in machines)
+    return layout.ConstructionSite(x1 + margin, y1 + margin)
+
+def factory_stages(machine_count, side):
+    '''Return a list of (stage name, function) for a factory workload.
+    The functions share state through a dict, given as argument.'''
+    borders = ((0, 0), (side, side))
+
+    def solve(state):
+        state['factory'] = solve_factory(machine_count)
+        state['machines'] = solver.randomly_placed_machines(state['factory'], (side, side))
+
+    def spread(state):
+        solver.spread_machines(state['machines'], MACHINE_GAP)
+        state['site'] = fitting_site(state['machines'])
+
+    return [
+        ('solve', solve),
+        ('add_connections', lambda state: solver.add_connections(state['machines'])),
+        ('spring', lambda state: solver.spring(state['machines'], borders=borders)),
+        ('spread', spread),
+        ('machines_to_int', lambda state: solver.machines_to_int(state['machines'])),
+        ('place_on_site', lambda state: solver.place_on_site(state['site'], state['machines'])),
+        ('export', lambda state: layout.site_as_blueprint_string(state['site'])),
+    ]
+
+def routing_stages(side, density):
+    '''Return a list of (stage name, function) for a routing workload'''
+    def add_obstacles(state):
+        site = layout.ConstructionSite(side, side)
+        source = solver.FakeMachine(Vector(1, 1), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(side - 4, side - 4), MACHINE_SIZE)
+        keep_free = set()
+        for m in [source, target]:
+            x0, y0 = m.position.as_int()
+            keep_free.update((x, y) for x in range(x0 - 1, x0 + 4) for y in range(y0 - 1, y0 + 4))
+        for y in range(side):
+            for x in range(side):
+                if (x, y) not in keep_free and random.random() < density:
+                    site.add_entity(OBSTACLE, (x, y), 0)
+        state['site'] = site
+        state['source'] = source
+        state['target'] = target
+
+    return [
+        ('obstacles', add_obstacles),
+        ('find_path', lambda state: solver.find_path(state['site'], state['source'], state['target'])),
+        ('find_path_tiles', lambda state: solver.find_path(
+            state['site'], state['source'], state['target'], directional=False)),
+        ('find_path_bidirectional', lambda state: solver.find_path(
+            state['site'], state['source'], state['target'], bidirectional=True)),
+        ('find_path_hierarchical', lambda state: solver.find_path(
+            state['site'], state['source'], state['target'], chunks=hierarchy.ChunkGraph(state['site']))),
+    ]
+
+def workloads(machine_counts, sides, densities):
+    '''Yield (name, params, stages) for each workload'''
+    for machine_count in machine_counts:
+        side = max(32, math.ceil(math.sqrt(machine_count * AREA_PER_MACHINE)))
+        yield (f'factory machines={machine_count} side={side}',
+               dict(workload='factory', machines=machine_count, side=side),
+               factory_stages(machine_count, side))
+    for side in sides:
+        for density in densities:
+            yield (f'routing side={side} density={density}',
+                   dict(workload='routing', side=side, density=density),
+                   routing_stages(side, density))
+
+#
+#  Measurement
+#
+
+def run_stages(stages, seed, trace_memory):
+    '''Run the stages in order, until one of them fails
+
+    :return:  List of dicts with stage, seconds, peak_bytes, error, and the
+        counters and values from profiling
+    '''
+    random.seed(seed)
+    state = {}
+    results = []
+    for stage, function in stages:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        error = None
+        with profiling.profile() as profile:
+            try:
+                function(state)
+            except Exception as ex:
+                error = f'{type(ex).__name__}: {ex}'
+        seconds = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        results.append(dict(stage=stage, seconds=seconds, peak_bytes=peak, error=error,
+                            counters=profile.counters, values=profile.values))
+        if error is not None:
+            break
+    return results
+
+def measure(stages, seed, repeat):
+    '''Measure the best time of each stage over repeated runs, and the peak
+    memory in a separate run, as tracing memory slows the code down.
+    Each run starts from the same random seed, so runs are alike.'''
+    best = None
+    for _ in range(repeat):
+        results = run_stages(stages, seed, trace_memory=False)
+        if best is None:
+            best = results
+        else:
+            for b, r in zip(best, results):
+                b['seconds'] = min(b['seconds'], r['seconds'])
+    for b, r in zip(best, run_stages(stages, seed, trace_memory=True)):
+        b['peak_bytes'] = r['peak_bytes']
+    return best
+
+def compare(results, baseline, tolerance, min_seconds):
+    '''Find stages that are slower than in the baseline
+
+    :param tolerance:  Allowed relative slowdown, 0.2 is 20%
+    :param min_seconds:  Slowdowns smaller than this are ignored as noise
+    :return:  List of (result, baseline seconds) for the regressions
+    '''
+    known = {(b['name'], b['stage']): b for b in baseline['results']}
+    regressions = []
+    for r in results:
+        b = known.get((r['name'], r['stage']))
+        if b is None or r['error'] is not None or b['error'] is not None:
+            continue
+        if r['seconds'] > b['seconds'] * (1 + tolerance) and r['seconds'] - b['seconds'] > min_seconds:
+            regressions.append((r, b['seconds']))
+    return regressions
+
+@click.command
+@click.option('--machines', 'machine_counts', type=click.IntRange(min=1), multiple=True, default=[10, 50],
+              help='Machines in a factory workload, 10 to 5000')
+@click.option('--side', 'sides', type=click.IntRange(min=16), multiple=True, default=[32, 64],
+              help='Site side length of a routing workload, 32 to 1024')
+@click.option('--density', 'densities', type=click.FloatRange(0, 1), multiple=True, default=[0.1, 0.3],
+              help='Obstacle density of a routing workload')
+@click.option('--repeat', type=click.IntRange(min=1), default=3, help='Repeat each workload, and use the best time')
+@click.option('--seed', default=1, help='Random seed of each workload')
+@click.option('-o', '--output', type=click.File('w'), help='Write results to this JSON file')
+@click.option('--baseline', type=click.File('r'), help='Compare with results from an earlier run')
+@click.option('--tolerance', default=0.2, help='Allowed relative slowdown compared to the baseline')
+@click.option('--min-seconds', default=0.005, help='Ignore slowdowns smaller than this')
+def main(machine_counts, sides, densities, repeat, seed, output, baseline, tolerance, min_seconds):
+    '''Time each stage of synthetic workloads, and flag regressions'''
+    results = []
+    click.echo(f'{"workload":<36} {"stage":<24} {"time ms":>10} {"peak MB":>9}')
+    for name, params, stages in workloads(machine_counts, sides, densities):
+        for r in measure(stages, seed, repeat):
+            r = dict(name=name, params=params, **r)
+            results.append(r)
+            status = '' if r['error'] is None else f' {r["error"]}'
+            click.echo(f'{name:<36} {r["stage"]:<24} {r["seconds"]*1000:>10.2f}'
+                       f' {r["peak_bytes"]/1e6:>9.2f}{status}')
+
+    if output is not None:
+        json.dump(dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            repeat=repeat,
+            seed=seed,
+            results=results,
+        ), output, indent=1)
+
+    if baseline is not None:
+        regressions = compare(results, json.load(baseline), tolerance, min_seconds)
+        for r, seconds in regressions:
+            click.echo(f'Regression: {r["name"]} {r["stage"]} {r["seconds"]*1000:.2f} ms,'
+                       f' was {seconds*1000:.2f} ms')
+        if regressions:
+            sys.exit(1)
+        click.echo('No regressions')
+
+if __name__ == '__main__':
+    main()
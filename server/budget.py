@@ -0,0 +1,126 @@
+''' Time budgets and cancellation of blueprint generation.
+
+Long running loops check the active budget now and then. When the time is
+up, loops that have a useful partial result, like the spring layout, stop
+and return it. Others raise TimeBudgetExceeded, with details on how far
+they got. When a budget is cancelled, eg. because the client left, checks
+raise Cancelled, as nobody wants the result.
+
+Like profiles, a budget is active in the context where it was started, so
+it does not need to be passed through every function.
+
+Primary interface:
+
+- :class:`Budget` - a deadline and a cancellation flag
+- :func:`limit` - context manager making a budget active
+- :func:`check` - raise if cancelled or out of time
+- :func:`expired` - tell if out of time, raise if cancelled
+'''
+
+import contextlib
+import contextvars
+import threading
+import time
+
+#
+#  Classes
+#
+
+class Cancelled(Exception):
+    '''Raised when the result of a computation is no longer wanted'''
+
+
+class TimeBudgetExceeded(Cancelled):
+    '''Raised when a computation runs out of time
+
+    :param stage:  Name of the stage that ran out of time
+    :param details:  Progress made, like connections routed
+    '''
+
+    def __init__(self, stage, budget_seconds, elapsed_seconds, **details):
+        super().__init__(f'Time budget of {budget_seconds:g} s exceeded in {stage}')
+        self.stage = stage
+        self.budget_seconds = budget_seconds
+        self.elapsed_seconds = elapsed_seconds
+        self.details = details
+
+    def as_dict(self):
+        '''Return the error as plain data, ready for JSON'''
+        return dict(error='timeout', stage=self.stage, budget_seconds=self.budget_seconds,
+                    elapsed_seconds=self.elapsed_seconds, **self.details)
+
+
+class Budget:
+    '''A wall-clock deadline, and a flag to cancel the computation.
+    The budget can be cancelled from another thread.
+
+    :param seconds:  Time allowed from now. None is no limit.
+    '''
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.start = time.monotonic()
+        self.deadline = None if seconds is None else self.start + seconds
+        self.cancelled = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason='Cancelled'):
+        self.reason = reason
+        self.cancelled.set()
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def remaining(self):
+        '''Seconds left, or None if there is no limit'''
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        '''Return True if out of time. Raise Cancelled if cancelled.'''
+        if self.cancelled.is_set():
+            raise Cancelled(self.reason)
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def check(self, stage, **details):
+        '''Raise Cancelled if cancelled, or TimeBudgetExceeded if out of time'''
+        if self.expired():
+            raise TimeBudgetExceeded(stage, self.seconds, self.elapsed(), **details)
+
+_current_budget = contextvars.ContextVar('budget', default=None)
+
+#
+#  Functions
+#
+
+def current_budget():
+    '''Return the active Budget, or None'''
+    return _current_budget.get()
+
+@contextlib.contextmanager
+def limit(budget):
+    '''Make a budget active until the context ends
+
+    :param budget:  A Budget, or seconds for a new Budget
+    '''
+    if not isinstance(budget, Budget):
+        budget = Budget(budget)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+def check(stage, **details):
+    '''Raise Cancelled if the active budget is cancelled, or
+    TimeBudgetExceeded if it is out of time'''
+    b = _current_budget.get()
+    if b is not None:
+        b.check(stage, **details)
+
+def expired():
+    '''Return True if the active budget is out of time. Raise Cancelled if
+    it is cancelled.'''
+    b = _current_budget.get()
+    return b is not None and b.expired()
@@ -3,11 +3,23 @@ It can be used for testing, or simply for scripting access to GERD featuers'''
 
 import click
 
-import analyze
 import layout
 
+OPTIONAL_BLUEPRINT_KEYS = set(['item', 'label', 'description', 'entities', 'tiles', 'icons', 'schedules', 'stock_connections', 'version', 'wires'])
+MANDATORY_BLUEPRINT_KEYS = set(['item','entities', 'icons', 'version'])
+
+def validate_blueprint_keys(found_blueprint_keys):
+    '''Raise ValueError unless the blueprint has exactly the keys we know about'''
+    found_blueprint_keys = set(found_blueprint_keys)
+    missing_keys = MANDATORY_BLUEPRINT_KEYS - found_blueprint_keys
+    extra_keys = found_blueprint_keys - MANDATORY_BLUEPRINT_KEYS - OPTIONAL_BLUEPRINT_KEYS
+    if len(missing_keys) > 0:
+        raise ValueError(f'Blueprint missing keys: {missing_keys}, has keys: {found_blueprint_keys}')
+    if len(extra_keys) > 0:
+        raise ValueError(f'Blueprint unknown keys: {extra_keys}, has keys: {found_blueprint_keys}')
+
 def load_blueprint(filename):
-    '''Load and validate a string-encoded blueprint from a file.'''
+    '''Load and validate a string-encoded blueprint or blueprint book from a file.'''
 
     # Load data
     with open(filename) as fi:
@@ -15,65 +27,235 @@ def load_blueprint(filename):
         bp_dict = layout.import_blueprint_dict(data)
 
     # Validate data
-    if list(bp_dict.keys()) != ['blueprint']:
-        raise ValueError(f'Expected a blueprint, but root JSON keys are: {list(bp_dict.keys())}')
-    blueprint = bp_dict['blueprint']
-    OPTIONAL_BLUEPRINT_KEYS = set(['item', 'label', 'description', 'entities', 'tiles', 'icons', 'schedules', 'stock_connections', 'version', 'wires'])
-    MANDATORY_BLUEPRINT_KEYS = set(['item','entities', 'icons', 'version'])
-    found_blueprint_keys = set(blueprint.keys())
-    missing_keys = MANDATORY_BLUEPRINT_KEYS - found_blueprint_keys
-    extra_keys = found_blueprint_keys - MANDATORY_BLUEPRINT_KEYS - OPTIONAL_BLUEPRINT_KEYS
-    if len(missing_keys) > 0:
-        print(f'Blueprint keys: {found_blueprint_keys}')
-        raise ValueError(f'Blueprint missing keys: {missing_keys}')
-    if len(extra_keys) > 0:
-        print(f'Blueprint keys: {found_blueprint_keys}')
-        raise ValueError(f'Blueprint unknown keys: {extra_keys}')
+    if list(bp_dict.keys()) not in (['blueprint'], ['blueprint_book']):
+        raise ValueError(f'Expected a blueprint or a blueprint book, but root JSON keys are: {list(bp_dict.keys())}')
+    for _, page in layout.iter_book_blueprints(bp_dict):
+        validate_blueprint_keys(page['blueprint'].keys())
 
     return bp_dict
 
-def show_blueprint_stats(bp_dict, show_entity_details):
+def blueprint_root_key(filename):
+    '''Return "blueprint" or "blueprint_book", depending on the content of a
+    string-encoded file. Only the start of the file is decoded.'''
+    with open(filename) as fi:
+        for path, _ in layout.iter_blueprint_events(fi):
+            return path[0]
+
+def blueprint_stats(blueprint, entities):
+    '''Compute some blueprint statistics
+
+    :param blueprint:  Dict with the blueprint members. It is read after all
+        entities are consumed, so a streaming reader may fill it in while
+        delivering entities.
+    :param entities:  Iterable of entities, consumed one at a time
+    :return:  Dict with title, version, dimensions and entity count by kind
+    '''
+    import collections
+    entity_count = collections.Counter()
+    x0 = y0 = float('inf')
+    x9 = y9 = float('-inf')
+    for e in entities:
+        entity_count[e['name']] += 1
+        x, y = e['position']['x'], e['position']['y']
+        x0, x9 = min(x0, x), max(x9, x)
+        y0, y9 = min(y0, y), max(y9, y)
+    return dict(
+        title=blueprint.get('label'),
+        version=layout.factorio_version_int_as_string(blueprint['version']),
+        dimensions=(x0, x9, y0, y9) if entity_count else None,
+        description=blueprint.get('description'),
+        entities=entity_count,
+    )
+
+def stream_blueprint_stats(filename):
+    '''Load and validate a string-encoded blueprint from a file, and compute
+    statistics one entity at a time, see blueprint_stats.'''
+    blueprint = {}
+    def entities(fi):
+        for path, value in layout.iter_blueprint_events(fi):
+            if path[0] != 'blueprint':
+                raise ValueError(f'Expected a blueprint, but root JSON key is: {path[0]}')
+            if len(path) == 1:
+                raise ValueError('Expected a blueprint, but it is not an object')
+            if path[1] == 'entities':
+                blueprint['entities'] = True
+                if len(path) == 3:
+                    yield value
+            else:
+                blueprint[path[1]] = value
+
+    with open(filename) as fi:
+        stats = blueprint_stats(blueprint, entities(fi))
+    validate_blueprint_keys(blueprint.keys())
+    return stats
+
+def _page_stats(page):
+    '''Validate one blueprint from a book, and compute its statistics'''
+    indexes, bp_dict = page
     blueprint = bp_dict['blueprint']
-    entities = blueprint['entities']
+    validate_blueprint_keys(blueprint.keys())
+    return indexes, blueprint_stats(blueprint, blueprint['entities'])
+
+def book_stats(bp_dict, processes=None):
+    '''Compute statistics for each blueprint in a book, in parallel
 
+    :return:  List of (indexes, stats) tuples, see layout.iter_book_blueprints
+        and blueprint_stats
+    '''
+    return layout.map_blueprints(_page_stats, layout.iter_book_blueprints(bp_dict), processes)
+
+def echo_blueprint_stats(stats, show_entity_details):
+    '''Show statistics computed by blueprint_stats'''
     # Title
-    title = blueprint['label']
-    click.echo(f'Title: {title}')
+    click.echo(f'Title: {stats["title"]}')
 
     # Version
-    version_string = layout.factorio_version_int_as_string(blueprint['version'])
-    click.echo(f'Factorio version: {version_string}')
+    click.echo(f'Factorio version: {stats["version"]}')
 
     # Dimensions
-    x_pos = [e['position']['x'] for e in entities]
-    x0 = min(x_pos)
-    x9 = max(x_pos)
-    y_pos = [e['position']['y'] for e in entities]
-    y0 = min(y_pos)
-    y9 = max(y_pos)
-    click.echo(f'Dimensions: ({x0}..{x9}, {y0}..{y9}) = {x9-x0} x {y9-y0}')
+    if stats['dimensions'] is None:
+        click.echo('Dimensions: empty')
+    else:
+        x0, x9, y0, y9 = stats['dimensions']
+        click.echo(f'Dimensions: ({x0}..{x9}, {y0}..{y9}) = {x9-x0} x {y9-y0}')
 
     # Description
-    if 'description' not in blueprint:
+    if stats['description'] is None:
         click.echo('Description: missing')
     else:
         click.echo('Description:')
-        for line in blueprint['description'].split('\n'):
+        for line in stats['description'].split('\n'):
             click.echo(f'  {line}')
 
     # Entities
+    c = stats['entities']
     if not show_entity_details:
-        click.echo(f'Entities: {len(entities)}')
+        click.echo(f'Entities: {c.total()}')
     else:
-        import collections
-        c = collections.Counter([
-            e['name'] for e in entities
-        ])
         click.echo('Entities:')
         for kind, count in c.most_common():
-            click.echo(f'  {c[kind]} {kind}')
+            click.echo(f'  {count} {kind}')
         click.echo(f'Total {c.total()}')
 
+def echo_flow_report(report):
+    '''Show a report computed by analyze.flow_report'''
+    click.echo('Inputs:')
+    for edge in report['inputs']:
+        click.echo(f'  {edge["rate"]:.3f}/s {edge["kind"]}')
+    click.echo('Outputs:')
+    for edge in report['outputs']:
+        click.echo(f'  {edge["rate"]:.3f}/s {edge["kind"]}')
+    click.echo('Bottlenecks:')
+    for b in report['bottlenecks']:
+        if b['kind'] == 'node':
+            click.echo(f'  {b["lost"]:.3f}/s lost at {b["name"]} {b["id"]}'
+                       f' running at {b["throttle"]:.0%}, limited {b["cause"]}')
+        else:
+            click.echo(f'  {b["lost"]:.3f}/s lost at edge {b["source"]} -> {b["target"]}')
+
+def page_name(indexes):
+    '''Name of a blueprint in a book, like "Page 3.1" for the second
+    blueprint in a book on page 3'''
+    return 'Page ' + '.'.join(str(i) for i in indexes)
+
+def show_blueprint_stats(bp_dict, show_entity_details):
+    blueprint = bp_dict['blueprint']
+    stats = blueprint_stats(blueprint, blueprint['entities'])
+    echo_blueprint_stats(stats, show_entity_details)
+
+# Record fields written by the batch command, for each analysis
+BATCH_FIELDS = {
+    'stats': ['file', 'page', 'title', 'version', 'entities', 'width', 'height', 'error'],
+    'maxflow': ['file', 'page', 'title', 'inputs', 'outputs', 'bottlenecks', 'error'],
+}
+
+def expand_blueprint_paths(paths, pattern='*.txt'):
+    '''Expand files, directories and glob patterns to a list of files
+
+    :param paths:  File names, directory names or glob patterns
+    :param pattern:  Glob pattern for files in directories, that are
+        searched recursively
+    :return:  List of (path, found) tuples. found is False for paths that
+        match nothing, so they can be reported.
+    '''
+    import glob
+    import os
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = glob.glob(os.path.join(glob.escape(path), '**', pattern), recursive=True)
+        elif os.path.exists(path):
+            found = [path]
+        else:
+            found = glob.glob(path, recursive=True)
+        found = sorted(f for f in found if os.path.isfile(f))
+        if len(found) == 0:
+            result.append((path, False))
+        result.extend((f, True) for f in found)
+    return result
+
+def _batch_records(args):
+    '''Analyze one blueprint file for the batch command
+
+    :return:  (file size in bytes, list of record dicts), with one record for
+        each blueprint in the file. Failures give a record with an error.
+    '''
+    import os
+    filename, found, analysis = args
+    if not found:
+        return 0, [dict(file=filename, page='', error='No such file')]
+    size = os.path.getsize(filename)
+    try:
+        bp_dict = load_blueprint(filename)
+        records = []
+        if analysis == 'stats':
+            for indexes, stats in book_stats(bp_dict, processes=1):
+                x0, x9, y0, y9 = stats['dimensions'] or (0, 0, 0, 0)
+                records.append(dict(title=stats['title'], version=stats['version'],
+                    entities=stats['entities'].total(), width=x9 - x0, height=y9 - y0,
+                    page='.'.join(str(i) for i in indexes)))
+        else:
+            import analyze
+            for result in analyze.analyze_blueprint_book(bp_dict, processes=1):
+                record = dict(title=result['label'], page='.'.join(str(i) for i in result['index']))
+                if 'error' in result:
+                    record['error'] = result['error']
+                else:
+                    report = result['report']
+                    record['inputs'] = {e['kind']: e['rate'] for e in report['inputs']}
+                    record['outputs'] = {e['kind']: e['rate'] for e in report['outputs']}
+                    record['bottlenecks'] = len(report['bottlenecks'])
+                records.append(record)
+    except Exception as ex:
+        # Keep going with the other files
+        error = str(ex) if isinstance(ex, ValueError) else f'{type(ex).__name__}: {ex}'
+        records = [dict(page='', error=error)]
+    for record in records:
+        record['file'] = filename
+    return size, records
+
+def write_batch_records(records, fo, fields, output_format):
+    '''Write batch records as they arrive, as JSON Lines or CSV
+
+    :param records:  Iterable of record dicts
+    :param fo:  Text file to write to
+    :param fields:  Field names, in output order. Missing fields are empty.
+    :param output_format:  "jsonl" or "csv"
+    '''
+    import json
+    if output_format == 'csv':
+        import csv
+        writer = csv.DictWriter(fo, fields)
+        writer.writeheader()
+    for record in records:
+        row = {key: record.get(key) for key in fields}
+        if output_format == 'csv':
+            writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                             for key, value in row.items()})
+        else:
+            fo.write(json.dumps(row) + '\n')
+        fo.flush()
+
 @click.group
 def gerd():
     '''Command Line Interface access to some features of Gerd'''
@@ -81,22 +263,88 @@ def gerd():
 @gerd.command
 @click.argument('bp_file', type=click.types.Path(exists=True))
 @click.option('-v', '--entity-details/--no-entity-details', default=False, help='Show entity count per type')
-def stats(bp_file, entity_details):
-    '''Show some blueprint statistics'''
+@click.option('-j', '--processes', type=click.IntRange(min=1), default=None, help='Worker processes for blueprint books [default: all cores]')
+def stats(bp_file, entity_details, processes):
+    '''Show some blueprint or blueprint book statistics'''
     click.echo(f'Loading blueprint from "{bp_file}"')
+    if blueprint_root_key(bp_file) != 'blueprint_book':
+        stats = stream_blueprint_stats(bp_file)
+        echo_blueprint_stats(stats, entity_details)
+        return
+
     bp_dict = load_blueprint(bp_file)
-    show_blueprint_stats(bp_dict, entity_details)
+    click.echo(f'Book: {bp_dict["blueprint_book"].get("label")}')
+    for indexes, stats in book_stats(bp_dict, processes):
+        click.echo(f'{page_name(indexes)}:')
+        echo_blueprint_stats(stats, entity_details)
 
 @gerd.command
 @click.argument('bp_file', type=click.types.Path(exists=True))
-def maxflow(bp_file):
-    '''Compute the max flow reachable given a blueprint'''
+@click.option('-j', '--processes', type=click.IntRange(min=1), default=None, help='Worker processes for blueprint books [default: all cores]')
+def maxflow(bp_file, processes):
+    '''Compute the max flow reachable given a blueprint or each blueprint in a book'''
 
+    import analyze
     click.echo(f'Loading blueprint from "{bp_file}"')
+
+    if blueprint_root_key(bp_file) != 'blueprint_book':
+        # Convert blueprint to flow graph
+        with open(bp_file) as fi:
+            G = analyze.extract_flow_from_exchange_string(fi)
+        echo_flow_report(analyze.flow_report(G))
+        return
+
     bp_dict = load_blueprint(bp_file)
+    for result in analyze.analyze_blueprint_book(bp_dict, processes):
+        click.echo(f'{page_name(result["index"])}: {result["label"]}')
+        if 'error' in result:
+            click.echo(f'  Error: {result["error"]}')
+        else:
+            echo_flow_report(result['report'])
+
+@gerd.command
+@click.argument('book_file', type=click.types.Path(exists=False))
+@click.argument('bp_files', nargs=-1, required=True, type=click.types.Path(exists=True))
+@click.option('-l', '--label', default='Unnamed Blueprint Book', help='Book label')
+@click.option('-j', '--processes', type=click.IntRange(min=1), default=None, help='Worker processes [default: all cores]')
+def book(book_file, bp_files, label, processes):
+    '''Collect blueprints and blueprint books into a new book'''
+    blueprints = [load_blueprint(filename) for filename in bp_files]
+    bp_dict = layout.blueprint_book_dict(blueprints, label=label)
+    with open(book_file, 'w') as fo:
+        fo.write(layout.export_blueprint_book(bp_dict, processes=processes))
+    click.echo(f'Wrote {len(blueprints)} blueprints to "{book_file}"')
+
+@gerd.command
+@click.argument('paths', nargs=-1, required=True)
+@click.option('-a', '--analysis', type=click.Choice(list(BATCH_FIELDS)), default='stats', help='Analysis for each blueprint')
+@click.option('-f', '--format', 'output_format', type=click.Choice(['jsonl', 'csv']), default='jsonl', help='Output format')
+@click.option('-o', '--output', type=click.File('w'), default='-', help='Output file [default: standard output]')
+@click.option('-p', '--pattern', default='*.txt', help='File name pattern in directories')
+@click.option('-j', '--processes', type=click.IntRange(min=1), default=None, help='Worker processes [default: all cores]')
+def batch(paths, analysis, output_format, output, pattern, processes):
+    '''Analyze many blueprint files, given as files, directories or glob patterns.
+    Each blueprint gives one record, also when it fails.'''
+    import time
+    files = expand_blueprint_paths(paths, pattern)
+    start = time.perf_counter()
+    totals = dict(files=0, bytes=0, errors=0)
+
+    def records():
+        args = [(filename, found, analysis) for filename, found in files]
+        for size, file_records in layout.imap_blueprints(_batch_records, args, processes):
+            totals['files'] += 1
+            totals['bytes'] += size
+            totals['errors'] += any(r.get('error') for r in file_records)
+            yield from file_records
+
+    write_batch_records(records(), output, BATCH_FIELDS[analysis], output_format)
 
-    # Convert blueprint to flow graph
-    G = analyze.extract_flow_from_blueprint(bp_dict)
+    seconds = max(time.perf_counter() - start, 1e-9)
+    megabytes = totals['bytes'] / 1e6
+    click.echo(f'Processed {totals["files"]} files, {megabytes:.1f} MB, with {totals["errors"]} failing'
+               f' in {seconds:.2f} s: {totals["files"] / seconds:.1f} files/s, {megabytes / seconds:.2f} MB/s',
+               err=True)
 
 if __name__ == '__main__':
     gerd()
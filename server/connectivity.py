@@ -0,0 +1,161 @@
+'''
+Connected components of the free tiles of a construction site.
+
+Two free tiles in line are connected when a belt or an underground belt
+can go from one to the other, that is when they are at most
+UNDERGROUND_REACH - 1 tiles apart with only reserved tiles between them.
+Tiles with the same label are connected through other free tiles. The
+rules for underground belts are relaxed, like in
+a_star_factorio.obstacle_field, so tiles with different labels can never
+be joined by a belt, while tiles with the same label usually can.
+
+Labels are found for the whole site when first asked for. As tiles are
+reserved, a search close to the tile checks that its free neighbours are
+still connected to each other. Only when they may not be are the labels
+found again, and then only when next asked for. So a Components can be
+reused for all connections of a site.
+'''
+
+from collections import deque
+import logging
+from typing import List
+
+from a_star_factorio import UNDERGROUND_REACH
+import layout
+import profiling
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+DIRECTIONS = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+
+#
+#  Components
+#
+
+class Components:
+    '''Labels of the connected components of the free tiles of a site'''
+
+    def __init__(self, site: layout.ConstructionSite, reach=UNDERGROUND_REACH):
+        self.site = site
+        # Longest underground belt, from the tile before the entry to the exit
+        self.reach = reach
+        self.width, self.height = site.size()
+        # Label of each tile, indexed y * width + x, or None when reserved
+        self.labels = []
+        # The labels must be found again before they are used
+        self.dirty = True
+        site.listeners.append(self.reserved)
+        site.release_listeners.append(self.released)
+
+    def close(self):
+        '''Stop following changes to the site'''
+        if self.reserved in self.site.listeners:
+            self.site.listeners.remove(self.reserved)
+        if self.released in self.site.release_listeners:
+            self.site.release_listeners.remove(self.released)
+
+    def hop_neighbors(self, x, y) -> List["tuple"]:
+        '''Return the nearest free tile in each direction, within reach of
+        an underground belt'''
+        neighbors = []
+        for dx, dy in DIRECTIONS:
+            for distance in range(1, self.reach):
+                nx, ny = x + dx*distance, y + dy*distance
+                if not (0 <= nx < self.width and 0 <= ny < self.height):
+                    break
+                if not self.site.is_reserved(nx, ny):
+                    neighbors.append((nx, ny))
+                    break
+        return neighbors
+
+    def update(self):
+        '''Label all free tiles, joining each free tile with the next free
+        tile in its row and column when they are close enough'''
+        profiling.count('connectivity.relabels')
+        width, height = self.width, self.height
+        parent = list(range(width * height))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        def union(i, j):
+            i, j = find(i), find(j)
+            if i != j:
+                parent[j] = i
+
+        free = [[not self.site.is_reserved(x, y) for x in range(width)] for y in range(height)]
+        for y in range(height):
+            last = None
+            for x in range(width):
+                if free[y][x]:
+                    if last is not None and x - last < self.reach:
+                        union(y * width + last, y * width + x)
+                    last = x
+        for x in range(width):
+            last = None
+            for y in range(height):
+                if free[y][x]:
+                    if last is not None and y - last < self.reach:
+                        union(last * width + x, y * width + x)
+                    last = y
+        self.labels = [find(y * width + x) if free[y][x] else None
+                       for y in range(height) for x in range(width)]
+        self.dirty = False
+
+    def reserved(self, position):
+        '''Site listener, called when a tile is reserved'''
+        if self.dirty:
+            return
+        x, y = position
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return
+        self.labels[y * self.width + x] = None
+        if not self.still_connected(self.hop_neighbors(x, y), position):
+            log.debug(f'Reserving {position} may split a component')
+            self.dirty = True
+
+    def released(self, position):
+        '''Site listener, called when a tile is released by a rollback.
+        It may join components.'''
+        self.dirty = True
+
+    def still_connected(self, neighbors: List["tuple"], center) -> bool:
+        '''Check that the neighbors of a reserved tile are connected to each
+        other by the free tiles close to it'''
+        if len(neighbors) <= 1:
+            return True
+        x0, y0 = center
+        # Tiles around the reserved tile searched for a way between them
+        radius = 2 * self.reach
+        wanted = set(neighbors[1:])
+        seen = {neighbors[0]}
+        queue = deque([neighbors[0]])
+        while queue and wanted:
+            for tile in self.hop_neighbors(*queue.popleft()):
+                if tile in seen:
+                    continue
+                if abs(tile[0] - x0) > radius or abs(tile[1] - y0) > radius:
+                    continue
+                seen.add(tile)
+                wanted.discard(tile)
+                queue.append(tile)
+        return not wanted
+
+    def label(self, position):
+        '''Return the label of a tile, or None when it is reserved'''
+        if self.dirty:
+            self.update()
+        x, y = position
+        return self.labels[y * self.width + x]
+
+    def connected(self, start_positions: List["tuple"], end_positions: List["tuple"]) -> bool:
+        '''Check if any start position shares a component with any end
+        position. When not, no belt can join them.'''
+        profiling.count('connectivity.queries')
+        start_labels = {self.label(p) for p in start_positions} - {None}
+        return any(self.label(p) in start_labels for p in end_positions)
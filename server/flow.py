@@ -3,19 +3,19 @@ that could be an assembling machine or a transport belt. Edges represents transi
 from one unit to another.
 
 The module has no depencencies, except networkx. It is designed to be a
-utility module for other modules.
+utility module for other modules. networkx is slow to import, so it is
+imported when the first graph is made.
 
 Primary interface:
 
 - :class:`Node` - a node in a flow graph
 - :class:`Graph` - a flow graph
 - :func:`compute_max_flow` - recompute flow in the graph
+- :func:`find_bottlenecks` - find nodes and edges that limit the flow
 '''
 
 import logging
 
-import networkx
-
 #
 #  Logging
 #
@@ -54,6 +54,7 @@ class Node:
 
         # Flow information
         self.throttle = 1 # 0..1 where 1 means full capacity flow
+        self.output_throttle = 1 # throttle allowed by downstream nodes, set by compute_max_flow
 
     def __repr__(self) -> str:
         name = '' if self.name is None else f'"{self.name}" '
@@ -96,6 +97,7 @@ class Graph:
     This is the maximum flow possible between nodes.
     '''
     def __init__(self) -> None:
+        import networkx
         self.graph = networkx.DiGraph()
         self.nodes = dict()
 
@@ -129,12 +131,13 @@ class Graph:
         self.graph.add_edge(u, v)
         # Automatically determine items that can flow
         outputs = set() if self.nodes[u].outputs is None else set(self.nodes[u].outputs.keys())
-        inputs = set() if self.nodes[u].inputs is None else set(self.nodes[v].inputs.keys())
+        inputs = set() if self.nodes[v].inputs is None else set(self.nodes[v].inputs.keys())
         for item in outputs.intersection(inputs):
             self.graph.edges[u, v][item] = 1 # will be scaled by compute_max_flow
 
     def __str__(self) -> str:
         '''String representation of flow graph'''
+        import networkx
         result = []
         try:
             node_list = list(networkx.topological_sort(self.graph))
@@ -161,7 +164,8 @@ class Graph:
 def _join_inputs(G: Graph, n):
     '''Compute inbound flow. Reduce throttle to match'''
     node = G.nodes[n]
-    log.debug(f'{n}: join inputs of {node.name} from {list(G.graph.predecessors(n))}')
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'{n}: join inputs of {node.name} from {list(G.graph.predecessors(n))}')
     # Sum flow from all input edges
     flow_in = dict()
     v = n
@@ -181,7 +185,7 @@ def _join_inputs(G: Graph, n):
         in_throttle = min(flow_in[item] / node.inputs[item] for item in flow_in)
         assert in_throttle <= node.throttle, f'{n}: FAIL {in_throttle} <= {node.throttle}'
         node.throttle = min(node.throttle, in_throttle)
-        log.debug(f'{n}: flow_in = {list(flow_in.items())}, throttle := {node.throttle}')
+        log.debug('%s: flow_in = %s, throttle := %s', n, flow_in, node.throttle)
 
 def _split_outputs(G, n):
     '''Compute outbound flow from inner flow'''
@@ -211,7 +215,7 @@ def _split_outputs(G, n):
 
 def _combine_outputs(G: Graph, n):
     '''Compute initial node throttle from outbound flow limits.'''
-    log.debug(f'{n}: combine outputs to reduce throttle')
+    log.debug('%s: combine outputs to reduce throttle', n)
     graph = G.graph
     node = G.nodes[n]
     # Sum flow in all output edges
@@ -227,19 +231,19 @@ def _combine_outputs(G: Graph, n):
     if len(flow_out) == 0:
         # This node is a sink node. Assume all output is consumed
         node.throttle = 1
-        log.debug(f' : no outputs, throttle={node.throttle}')
+        log.debug(' : no outputs, throttle=%s', node.throttle)
     else:
         assert set(flow_out.keys()) == set(node.outputs.keys())
         # Cap out-flow with internal max-flow
         node.throttle = min(flow_out[item] / node.outputs[item] for item in flow_out)
         if node.throttle > 1:
             node.throttle = 1
-        log.debug(f' : {flow_out} -> throttle={node.throttle}')
+        log.debug(' : %s -> throttle=%s', flow_out, node.throttle)
 
 def _allocate_inputs(G: Graph, n):
     '''Compute node in-flow from inner flow limits'''
     node = G.nodes[n]
-    log.debug(f'{n}: compute in-flow from inner flow, throttle={node.throttle}')
+    log.debug('%s: compute in-flow from inner flow, throttle=%s', n, node.throttle)
 
     flow_in = dict()
     v = n
@@ -274,6 +278,7 @@ def compute_max_flow(G: Graph):
     :param graph:  flow.Graph to be updated with max flow values.
     '''
 
+    import networkx
     # order all nodes after flow
     ordered_nodes = list(networkx.topological_sort(G.graph))
 
@@ -284,6 +289,7 @@ def compute_max_flow(G: Graph):
     for n in reversed(ordered_nodes):
         _combine_outputs(G, n)
         _allocate_inputs(G, n)
+        G.nodes[n].output_throttle = G.nodes[n].throttle
 
     log.debug('---- begin forward flow ----')
     log.debug(G)
@@ -293,6 +299,94 @@ def compute_max_flow(G: Graph):
         _join_inputs(G, n)
         _split_outputs(G, n)
 
+def _passes_through(node: Node):
+    '''Test if node moves items without transforming them, like a belt'''
+    inputs = set(node.inputs or {})
+    return len(inputs) > 0 and inputs == set(node.outputs or {})
+
+def _limiting_edges(G: Graph, n, upstream, tolerance):
+    '''Find the saturated edges that limit the flow through node n.
+
+    Only edges carrying the item types that limit the throttle are followed.
+    Nodes that pass items through are followed until a node running at
+    full capacity is found.
+    '''
+    result = []
+    visited = set([n])
+    stack = [n]
+    while stack:
+        m = stack.pop()
+        node = G.nodes[m]
+        edges = list(G.graph.in_edges(m) if upstream else G.graph.out_edges(m))
+        capacity = (node.inputs if upstream else node.outputs) or {}
+        flow = dict()
+        for e in edges:
+            for item, value in G.graph.edges[e].items():
+                flow[item] = flow.get(item, 0) + value
+        ratios = {item: value / capacity[item] for item, value in flow.items()
+                  if capacity.get(item)}
+        if len(ratios) == 0:
+            continue
+        least = min(ratios.values())
+        limiting = set(item for item, ratio in ratios.items() if ratio <= least + tolerance)
+        for u, v in edges:
+            if not limiting.intersection(G.graph.edges[u, v].keys()):
+                continue
+            other = u if upstream else v
+            if other in visited:
+                continue
+            visited.add(other)
+            other_node = G.nodes[other]
+            if other_node.throttle >= 1 - tolerance:
+                result.append((u, v))
+            elif _passes_through(other_node):
+                stack.append(other)
+    return result
+
+def find_bottlenecks(G: Graph, tolerance=1e-9, ignore=()):
+    '''Find nodes and edges that limit the flow. Run
+    :func:`compute_max_flow` first.
+
+    A node that transforms items is throttled when it runs below full
+    capacity. The cause is "downstream" when the nodes after it cannot take
+    more, and "upstream" when the nodes before it cannot deliver more.
+    A saturated edge leads from a throttled node towards a node running at
+    full capacity, that is the node holding the flow back. Nodes passing
+    items through, like belts, are only reported via saturated edges.
+
+    :param G:  flow.Graph with computed flow
+    :param tolerance:  Throttle values this close to 1 count as full capacity
+    :param ignore:  Ids of nodes that should not be reported, eg. nodes
+        representing the world outside the graph
+    :return:  List of dicts, ranked by lost throughput in items per second.
+        Nodes are reported as dict(kind='node', id, name, throttle, cause, lost)
+        and edges as dict(kind='edge', source, target, items, cause, lost).
+    '''
+    ignore = set(ignore)
+    result = []
+    edge_report = {}
+    for n, node in G.nodes.items():
+        if node.throttle >= 1 - tolerance or n in ignore or _passes_through(node):
+            continue
+        lost = sum((node.outputs or node.inputs or {}).values()) * (1 - node.throttle)
+        upstream = node.throttle < node.output_throttle - tolerance
+        cause = 'upstream' if upstream else 'downstream'
+        result.append(dict(kind='node', id=n, name=node.name,
+                           throttle=node.throttle, cause=cause, lost=lost))
+
+        edges = [e for e in _limiting_edges(G, n, upstream, tolerance)
+                 if e[0] not in ignore and e[1] not in ignore]
+        for u, v in edges:
+            if (u, v) not in edge_report:
+                edge_report[u, v] = dict(kind='edge', source=u, target=v,
+                                         items=dict(G.graph.edges[u, v]),
+                                         cause=cause, lost=0)
+            edge_report[u, v]['lost'] += lost / len(edges)
+
+    result.extend(edge_report.values())
+    result.sort(key=lambda b: b['lost'], reverse=True)
+    return result
+
 if __name__ == "__main__":
     """Test code executed if run from command line"""
     import test.flow
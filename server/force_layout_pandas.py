@@ -13,6 +13,8 @@ import pandas as pd
 # First party imports
 from solver import FactoryNode
 from vector import Vector
+import budget
+import profiling
 
 
 
@@ -192,6 +194,13 @@ def spring(
 
         if max_dist < iteration_threshold:
             break
+        if budget.expired():
+            # The positions so far are a usable layout
+            log.info('Spring layout stopped after %d iterations, out of time', iteration_no + 1)
+            profiling.count('spring.out_of_time')
+            break
 
+    profiling.count('spring.iterations', iteration_no + 1)
+    profiling.value('spring.movement', max_dist)
     return machines
     
\ No newline at end of file
@@ -0,0 +1,361 @@
+'''
+Hierarchical path finding over chunks of a construction site.
+
+The site is split into square chunks, 32x32 like Factorio's. Where a
+chunk borders its neighbour, runs of free tiles on both sides get
+entrances, and entrances are the nodes of an abstract graph. A route is
+planned on the abstract graph, from entrance to entrance, and then refined
+with A* within one chunk at a time. Long routes on large sites only search
+the chunks they pass through.
+
+Entrances are found for the whole site up front, which is cheap. The cost
+between the entrances of a chunk is found when a search first needs it.
+Both are updated as tiles are reserved, only for the chunks that changed,
+so a ChunkGraph can be reused for all connections of a site.
+
+Costs on the abstract graph relax the rules for underground belts, like
+a_star_factorio.obstacle_field, so a planned route may not refine to a
+path. Callers fall back to a search of the whole site when no path is
+found.
+'''
+
+import heapq
+import logging
+from typing import Dict, List
+
+import a_star_factorio
+from a_star_factorio import A_star, UNDERGROUND_COST, UNDERGROUND_REACH
+import layout
+import profiling
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+# Side of a chunk, in tiles
+CHUNK_SIZE = 32
+
+# Most tiles along a border that share an entrance
+ENTRANCE_SPACING = 8
+
+#
+#  Abstract graph
+#
+
+class ChunkGraph:
+    '''Entrances between the chunks of a site, and the costs between them'''
+
+    def __init__(self, site: layout.ConstructionSite, chunk_size=CHUNK_SIZE):
+        self.site = site
+        self.chunk_size = chunk_size
+        width, height = site.size()
+        self.chunks_x = -(-width // chunk_size)
+        self.chunks_y = -(-height // chunk_size)
+        # Border to its entrances, as (inside, outside) tile pairs. A border
+        # is a chunk and (1, 0) or (0, 1), to the chunk after it.
+        self.borders = {}
+        # Entrance tile to the tiles across the border. Corner tiles can
+        # have entrances on two borders.
+        self.crossings = {}
+        # Chunk to its entrance tiles
+        self.entrances = {}
+        # Entrance tile to the cost of reaching each other entrance of its chunk
+        self.costs = {}
+        # Chunks with tiles reserved since the last update
+        self.dirty = set()
+        for cy in range(self.chunks_y):
+            for cx in range(self.chunks_x):
+                for step in [(1, 0), (0, 1)]:
+                    self.find_entrances((cx, cy), step)
+        for chunk in self.chunk_list():
+            self.collect_entrances(chunk)
+        site.listeners.append(self.reserved)
+        site.release_listeners.append(self.released)
+
+    def close(self):
+        '''Stop following changes to the site'''
+        if self.reserved in self.site.listeners:
+            self.site.listeners.remove(self.reserved)
+        if self.released in self.site.release_listeners:
+            self.site.release_listeners.remove(self.released)
+
+    def chunk_list(self):
+        return [(cx, cy) for cy in range(self.chunks_y) for cx in range(self.chunks_x)]
+
+    def chunk_of(self, position) -> "tuple":
+        return (position[0] // self.chunk_size, position[1] // self.chunk_size)
+
+    def chunk_area(self, chunk) -> "tuple":
+        '''Return (x0, y0, x1, y1) of a chunk, with x1 and y1 excluded'''
+        width, height = self.site.size()
+        x0, y0 = chunk[0] * self.chunk_size, chunk[1] * self.chunk_size
+        return (x0, y0, min(x0 + self.chunk_size, width), min(y0 + self.chunk_size, height))
+
+    def is_free(self, x, y):
+        width, height = self.site.size()
+        return 0 <= x < width and 0 <= y < height and not self.site.is_reserved(x, y)
+
+    def reserved(self, position):
+        '''Site listener, called when a tile is reserved'''
+        self.dirty.add(self.chunk_of(position))
+
+    def released(self, position):
+        '''Site listener, called when a tile is released by a rollback'''
+        self.dirty.add(self.chunk_of(position))
+
+    def find_entrances(self, chunk, step):
+        '''Find the entrances on the border from a chunk to the next chunk
+        in the direction of step. Runs of tiles free on both sides get an
+        entrance for every ENTRANCE_SPACING tiles, in the middle of them.'''
+        for inside, outside in self.borders.pop((chunk, step), []):
+            self.crossings[inside].discard(outside)
+            self.crossings[outside].discard(inside)
+        x0, y0, x1, y1 = self.chunk_area(chunk)
+        if step == (1, 0):
+            if x1 >= self.site.size()[0]:
+                return
+            pairs = [((x1 - 1, y), (x1, y)) for y in range(y0, y1)]
+        else:
+            if y1 >= self.site.size()[1]:
+                return
+            pairs = [((x, y1 - 1), (x, y1)) for x in range(x0, x1)]
+
+        entrances = []
+        run = []
+        for pair in pairs + [None]:
+            if pair is not None and self.is_free(*pair[0]) and self.is_free(*pair[1]):
+                run.append(pair)
+                continue
+            for i in range(0, len(run), ENTRANCE_SPACING):
+                part = run[i:i + ENTRANCE_SPACING]
+                entrances.append(part[len(part) // 2])
+            run = []
+        self.borders[(chunk, step)] = entrances
+        for inside, outside in entrances:
+            self.crossings.setdefault(inside, set()).add(outside)
+            self.crossings.setdefault(outside, set()).add(inside)
+
+    def collect_entrances(self, chunk):
+        '''Gather the entrance tiles of a chunk from its four borders'''
+        cx, cy = chunk
+        tiles = []
+        for inside, _ in self.borders.get((chunk, (1, 0)), []) + self.borders.get((chunk, (0, 1)), []):
+            tiles.append(inside)
+        for _, outside in self.borders.get(((cx - 1, cy), (1, 0)), []) + self.borders.get(((cx, cy - 1), (0, 1)), []):
+            tiles.append(outside)
+        for tile in self.entrances.get(chunk, []):
+            self.costs.pop(tile, None)
+        self.entrances[chunk] = tiles
+
+    def update(self):
+        '''Find the entrances and forget the costs of chunks that changed'''
+        if not self.dirty:
+            return
+        profiling.count('hierarchy.chunks_updated', len(self.dirty))
+        changed = set()
+        for cx, cy in self.dirty:
+            for chunk, step in [((cx, cy), (1, 0)), ((cx, cy), (0, 1)),
+                                ((cx - 1, cy), (1, 0)), ((cx, cy - 1), (0, 1))]:
+                if 0 <= chunk[0] < self.chunks_x and 0 <= chunk[1] < self.chunks_y:
+                    self.find_entrances(chunk, step)
+                    changed.add(chunk)
+                    changed.add((chunk[0] + step[0], chunk[1] + step[1]))
+        for chunk in changed:
+            if chunk in self.entrances:
+                self.collect_entrances(chunk)
+        self.dirty = set()
+
+    def distances(self, position) -> Dict["tuple", int]:
+        '''Return the cost from a tile to each tile of its chunk, staying
+        inside the chunk. Underground belts cost as in
+        a_star_factorio.obstacle_field, but need a free tile to start on.'''
+        x0, y0, x1, y1 = self.chunk_area(self.chunk_of(position))
+        costs = {position: 0}
+        queue = [(0, position)]
+        while queue:
+            cost, (x, y) = heapq.heappop(queue)
+            if cost > costs[(x, y)]:
+                continue
+            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+                # Underground belts start on the next tile, and only pay off
+                # to pass reserved tiles
+                passed_reserved = False
+                for step in range(1, UNDERGROUND_REACH + 1):
+                    nx, ny = x + dx*step, y + dy*step
+                    if not (x0 <= nx < x1 and y0 <= ny < y1):
+                        break
+                    if self.site.is_reserved(nx, ny):
+                        if step == 1:
+                            break
+                        passed_reserved = True
+                        continue
+                    if step > 1 and not passed_reserved:
+                        continue
+                    next_cost = cost + (1 if step == 1 else UNDERGROUND_COST)
+                    if next_cost < costs.get((nx, ny), a_star_factorio.UNREACHABLE):
+                        costs[(nx, ny)] = next_cost
+                        heapq.heappush(queue, (next_cost, (nx, ny)))
+        return costs
+
+    def entrance_costs(self, tile) -> Dict["tuple", int]:
+        '''Return the cost from an entrance to each other entrance it can
+        reach in its chunk'''
+        if tile not in self.costs:
+            profiling.count('hierarchy.chunk_searches')
+            distances = self.distances(tile)
+            self.costs[tile] = {other: distances[other]
+                                for other in self.entrances[self.chunk_of(tile)]
+                                if other != tile and other in distances}
+        return self.costs[tile]
+
+    def plan(self, start_positions, end_positions) -> List["tuple"]:
+        '''Find the cheapest route on the abstract graph
+
+        :return:  Tiles of the route. The first is a start position, the last
+            an end position, and the tiles between are entrances. None if
+            there is no route.
+        '''
+        self.update()
+        end_set = set(end_positions)
+        # End positions, by the entrances of their chunk that reach them
+        to_end = {}
+        for end in end_set:
+            distances = self.distances(end)
+            for tile in self.entrances[self.chunk_of(end)]:
+                if tile in distances:
+                    to_end.setdefault(tile, {})[end] = distances[tile]
+
+        def estimate(tile):
+            return min(abs(tile[0] - x) + abs(tile[1] - y) for x, y in end_set)
+
+        def push(cost, tile):
+            # Many tiles tie, so prefer those closest to the end
+            h = estimate(tile)
+            heapq.heappush(queue, (cost + h, h, tile))
+
+        costs = {}
+        parents = {}
+        queue = []
+        for start in set(start_positions):
+            costs[start] = 0
+            parents[start] = None
+            push(0, start)
+        expanded = 0
+        while queue:
+            _, _, tile = heapq.heappop(queue)
+            if tile in end_set:
+                break
+            expanded += 1
+            cost = costs[tile]
+            if parents[tile] is None:
+                # A start position reaches the entrances and end positions of its chunk
+                distances = self.distances(tile)
+                steps = {other: distances[other]
+                         for other in self.entrances[self.chunk_of(tile)] + list(end_set)
+                         if other in distances and other != tile}
+            else:
+                steps = dict(self.entrance_costs(tile))
+                steps.update(to_end.get(tile, {}))
+            if parents[tile] is None or self.chunk_of(parents[tile]) == self.chunk_of(tile):
+                # Across the border, but not back again
+                for other in self.crossings.get(tile, []):
+                    steps[other] = 1
+            for other, step_cost in steps.items():
+                if cost + step_cost < costs.get(other, a_star_factorio.UNREACHABLE):
+                    costs[other] = cost + step_cost
+                    parents[other] = tile
+                    push(cost + step_cost, other)
+        else:
+            tile = None
+        profiling.count('hierarchy.expanded', expanded)
+        if tile is None:
+            return None
+        route = []
+        while tile is not None:
+            route.append(tile)
+            tile = parents[tile]
+        return route[::-1]
+
+#
+#  Refinement
+#
+
+def window_site(site: layout.ConstructionSite, x0, y0, x1, y1) -> layout.ConstructionSite:
+    '''Return a site with the reserved tiles of an area of another site, moved
+    so that the area starts at (0, 0)'''
+    window = layout.ConstructionSite(x1 - x0, y1 - y0)
+    for x, y in site.reserved_cells(x0, y0, x1, y1):
+        window.reserve(x - x0, y - y0)
+    return window
+
+def turning_undergrounds(position, across) -> List["tuple"]:
+    '''Return the exits of underground belts that start at a position on a
+    border, and are not in line with the belt from across the border'''
+    x, y = position
+    tiles = []
+    for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
+        if (dx, dy) == (x - across[0], y - across[1]):
+            continue
+        for distance in range(2, UNDERGROUND_REACH):
+            tiles.append((x + dx*distance, y + dy*distance))
+    return tiles
+
+def find_path(
+    graph: ChunkGraph,
+    start_positions: List["tuple"],
+    end_positions: List["tuple"],
+    start_node_illegal_neighbors: Dict["tuple", List["tuple"]],
+    end_node_illegal_neighbors: Dict["tuple", List["tuple"]],
+    heuristic='euclidean',
+    directional=False,
+    straight_runs=False,
+) -> List["tuple"]:
+    """
+    Plan a route on the abstract graph, and refine each part of it with A*
+    in the chunk it passes through. Parts in a chunk end at the entrance
+    tiles, and steps across a border are single belts.
+
+    :return:  List of positions from a start to an end position, like
+        A_star.find_path, or None if the route could not be refined
+    """
+    route = graph.plan(start_positions, end_positions)
+    if route is None:
+        log.debug("No route on the chunk graph")
+        return None
+    if len(route) == 1:
+        # A start position is an end position, which A* in its chunk finds
+        route = route * 2
+    path = []
+    for i, (first, last) in enumerate(zip(route, route[1:])):
+        if graph.chunk_of(first) != graph.chunk_of(last):
+            # Across a border
+            continue
+        start_illegal = list(start_node_illegal_neighbors.get(first, [])) if i == 0 else []
+        end_illegal = list(end_node_illegal_neighbors.get(last, [])) if i == len(route) - 2 else []
+        if i > 0 and graph.chunk_of(route[i - 1]) != graph.chunk_of(first):
+            # The search starts here, but the belt comes from across the border
+            start_illegal += turning_undergrounds(first, route[i - 1])
+
+        x0, y0, x1, y1 = graph.chunk_area(graph.chunk_of(first))
+        moved = lambda positions: [(x - x0, y - y0) for x, y in positions]
+        finder = A_star(window_site(graph.site, x0, y0, x1, y1), moved([first]), moved([last]),
+                        {moved([first])[0]: moved(start_illegal)}, {moved([last])[0]: moved(end_illegal)})
+        part = finder.find_path(True, None, heuristic, directional, straight_runs)
+        profiling.count('hierarchy.refined')
+        if part is None:
+            log.debug(f'No path from {first} to {last} in its chunk')
+            return None
+        part = [(x + x0, y + y0) for x, y in part]
+        if path and path[-1] == part[0]:
+            # Two parts in the same chunk
+            part = part[1:]
+        path.extend(part)
+
+    illegal = (start_node_illegal_neighbors.get(path[0], [])
+               + end_node_illegal_neighbors.get(path[-1], []))
+    if not a_star_factorio.is_belt_path(path, illegal):
+        log.debug("Refined parts do not join")
+        return None
+    return path
@@ -0,0 +1,164 @@
+''' Incremental JSON parsing. The JSON text arrives in chunks, and the
+document is delivered as (path, value) pairs. Objects and arrays are only
+held in memory when they are delivered as a value, so a huge array can be
+processed one element at a time.
+
+The module has no depencencies outside the standard library. It is designed
+to be a utility module for other modules.
+
+Primary interface:
+
+- :func:`iter_events` - yield (path, value) pairs from chunks of JSON text
+'''
+
+import json
+
+#
+#  Constants
+#
+
+# Matches any object key or array index in a path pattern
+ANY = '*'
+
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARS = '0123456789.eE+-'
+
+_decoder = json.JSONDecoder()
+
+#
+#  Classes
+#
+
+class _Reader:
+    '''Buffer of JSON text that is filled one chunk at a time'''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        '''Append the next chunk to the buffer, dropping text already parsed.
+
+        :return:  False if there are no more chunks
+        '''
+        if self.eof:
+            return False
+        for chunk in self.chunks:
+            if len(chunk) > 0:
+                break
+        else:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        '''Return the next character that is not whitespace, without
+        consuming it. Return an empty string at end of input.'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars) -> str:
+        '''Consume the next character, which must be one of chars'''
+        ch = self.peek()
+        if ch == '' or ch not in chars:
+            found = 'end of input' if ch == '' else repr(ch)
+            raise ValueError(f'Expected one of {chars!r} in JSON, found {found}')
+        self.pos += 1
+        return ch
+
+    def value(self):
+        '''Decode the next complete JSON value'''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                number_may_continue = (
+                    isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and (end == len(self.buffer) or self.buffer[end] in NUMBER_CHARS))
+                if self.eof or (end < len(self.buffer) and not number_may_continue):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as ex:
+                if self.eof:
+                    raise ValueError(f'Invalid JSON: {ex}') from None
+            # Double the unparsed text before trying again, so a large
+            # value is not parsed over and over
+            wanted = 2 * (len(self.buffer) - self.pos) + 1
+            while len(self.buffer) - self.pos < wanted and self.fill():
+                pass
+
+#
+#  Functions
+#
+
+def _is_prefix(path, pattern) -> bool:
+    '''Test if path leads to, but is not the same as, pattern'''
+    if len(path) >= len(pattern):
+        return False
+    return all(p == ANY or p == key for key, p in zip(path, pattern))
+
+def _walk(reader: _Reader, path, patterns):
+    '''Yield (path, value) pairs for the JSON value at the reader position'''
+    ch = reader.peek()
+    walk_into = ch in ('{', '[') and any(_is_prefix(path, p) for p in patterns)
+    if not walk_into:
+        yield path, reader.value()
+        return
+
+    reader.expect(ch)
+    end = '}' if ch == '{' else ']'
+    if reader.peek() == end:
+        # Empty containers are delivered as values, so they are not lost
+        reader.expect(end)
+        yield path, {} if ch == '{' else []
+        return
+    index = 0
+    while True:
+        if ch == '{':
+            key = reader.value()
+            if not isinstance(key, str):
+                raise ValueError(f'Expected a string as JSON object key, found {key!r}')
+            reader.expect(':')
+        else:
+            key = index
+            index += 1
+        yield from _walk(reader, path + (key,), patterns)
+        if reader.expect(',' + end) == end:
+            return
+
+def iter_events(chunks, stream_paths=()):
+    '''Parse JSON text, and yield (path, value) pairs for its content.
+
+    A path is a tuple of object keys and array indexes, from the top of
+    the document to the value. Objects and arrays leading to one of the
+    stream paths are walked member by member. All other values are decoded
+    completely, and yielded with their path.
+
+    Example: With stream_paths [('blueprint', 'entities', ANY)], the text
+    {"blueprint": {"label": "x", "entities": [{"a": 1}, {"b": 2}]}} gives
+    (('blueprint', 'label'), 'x'),
+    (('blueprint', 'entities', 0), {'a': 1}),
+    (('blueprint', 'entities', 1), {'b': 2})
+
+    :param chunks:  Iterable of str, that together form a JSON document
+    :param stream_paths:  Paths to the values that should be yielded one at a
+        time. ANY matches any object key or array index.
+    :return:  Iterator of (path, value) tuples
+    '''
+    patterns = [tuple(p) for p in stream_paths]
+    reader = _Reader(chunks)
+    if reader.peek() == '':
+        raise ValueError('Invalid JSON: no content')
+    yield from _walk(reader, (), patterns)
+    if reader.peek() != '':
+        raise ValueError('Invalid JSON: extra data after document')
@@ -2,6 +2,10 @@
 Functions related to placing machines on a grid.
 '''
 
+import contextlib
+import functools
+from typing import List
+
 from constants import Direction
 
 MACHINES_WITH_RECIPE = {
@@ -9,41 +13,218 @@ MACHINES_WITH_RECIPE = {
     'assembling-machine-2',
 }
 
+# Side of the chunks of occupancy of a site, in cells, as a power of two
+CHUNK_BITS = 5
+CHUNK_SIZE = 1 << CHUNK_BITS
+
 class ConstructionSite:
     '''Representation of the area to layout a factory'''
 
-    def __init__(self, x_size, y_size):
-        # self.reserved is a sparse array, containing only those cells that
-        # have been reserved. This means it will work for very large
-        # dimensions as long as they are not fully utilized.
-        self.reserved = {}
+    def __init__(self, x_size=None, y_size=None):
+        '''Create a site of the given size, or an unbounded one that
+        grows with what is built on it, at any coordinates including
+        negative ones'''
+        # Occupancy of each CHUNK_SIZE x CHUNK_SIZE chunk that has a
+        # reserved cell, by chunk coordinates. Memory follows what is built,
+        # so this works for very large dimensions as long as they are not
+        # fully utilized.
+        self.chunks = {}
+        # Number of reserved cells
+        self.reserved_count = 0
+        # (x0, y0, x1, y1) of the reserved cells, x1 and y1 excluded
+        self.box = None
         self.dim_x = x_size
         self.dim_y = y_size
         self.entities = []
+        # Functions called with the position of each cell reserved, and of
+        # each cell released by a rollback, to keep structures derived from
+        # the site up to date
+        self.listeners = []
+        self.release_listeners = []
+        # Changes since the first open checkpoint, to undo them on rollback,
+        # or None when there is no checkpoint
+        self.journal = None
+        # Length of the journal at each open checkpoint, the outermost first
+        self.checkpoints = []
+        # FreeRuns of the site, made when first asked for
+        self.runs = None
 
     def size(self):
-        '''Return an (width, height) tuple'''
-        return (self.dim_x, self.dim_y)
+        '''Return an (width, height) tuple. An unbounded site is as large as
+        the bounding box of its reserved cells.'''
+        if self.is_bounded():
+            return (self.dim_x, self.dim_y)
+        x0, y0, x1, y1 = self.bounding_box()
+        return (x1 - x0, y1 - y0)
+
+    def is_bounded(self) -> bool:
+        return self.dim_x is not None
+
+    def bounding_box(self) -> 'tuple':
+        '''Return (x0, y0, x1, y1) of the reserved cells, x1 and y1
+        excluded, or (0, 0, 0, 0) when no cell is reserved'''
+        return tuple(self.box) if self.box else (0, 0, 0, 0)
+
+    def bounds(self) -> 'tuple':
+        '''Return (x0, y0, x1, y1) of the cells to search: the whole of a
+        bounded site, or the bounding box of an unbounded one'''
+        if self.is_bounded():
+            return (0, 0, self.dim_x, self.dim_y)
+        return self.bounding_box()
+
+    def in_bounds(self, x, y) -> bool:
+        '''Test if a cell is on the site. All cells are on an unbounded site.'''
+        return not self.is_bounded() or (0 <= x < self.dim_x and 0 <= y < self.dim_y)
 
-        if len(self.reserved) == 0:
-            self.dim_x, self.dim_y = 0, 0
-            return
     def is_reserved(self, x, y) -> bool:
         '''Test if a given grid cell is free or not'''
-        pos = (int(x), int(y))
-        return self.reserved.get(pos, False)
+        x, y = int(x), int(y)
+        chunk = self.chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+        return chunk is not None and chunk[((y & (CHUNK_SIZE - 1)) << CHUNK_BITS) | (x & (CHUNK_SIZE - 1))] == 1
 
     def reserve(self, x, y) -> bool:
         '''Allocate the given grid cell'''
         pos = (int(x), int(y))
-        if self.is_reserved(*pos):
+        x, y = pos
+        key = (x >> CHUNK_BITS, y >> CHUNK_BITS)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = bytearray(CHUNK_SIZE * CHUNK_SIZE)
+        i = ((y & (CHUNK_SIZE - 1)) << CHUNK_BITS) | (x & (CHUNK_SIZE - 1))
+        if chunk[i]:
             raise ValueError(f'Cell {pos} is already reserved')
-        self.reserved[pos] = True
+        chunk[i] = 1
+        self.reserved_count += 1
+        if self.journal is not None:
+            self.journal.append(('reserve', pos, self.box and tuple(self.box)))
+        if self.box is None:
+            self.box = [x, y, x + 1, y + 1]
+        else:
+            box = self.box
+            box[0], box[1] = min(box[0], x), min(box[1], y)
+            box[2], box[3] = max(box[2], x + 1), max(box[3], y + 1)
+        for listener in self.listeners:
+            listener(pos)
+
+    def release(self, x, y, box=None):
+        '''Free a reserved grid cell, and set the bounding box of the
+        reserved cells, which is not shrunk otherwise'''
+        pos = (int(x), int(y))
+        x, y = pos
+        key = (x >> CHUNK_BITS, y >> CHUNK_BITS)
+        chunk = self.chunks.get(key)
+        i = ((y & (CHUNK_SIZE - 1)) << CHUNK_BITS) | (x & (CHUNK_SIZE - 1))
+        if chunk is None or not chunk[i]:
+            raise ValueError(f'Cell {pos} is not reserved')
+        chunk[i] = 0
+        if chunk.find(1) < 0:
+            del self.chunks[key]
+        self.reserved_count -= 1
+        if box is not None or self.reserved_count == 0:
+            self.box = box and list(box)
+        for listener in self.release_listeners:
+            listener(pos)
+
+    def reserved_cells(self, x0=None, y0=None, x1=None, y1=None):
+        '''Iterate over the reserved cells, of the area (x0, y0, x1, y1) if
+        given, looking only at the allocated chunks'''
+        area = x0 is not None
+        if area and len(self.chunks) > (((x1 - x0) >> CHUNK_BITS) + 2) * (((y1 - y0) >> CHUNK_BITS) + 2):
+            keys = [(cx, cy) for cy in range(y0 >> CHUNK_BITS, ((y1 - 1) >> CHUNK_BITS) + 1)
+                    for cx in range(x0 >> CHUNK_BITS, ((x1 - 1) >> CHUNK_BITS) + 1)]
+        else:
+            keys = list(self.chunks)
+        for cx, cy in keys:
+            chunk = self.chunks.get((cx, cy))
+            if chunk is None:
+                continue
+            start = 0
+            while True:
+                i = chunk.find(1, start)
+                if i < 0:
+                    break
+                start = i + 1
+                x = (cx << CHUNK_BITS) + (i & (CHUNK_SIZE - 1))
+                y = (cy << CHUNK_BITS) + (i >> CHUNK_BITS)
+                if not area or (x0 <= x < x1 and y0 <= y < y1):
+                    yield (x, y)
+
+    @property
+    def reserved(self) -> set:
+        '''The set of reserved cells'''
+        return set(self.reserved_cells())
+
+    def free_runs(self) -> 'FreeRuns':
+        '''Return the runs of free and reserved cells along the rows and
+        columns, kept up to date as cells are reserved
+
+        :raises ValueError:  When the site is unbounded, see FreeRuns
+        '''
+        if self.runs is None:
+            self.runs = FreeRuns(self)
+            self.listeners.append(self.runs.reserved)
+            self.release_listeners.append(self.runs.released)
+        return self.runs
+
+    #
+    #  Checkpoints
+    #
+
+    def checkpoint(self) -> int:
+        '''Start recording the changes to the site, to undo them with
+        rollback. Checkpoints nest.
+
+        :return:  The checkpoint, to give to rollback or commit
+        '''
+        if self.journal is None:
+            self.journal = []
+        self.checkpoints.append(len(self.journal))
+        return len(self.checkpoints) - 1
+
+    def rollback(self, checkpoint: int):
+        '''Undo the reservations, added entities and entity updates since
+        a checkpoint, most recent first, and close it with the checkpoints
+        opened after it'''
+        journal = self.journal
+        start = self.checkpoints[checkpoint]
+        while len(journal) > start:
+            change = journal.pop()
+            if change[0] == 'reserve':
+                self.release(*change[1], change[2])
+            elif change[0] == 'entity':
+                self.entities.pop()
+            else:
+                _, entity, old = change
+                entity.clear()
+                entity.update(old)
+        self.commit(checkpoint)
+
+    def commit(self, checkpoint: int):
+        '''Keep the changes since a checkpoint, and close it with the
+        checkpoints opened after it. The changes are undone by the rollback
+        of an enclosing checkpoint, and are no longer recorded when the
+        outermost checkpoint is closed.'''
+        del self.checkpoints[checkpoint:]
+        if not self.checkpoints:
+            self.journal = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Context in which the changes to the site are undone when an
+        exception is raised'''
+        checkpoint = self.checkpoint()
+        try:
+            yield self
+        except BaseException:
+            self.rollback(checkpoint)
+            raise
+        self.commit(checkpoint)
 
     def __str__(self) -> str:
+        x0, y0, x1, y1 = self.bounds()
         result = []
-        for y in range(self.dim_y):
-            for x in range(self.dim_x):
+        for y in range(y0, y1):
+            for x in range(x0, x1):
                 ch = '#' if self.is_reserved(x, y) else '.'
                 result.append(ch)
             result.append('\n')
@@ -110,21 +291,25 @@ class ConstructionSite:
         if request_filters:
             entity['request_filters'] = request_filters
         self.entities.append(entity)
+        if self.journal is not None:
+            self.journal.append(('entity',))
+
+    def update_entity(self, entity: dict, **changes):
+        '''Change the information of an entity on the site, like its kind or
+        direction, but not the cells it takes. Keys set to None are removed.'''
+        if self.journal is not None:
+            self.journal.append(('update', entity, dict(entity)))
+        for key, value in changes.items():
+            if value is None:
+                entity.pop(key, None)
+            else:
+                entity[key] = value
 
     def get_entity_list(self):
         '''Return all entities added in a form ready for Blueprint generation'''
 
         center_pos = {i: center_position(e['kind'], e['direction'], e['pos'])
                       for i, e in enumerate(self.entities)}
-        EXPORT_KEYS = set([
-            'recipe',
-            'recipe_quality',
-            'items',
-            'type',
-            'bar',
-            'control_behavior',
-            'request_filters',
-        ])
         result = []
         for i, e in enumerate(self.entities):
             result.append(dict(
@@ -133,20 +318,140 @@ class ConstructionSite:
                 direction=e['direction'],
                 entity_number=i+1
             ))
-            for key in EXPORT_KEYS.intersection(e.keys()):
-                result[-1][key] = e[key]
+            for key in ENTITY_EXPORT_KEYS:
+                if key in e:
+                    result[-1][key] = e[key]
         return result
 
+class FreeRuns:
+    '''
+    Lengths of the runs of free and reserved cells of a site, in each
+    direction along rows and columns.
+
+    For each cell and direction, the run is the number of cells from it
+    that are all free or all reserved, the cell itself included. The next
+    cell after the run is reserved when the cell is free, and the other way
+    around, or is outside the site. Finding free cells along a line, like
+    the exits of underground belts, then takes a lookup per run instead of
+    one per cell.
+
+    Reserving a cell only changes the runs of the cells before it on the
+    same line, up to the first one whose run is unchanged.
+
+    Runs cover the cells of a bounded site, from (0, 0). An unbounded site
+    has no fixed cells to cover, so only windows of it, see
+    windowed.window_site, have runs.
+    '''
+
+    DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+    def __init__(self, site: ConstructionSite):
+        if not site.is_bounded():
+            raise ValueError('Free runs need a bounded site, like a window of an unbounded site')
+        self.width, self.height = site.size()
+        width = self.width
+        self.free = bytearray(0 if site.is_reserved(x, y) else 1
+                              for y in range(self.height) for x in range(width))
+        # Direction to the run length of each cell, indexed y * width + x
+        self.runs = {}
+        for dx, dy in self.DIRECTIONS:
+            runs = [1] * (width * self.height)
+            # Visit cells from the far end of each line, so the cell after
+            # is done first
+            xs = range(width - 1, -1, -1) if dx > 0 else range(width)
+            ys = range(self.height - 1, -1, -1) if dy > 0 else range(self.height)
+            for y in ys:
+                for x in xs:
+                    self.update_run(runs, x, y, dx, dy)
+            self.runs[(dx, dy)] = runs
+
+    def update_run(self, runs, x, y, dx, dy) -> bool:
+        '''Find the run of a cell from the run of the cell after it
+
+        :return:  True if the run changed
+        '''
+        i = y * self.width + x
+        nx, ny = x + dx, y + dy
+        run = 1
+        if 0 <= nx < self.width and 0 <= ny < self.height:
+            j = ny * self.width + nx
+            if self.free[j] == self.free[i]:
+                run = runs[j] + 1
+        if runs[i] == run:
+            return False
+        runs[i] = run
+        return True
+
+    def reserved(self, position):
+        '''Site listener, called when a cell is reserved'''
+        self.set_free(position, 0)
+
+    def released(self, position):
+        '''Site listener, called when a cell is released'''
+        self.set_free(position, 1)
+
+    def set_free(self, position, free):
+        x, y = position
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return
+        self.free[y * self.width + x] = free
+        for (dx, dy), runs in self.runs.items():
+            self.update_run(runs, x, y, dx, dy)
+            bx, by = x - dx, y - dy
+            while 0 <= bx < self.width and 0 <= by < self.height and self.update_run(runs, bx, by, dx, dy):
+                bx, by = bx - dx, by - dy
+
+    def is_free(self, x, y) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height and self.free[y * self.width + x] == 1
+
+    def run(self, x, y, dx, dy) -> int:
+        '''Return the length of the run of a cell in direction (dx, dy)'''
+        return self.runs[(dx, dy)][y * self.width + x]
+
+    def free_cells(self, x, y, dx, dy, first, last) -> List[int]:
+        '''Return the distances from (x, y) of the free cells in direction
+        (dx, dy), from first to last cells away'''
+        runs = self.runs[(dx, dy)]
+        width, height = self.width, self.height
+        distances = []
+        distance = first
+        while distance <= last:
+            cx, cy = x + dx*distance, y + dy*distance
+            if not (0 <= cx < width and 0 <= cy < height):
+                break
+            i = cy * width + cx
+            run = runs[i]
+            if self.free[i]:
+                distances.extend(range(distance, min(distance + run - 1, last) + 1))
+            distance += run
+        return distances
+
+# Optional entity information that is exported to blueprints
+ENTITY_EXPORT_KEYS = [
+    'recipe',
+    'recipe_quality',
+    'items',
+    'type',
+    'bar',
+    'control_behavior',
+    'request_filters',
+]
+
 ENTITY_SIZE = {
     'wooden-chest': (1,1),
     'iron-chest': (1,1),
     'transport-belt': (1,1),
+    'fast-transport-belt': (1,1),
+    'express-transport-belt': (1,1),
     'underground-belt': (1,1),
     'fast-underground-belt': (1,1),
     'express-underground-belt': (1,1),
     'small-electric-pole': (1,1),
     'medium-electric-pole': (1,1),
     'inserter': (1,1),
+    'burner-inserter': (1,1),
+    'fast-inserter': (1,1),
+    'long-handed-inserter': (1,1),
     'gun-turret': (2,2),
     'aai-strongbox': (2,2),
     'electric-mining-drill': (3,3),
@@ -158,6 +463,7 @@ ENTITY_SIZE = {
     'logistic-chest-passive-provider': (1,1),
 }
 
+@functools.lru_cache(maxsize=None)
 def factoriocalc_entity_size(machine_name):
     import factoriocalc
     machine_class = factoriocalc.mchByName.get(machine_name)
@@ -176,12 +482,18 @@ def entity_size(entity_name, direc: Direction = 0):
         size = [x,y]
     return size
 
+@functools.lru_cache(maxsize=None)
+def center_offset(entity_name, direc: Direction):
+    '''Offset from top left corner to center of the entity'''
+    size = entity_size(entity_name, direc)
+    return (size[0]/2, size[1]/2)
+
 def center_position(entity_name, direc: Direction, top_left_pos):
     '''Factorio blueprint position are at the center of the entity,
     which has 1/2 grid resolution
     '''
-    size = entity_size(entity_name, direc)
-    return [top_left_pos[i] + size[i]/2 for i in range(2)]
+    offset = center_offset(entity_name, direc)
+    return [top_left_pos[i] + offset[i] for i in range(2)]
 
 def top_left_pos(kind, direction, center_pos):
     '''ConstructionSite position is at the top left of the entity'''
@@ -258,36 +570,125 @@ def empty_blueprint_dict():
         'label': 'Uninitialized Blueprint'
     }}
 
-def site_as_blueprint_string(site, label='Unnamed ConstructionSite', icons=None, description=None):
-    '''Given a ConstructionSite, return a valid blueprint string'''
+# zlib settings for exchange strings. Level 9 is markedly slower than
+# level 6, for a string that is only slightly shorter.
+DEFAULT_COMPRESSION_LEVEL = 6
+COMPRESSION_STRATEGIES = {
+    'default': 'Z_DEFAULT_STRATEGY',
+    'filtered': 'Z_FILTERED',
+    'huffman': 'Z_HUFFMAN_ONLY',
+    'rle': 'Z_RLE',
+    'fixed': 'Z_FIXED',
+}
+
+def json_encoder(backend=None):
+    '''Return a function that encodes a value as compact JSON in UTF-8 bytes
+
+    :param backend:  "json" for the standard library, "orjson" for the
+        faster orjson package, or None to use orjson when it is installed
+    '''
+    if backend in (None, 'orjson'):
+        try:
+            import orjson
+            return orjson.dumps
+        except ImportError:
+            if backend == 'orjson':
+                raise
+    elif backend != 'json':
+        raise ValueError(f'Unknown JSON backend {backend}')
+    import json
+    def dumps(value):
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return dumps
+
+def _compressor(level, strategy, wbits=15):
+    '''Create a zlib compression object
+
+    :param level:  Compression level 0..9, or -1 for the zlib default
+    :param strategy:  Name from COMPRESSION_STRATEGIES, or a zlib strategy constant
+    :param wbits:  15 for a zlib stream, -15 for raw deflate data
+    '''
+    import zlib
+    if isinstance(strategy, str):
+        if strategy not in COMPRESSION_STRATEGIES:
+            raise ValueError(f'Unknown compression strategy {strategy}')
+        strategy = getattr(zlib, COMPRESSION_STRATEGIES[strategy])
+    return zlib.compressobj(level=level, wbits=wbits, strategy=strategy)
+
+def _exchange_string(compressed_json):
+    '''Prefix version to base64 encoded data'''
+    import base64
+    VERSION = "0"
+    return VERSION + base64.b64encode(compressed_json).decode("ascii")
+
+def site_as_blueprint_string(site, label='Unnamed ConstructionSite', icons=None, description=None,
+        level=DEFAULT_COMPRESSION_LEVEL, strategy='default', json_backend=None):
+    '''Given a ConstructionSite, return a valid blueprint string
+
+    The entity JSON is written directly from the site entities, in batches
+    that are compressed as they are written. See export_blueprint_dict for
+    the compression parameters.
+    '''
+    import json
+    dumps = json_encoder(json_backend)
+    compressor = _compressor(level, strategy)
+
     bp_dict = empty_blueprint_dict()
     blueprint = bp_dict['blueprint']
-    blueprint['entities'] = site.get_entity_list()
+    del blueprint['entities']
     blueprint['label'] = label
     if icons is not None:
         blueprint['icons'] = icons
     if description is not None:
         blueprint['description'] = description
-    return export_blueprint_dict(bp_dict)
+    # Leave out the closing braces, and add the entities as the last member
+    header = dumps(bp_dict)
+    compressed = [compressor.compress(header[:-2] + b',"entities":[')]
+
+    json_name = {}
+    BATCH_SIZE = 1024
+    batch = []
+    for i, e in enumerate(site.entities):
+        kind = e['kind']
+        direction = e['direction']
+        if kind not in json_name:
+            json_name[kind] = json.dumps(kind)
+        offset = center_offset(kind, direction)
+        x = float(e['pos'][0] + offset[0])
+        y = float(e['pos'][1] + offset[1])
+        parts = [f'{{"name":{json_name[kind]},"position":{{"x":{x!r},"y":{y!r}}}'
+                 f',"direction":{int(direction)},"entity_number":{i+1}']
+        for key in ENTITY_EXPORT_KEYS:
+            if key in e:
+                parts.append(f',"{key}":{json.dumps(e[key], separators=(",", ":"))}')
+        parts.append('}')
+        batch.append(''.join(parts))
+        if len(batch) == BATCH_SIZE:
+            # Batches after the first are separated by a comma
+            separator = ',' if i >= BATCH_SIZE else ''
+            compressed.append(compressor.compress((separator + ','.join(batch)).encode('utf-8')))
+            batch = []
+    separator = ',' if len(batch) > 0 and len(site.entities) > BATCH_SIZE else ''
+    compressed.append(compressor.compress((separator + ','.join(batch) + ']}}').encode('utf-8')))
+    compressed.append(compressor.flush())
+    return _exchange_string(b''.join(compressed))
 
-def export_blueprint_dict(bp_dict):
+def export_blueprint_dict(bp_dict, level=DEFAULT_COMPRESSION_LEVEL, strategy='default', json_backend=None):
     '''Encodes a blueprint as an exchange string
 
     :param blueprint:  a dict representing the blueprint, containing elements defined by
         https://wiki.factorio.com/Blueprint_string_format
+    :param level:  zlib compression level 0..9. Higher levels give shorter
+        strings, but take more time.
+    :param strategy:  zlib compression strategy, one of the names in
+        COMPRESSION_STRATEGIES
+    :param json_backend:  See json_encoder
     '''
 
-    # This code is copied from factoriolib.dictToExchangeString
-    import base64
-    import json
-    import zlib
-    jsonString = json.dumps(bp_dict)
-    jsonBytes = jsonString.encode("utf-8")
-    compressedJson = zlib.compress(jsonBytes, 9)
-    VERSION = "0"
-    encodedString = VERSION + base64.b64encode(compressedJson).decode("utf-8")
-
-    return encodedString
+    # This code is inspired by factoriolib.dictToExchangeString
+    compressor = _compressor(level, strategy)
+    compressed_json = compressor.compress(json_encoder(json_backend)(bp_dict)) + compressor.flush()
+    return _exchange_string(compressed_json)
 
 def import_blueprint_dict(exchangeString) -> dict:
     '''Decodes a blueprint exchange string
@@ -302,14 +703,240 @@ def import_blueprint_dict(exchangeString) -> dict:
     import zlib
     version_byte = exchangeString[0] # currently always zero
     if not version_byte == '0':
-        raise ValueError('Exchange string version {VERSION} not supported')
+        raise ValueError(f'Exchange string version {version_byte} not supported')
     payload = exchangeString[1:]
     decodedString = base64.b64decode(payload)
-    decompressedData = zlib.decompress(decodedString)
+    try:
+        decompressedData = zlib.decompress(decodedString)
+    except zlib.error as ex:
+        raise ValueError(f'Exchange string is not valid: {ex}') from ex
     jsonString = decompressedData.decode("utf-8")
     bp_dict = json.loads(jsonString)
     return bp_dict
 
+# Paths in a blueprint dict, where values are streamed one at a time,
+# see iter_blueprint_events
+BLUEPRINT_STREAM_PATHS = [
+    ('blueprint', 'entities', '*'),
+    ('blueprint', 'tiles', '*'),
+    ('blueprint_book', 'blueprints', '*', 'blueprint', 'entities', '*'),
+    ('blueprint_book', 'blueprints', '*', 'blueprint', 'tiles', '*'),
+]
+
+def iter_exchange_string_json(source, chunk_size=1 << 16):
+    '''Decodes a blueprint exchange string in chunks, so only a small part
+    of it is held in memory at a time.
+
+    :param source:  A blueprint exchange string, or a text file to read it from
+    :param chunk_size:  Number of characters read and produced at a time
+    :return:  Iterator of str, that together form the blueprint JSON text
+    '''
+    import base64
+    import binascii
+    import codecs
+    import io
+    import zlib
+    if isinstance(source, str):
+        source = io.StringIO(source)
+
+    version_byte = source.read(1)
+    while version_byte.isspace():
+        version_byte = source.read(1)
+    if not version_byte == '0':
+        raise ValueError(f'Exchange string version {version_byte} not supported')
+
+    decompressor = zlib.decompressobj()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    try:
+        while True:
+            text = source.read(chunk_size)
+            if len(text) == 0:
+                break
+            # Base64 decodes groups of 4 characters
+            pending += ''.join(text.split())
+            usable = len(pending) - len(pending) % 4
+            data = base64.b64decode(pending[:usable], validate=True)
+            pending = pending[usable:]
+            while len(data) > 0:
+                json_bytes = decompressor.decompress(data, chunk_size)
+                data = decompressor.unconsumed_tail
+                yield utf8.decode(json_bytes)
+        if len(pending) > 0:
+            raise ValueError('Exchange string is truncated')
+        json_bytes = decompressor.flush()
+        if not decompressor.eof:
+            raise ValueError('Exchange string is truncated')
+        yield utf8.decode(json_bytes, final=True)
+    except (binascii.Error, zlib.error, UnicodeDecodeError) as ex:
+        raise ValueError(f'Exchange string is not valid: {ex}') from ex
+
+def iter_blueprint_events(source, stream_paths=BLUEPRINT_STREAM_PATHS):
+    '''Decodes a blueprint exchange string as a stream of (path, value) pairs.
+    Entities and tiles are delivered one at a time, so very large
+    blueprints and books can be processed in bounded memory.
+
+    Example: A blueprint gives pairs like
+    (('blueprint', 'label'), 'My blueprint') and
+    (('blueprint', 'entities', 0), {'entity_number': 1, 'name': ...})
+
+    :param source:  A blueprint exchange string, or a text file to read it from
+    :param stream_paths:  Paths that are delivered one value at a time,
+        see jsonstream.iter_events
+    :return:  Iterator of (path, value) tuples
+    '''
+    import jsonstream
+    return jsonstream.iter_events(iter_exchange_string_json(source), stream_paths)
+
+def iter_blueprint_entities(source):
+    '''Decodes the entities of a blueprint exchange string, one at a time
+
+    :param source:  A blueprint exchange string, or a text file to read it from
+    :return:  Iterator of entity dicts
+    '''
+    for path, value in iter_blueprint_events(source):
+        if path[:2] == ('blueprint', 'entities') and len(path) == 3:
+            yield value
+
+def is_blueprint_book(bp_dict) -> bool:
+    '''Test if a decoded exchange string is a blueprint book'''
+    return 'blueprint_book' in bp_dict
+
+def blueprint_book_dict(blueprints, label='Unnamed Blueprint Book', description=None, icons=None, active_index=0):
+    '''Return a blueprint book containing the given blueprints
+
+    :param blueprints:  List of dicts, like the ones returned by
+        empty_blueprint_dict. Books can be nested.
+    :return:  A dict as defined at https://wiki.factorio.com/Blueprint_string_format
+    '''
+    book = {
+        'item': 'blueprint-book',
+        'label': label,
+        'blueprints': [dict(index=i, **bp_dict) for i, bp_dict in enumerate(blueprints)],
+        'active_index': active_index,
+        'version': factorio_version_string_as_int(),
+    }
+    if description is not None:
+        book['description'] = description
+    if icons is not None:
+        book['icons'] = icons
+    return {'blueprint_book': book}
+
+def iter_book_blueprints(bp_dict, _indexes=()):
+    '''Yield the blueprints in a blueprint book. Nested books are searched
+    too. Other book content, like deconstruction planners, is skipped.
+
+    :param bp_dict:  A decoded exchange string. A plain blueprint gives
+        itself, with an empty index tuple.
+    :return:  Iterator of (indexes, bp_dict) tuples, where indexes is a
+        tuple with the page index in each book along the way
+    '''
+    if 'blueprint' in bp_dict:
+        yield _indexes, {'blueprint': bp_dict['blueprint']}
+    elif 'blueprint_book' in bp_dict:
+        for i, page in enumerate(bp_dict['blueprint_book'].get('blueprints', [])):
+            yield from iter_book_blueprints(page, _indexes + (page.get('index', i),))
+
+def imap_blueprints(func, items, processes=None):
+    '''Apply func to each item, in a pool of worker processes. Blueprints in
+    a book are independent of each other, so they can be encoded or analyzed
+    in parallel. Results are yielded as soon as they are ready, in order.
+
+    :param func:  Function taking one item. It must be defined at module
+        level, so worker processes can find it.
+    :param items:  List of arguments to func. Items and results are copied
+        between processes, so they should be plain data.
+    :param processes:  Number of worker processes. None uses all cores, and
+        1 runs func in this process.
+    :return:  Iterator of results, in the order of items
+    '''
+    import os
+    items = list(items)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(items))
+    if processes <= 1:
+        yield from map(func, items)
+        return
+
+    import concurrent.futures
+    # Send several items per task, to keep the overhead per item small
+    chunksize = max(1, len(items) // (4 * processes))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        yield from pool.map(func, items, chunksize=chunksize)
+
+def map_blueprints(func, items, processes=None):
+    '''Apply func to each item in parallel, see imap_blueprints
+
+    :return:  List of results, in the order of items
+    '''
+    return list(imap_blueprints(func, items, processes))
+
+def _deflate_page(args):
+    '''Compress one JSON encoded book page as raw deflate data, ending
+    at a byte boundary so pages can be joined.
+
+    :return:  (compressed bytes, adler32 checksum, length) of the page
+    '''
+    import zlib
+    page, separator, level, strategy, json_backend = args
+    data = separator + json_encoder(json_backend)(page)
+    compressor = _compressor(level, strategy, wbits=-15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data), len(data)
+
+def _adler32_combine(adler1, adler2, length2):
+    '''Return the adler32 checksum of two joined byte strings, from their
+    checksums. Python zlib does not have adler32_combine.'''
+    BASE = 65521
+    rem = length2 % BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + BASE - 1) % BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + BASE - rem) % BASE
+    return sum1 | (sum2 << 16)
+
+def export_blueprint_book(bp_dict, level=DEFAULT_COMPRESSION_LEVEL, strategy='default', json_backend=None, processes=None):
+    '''Encodes a blueprint book as an exchange string. The pages are encoded
+    and compressed in parallel, and the compressed pages are joined into one
+    zlib stream, like pigz does. References back in the compressed data do
+    not cross pages, so the string is slightly longer than the one from
+    export_blueprint_dict. It does not depend on the number of processes.
+
+    :param bp_dict:  A dict with a blueprint book, see blueprint_book_dict
+    :param processes:  See map_blueprints
+    :param level, strategy, json_backend:  See export_blueprint_dict
+    '''
+    import struct
+    import zlib
+    if not is_blueprint_book(bp_dict):
+        raise ValueError('Not a blueprint book')
+    dumps = json_encoder(json_backend)
+    book = dict(bp_dict['blueprint_book'])
+    pages = book.pop('blueprints', [])
+
+    # Leave out the closing braces, and add the pages as the last member
+    header = dumps({'blueprint_book': book})[:-2] + b',"blueprints":['
+    footer = b']}}'
+    compressor = _compressor(level, strategy, wbits=-15)
+    parts = [compressor.compress(header) + compressor.flush(zlib.Z_SYNC_FLUSH)]
+    checksum = zlib.adler32(header)
+    args = [(page, b',' if i > 0 else b'', level, strategy, json_backend) for i, page in enumerate(pages)]
+    for compressed, page_checksum, length in map_blueprints(_deflate_page, args, processes):
+        parts.append(compressed)
+        checksum = _adler32_combine(checksum, page_checksum, length)
+    parts.append(compressor.compress(footer) + compressor.flush())
+    checksum = zlib.adler32(footer, checksum)
+
+    # zlib header with the compression level in FLEVEL, and FCHECK making
+    # the header a multiple of 31
+    CMF = 0x78
+    flevel = 0 if level in (0, 1) else 1 if level < 6 else 2 if level in (6, -1) else 3
+    flg = flevel << 6
+    flg += -(CMF << 8 | flg) % 31
+    compressed_json = bytes([CMF, flg]) + b''.join(parts) + struct.pack('>I', checksum)
+    return _exchange_string(compressed_json)
+
 def place_blueprint_on_site(site: ConstructionSite, bp_dict, offset=(0,0)):
     '''Add objects from blueprint dict to construction site at the specified offset
 
@@ -404,11 +1031,7 @@ def belt_path(site: ConstructionSite, point_list, belt_type='transport-belt'):
             s[1] += step[1]
 
 def site_to_test(site: 'ConstructionSite', source, target) -> 'str':
-    coordinates = []
-    for y in range(site.dim_y):
-        for x in range(site.dim_x):
-            if site.is_reserved(x, y):
-                coordinates.append((x,y))
+    coordinates = sorted(site.reserved_cells(), key=lambda position: position[::-1])
 
     start = source.position
     end = target.position
@@ -425,8 +1048,8 @@ def site_to_test(site: 'ConstructionSite', source, target) -> 'str':
 
     final_string = f"""
         print("{start_type} and {end_type}")
-        width = {site.dim_x}
-        height = {site.dim_y}
+        width = {site.size()[0]}
+        height = {site.size()[1]}
         site = layout.ConstructionSite(width, height)
         source = solver.FakeMachine(Vector{str(start)}, (3,3))
         target = solver.FakeMachine(Vector{str(end)}, (3,3))
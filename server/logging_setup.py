@@ -0,0 +1,116 @@
+''' Non-blocking logging for the server.
+
+Log records are put on a queue by the thread that logs, and a listener
+thread writes them to file. Request threads never wait for file I/O.
+Levels can be set for each module while the server runs, eg. to debug
+path finding without logging everything else.
+
+Primary interface:
+
+- :func:`setup_queue_logging` - send all logging through a queue to a file
+- :func:`set_levels` - set log levels per module
+- :func:`get_levels` - get the log levels that are set
+'''
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+#
+#  Constants
+#
+
+FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+# Name used for the root logger in level dicts
+ROOT = 'root'
+
+_listener = None
+_queue_handler = None
+
+#
+#  Functions
+#
+
+def setup_queue_logging(filename, level=logging.INFO, levels=None, fmt=FORMAT):
+    '''Send all log records through a queue, and write them to a file in a
+    separate thread. Calling it again replaces the earlier setup.
+
+    :param filename:  Log file, appended to
+    :param level:  Level of the root logger
+    :param levels:  Dict from logger name to level, see set_levels
+    :return:  The started logging.handlers.QueueListener
+    '''
+    global _listener, _queue_handler
+    stop_queue_logging()
+
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(filename, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(fmt))
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    logging.getLogger().addHandler(_queue_handler)
+    set_levels({ROOT: level, **(levels or {})})
+    _listener.start()
+    return _listener
+
+def stop_queue_logging():
+    '''Write the records still on the queue, and stop the listener thread'''
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+atexit.register(stop_queue_logging)
+
+def parse_levels(spec: str) -> dict:
+    '''Parse levels like "solver=DEBUG,a_star_factorio=WARNING"
+
+    :return:  Dict from logger name to level name
+    '''
+    levels = {}
+    for part in spec.split(','):
+        if part.strip() == '':
+            continue
+        name, sep, level = part.partition('=')
+        if sep == '':
+            raise ValueError(f'Expected name=LEVEL, found "{part}"')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def set_levels(levels: dict):
+    '''Set log levels per logger. Levels take effect at once.
+
+    :param levels:  Dict from logger name to a level name like "DEBUG" or a
+        level number. The name "root" is the root logger. A level of None
+        or "NOTSET" makes the logger use the level of its parent.
+    '''
+    # Check all levels before changing any
+    checked = {}
+    for name, level in levels.items():
+        if level is None:
+            level = logging.NOTSET
+        if isinstance(level, str):
+            # getLevelName maps known level names to numbers
+            number = logging.getLevelName(level.upper())
+            if not isinstance(number, int):
+                raise ValueError(f'Unknown log level {level} for {name}')
+            level = number
+        checked[name] = level
+    for name, level in checked.items():
+        logging.getLogger(None if name == ROOT else name).setLevel(level)
+
+def get_levels() -> dict:
+    '''Return a dict from logger name to level name, for the root logger and
+    the loggers that have a level of their own'''
+    levels = {ROOT: logging.getLevelName(logging.getLogger().level)}
+    for name, logger in sorted(logging.root.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
@@ -0,0 +1,207 @@
+''' In-process metrics, exposed in the Prometheus text format.
+
+Metrics are registered in a Registry, and updated by the code that does
+the work. The registry renders all of them as text for a /metrics
+endpoint, so no external service is needed.
+
+Metrics are safe to update from several threads.
+
+Primary interface:
+
+- :class:`Counter` - a value that only goes up, like a request count
+- :class:`Gauge` - a value that goes up and down, like a queue depth
+- :class:`Histogram` - counts of observations in buckets, like latencies
+- :data:`REGISTRY` - the default registry, rendered by :func:`render`
+'''
+
+import math
+import threading
+
+#
+#  Constants
+#
+
+# Bucket upper bounds in seconds, for request and stage latencies
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+#
+#  Classes
+#
+
+class Registry:
+    '''A collection of metrics, rendered together'''
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        '''Return all metrics in the Prometheus text format'''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {_escape_help(metric.help)}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    '''Metric with a value for each combination of label values'''
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Metric {self.name} has labels {self.labelnames}, not {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def get(self, **labels):
+        '''Return the current value for the labels'''
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        '''Yield (name, labels, value) for each sample'''
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Counter(_Metric):
+    '''A count that only increases
+
+    :param function:  Optional function, called when rendering, that returns
+        a dict from tuples of label values to counts. Use this to expose
+        counts kept elsewhere.
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, function=None):
+        self.function = function
+        super().__init__(name, help, labelnames, registry)
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only increase')
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        for key, value in sorted(self.function().items()):
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Counter):
+    '''A value that goes up and down. See Counter for the function parameter.'''
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    '''Count observations in buckets
+
+    :param buckets:  Increasing upper bounds. An unbounded bucket is added.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value, **labels):
+        import bisect
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = dict(counts=[0] * (len(self.buckets) + 1), sum=0.0)
+            h = self.values[key]
+            h['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            h['sum'] += value
+
+    def get(self, **labels):
+        '''Return (count, sum) of observations for the labels'''
+        with self.lock:
+            h = self.values.get(self._key(labels))
+            return (sum(h['counts']), h['sum']) if h else (0, 0.0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, dict(counts=list(h['counts']), sum=h['sum']))
+                            for key, h in self.values.items())
+        for key, h in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), h['counts']):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + [('le', bound)], cumulative
+            yield f'{self.name}_sum', labels, h['sum']
+            yield f'{self.name}_count', labels, cumulative
+
+#
+#  Functions
+#
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(_format_value(v) if isinstance(v, (int, float)) else v)}"'
+                          for name, v in labels) + '}'
+
+def render(registry=REGISTRY) -> str:
+    '''Return the metrics of a registry in the Prometheus text format'''
+    return registry.render()
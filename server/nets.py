@@ -0,0 +1,146 @@
+'''
+Belts shared by the connections that take the same item from a machine.
+
+A machine, or an input port, often supplies the same item to several
+machines. Rather than a belt to each of them, one belt goes from it past
+each machine in turn, a chain through the machines of the net, and each
+machine takes its items off the belt with an inserter. The next machine
+is the one closest to the end of the belt, which is then extended from
+there by solver.connect_machines. A new belt is started when the items
+taken would be more than the belt carries, and when the belt cannot be
+extended. Belts and inserters are of the tiers that carry their items,
+see tiers.
+
+Each machine after the first costs a search from the end of the belt,
+instead of one from the source, and only the belt tiles past the machine
+before it.
+'''
+
+import logging
+from typing import Callable, List
+
+import profiling
+import tiers
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Nets
+#
+
+class Net:
+    '''Connections from one source, of one item'''
+
+    def __init__(self, source, item=None):
+        self.source = source
+        # The item carried, or None when the connections carry several
+        # items and may not share a belt
+        self.item = item
+        self.targets = []
+        # Items per second taken by each target
+        self.rates = {}
+
+    def add(self, target, rate):
+        self.targets.append(target)
+        self.rates[target] = float(rate)
+
+def find_nets(machines, share=True) -> List[Net]:
+    '''Group the connections of machines by source and item, in the order
+    of the sources
+
+    :param share:  When False, each connection is a net of its own, in the
+        order of the targets
+    '''
+    nets = []
+    if not share:
+        for target in machines:
+            for source in target.getConnections():
+                net = Net(source)
+                net.add(target, tiers.connection_rate(source, target))
+                nets.append(net)
+        return nets
+    for source in machines:
+        by_item = {}
+        for target in source.getUsers():
+            if any(target in net.rates for net in by_item.values()):
+                # Connected twice, and the belt already passes it
+                continue
+            rates = target.input_rates.get(source, {})
+            if len(rates) != 1:
+                net = Net(source)
+                net.add(target, sum(rates.values()))
+                nets.append(net)
+                continue
+            [(item, rate)] = rates.items()
+            if item not in by_item:
+                by_item[item] = Net(source, item)
+                nets.append(by_item[item])
+            by_item[item].add(target, rate)
+    return nets
+
+def route(net: Net, connect: Callable, belt=None, inserter=None) -> List[tiers.Overload]:
+    '''Connect the targets of a net, closest to the end of the belt first
+
+    :param connect:  Function called with (target, trunk, belt, inserter,
+        source_inserter) that connects the source to target, like
+        solver.connect_machines, and returns the entities of the belt, up to
+        the inserter at target
+    :param belt:  Tier of belt, which sets the items it carries. None picks
+        the cheapest that carries the items of the whole net.
+    :param inserter:  Type of inserter. None picks the cheapest that carries
+        the items of each connection, and of the belt at the source.
+    :return:  The belts and inserters that carry less than their rate. The
+        inserter at the source and the belt are checked once for each belt,
+        against the items of all its targets.
+    '''
+    if belt is None:
+        belt = tiers.belt_for(sum(net.rates.values()))
+    targets = list(net.targets)
+    # Belt that the next target may be connected to
+    trunk = None
+    # Entities of the belt to the last target, and the items it carries
+    current = None
+    current_target = None
+    carried = 0
+    overloads = []
+    def check_belt():
+        if current is not None:
+            overloads.extend(tiers.check(net.source, current_target, carried, current[0]['kind'],
+                                         tiers.SOURCE_INSERTER, current[0]['pos']))
+            overloads.extend(tiers.check(net.source, current_target, carried, belt,
+                                         tiers.BELT, current[1]['pos']))
+    while targets:
+        if trunk is None:
+            end = net.source.center()
+        else:
+            end = Vector(*trunk[-1]['pos']) + Vector(0.5, 0.5)
+        target = min(targets, key=lambda t: (t.center() - end).norm())
+        targets.remove(target)
+        rate = net.rates[target]
+        if trunk is not None and carried + rate > tiers.speed(belt):
+            log.debug(f'Belt of {net.item} is full')
+            profiling.count('nets.full')
+            trunk = None
+        if trunk is None:
+            carried = 0
+        target_inserter = inserter or tiers.inserter_for(rate)
+        source_inserter = inserter or tiers.inserter_for(carried + rate)
+        entities = connect(target, trunk, belt, target_inserter, source_inserter)
+        if trunk is not None and entities[0] is trunk[0]:
+            profiling.count('nets.taps')
+            carried += rate
+        else:
+            check_belt()
+            carried = rate
+        current, current_target = entities[:-1], target
+        overloads += tiers.check(net.source, target, rate, entities[-1]['kind'],
+                                 tiers.TARGET_INSERTER, entities[-1]['pos'])
+        if net.item is not None:
+            trunk = current
+    check_belt()
+    return overloads
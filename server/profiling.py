@@ -0,0 +1,129 @@
+''' Lightweight instrumentation of the blueprint generation pipeline.
+
+Code is instrumented with spans around stages, and counters for the work
+done in them. Nothing is recorded unless a profile is active, so the
+instrumentation can be left in production code. A profile is active in the
+context where it was started, also when threads or tasks run concurrently.
+
+Spans with the same name are summed, so a span can be used in a loop
+without the profile growing. Nested spans get dotted names, like
+"generate.place_on_site".
+
+Primary interface:
+
+- :func:`profile` - context manager collecting a Profile
+- :func:`span` - context manager timing a stage
+- :func:`count` - add to a counter
+- :func:`maximum` - keep the largest value seen
+- :func:`value` - keep the last value seen
+- :func:`observe` - keep every value seen, for histograms
+- :func:`log_profile` - write a profile as a structured log record
+'''
+
+import contextlib
+import contextvars
+import logging
+import time
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Classes
+#
+
+class Profile:
+    '''Spans and counters collected during a profile'''
+
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.values = {}
+        self.samples = {}
+        self.span_names = []
+
+    def add_span(self, name, seconds):
+        if name not in self.spans:
+            self.spans[name] = dict(calls=0, seconds=0.0)
+        self.spans[name]['calls'] += 1
+        self.spans[name]['seconds'] += seconds
+
+    def as_dict(self):
+        '''Return the profile as plain data, ready for JSON. Samples are
+        left out, as there may be many of them.'''
+        return dict(
+            spans={name: dict(s) for name, s in self.spans.items()},
+            counters=dict(self.counters),
+            values=dict(self.values),
+        )
+
+_current_profile = contextvars.ContextVar('profile', default=None)
+
+#
+#  Functions
+#
+
+def current_profile():
+    '''Return the active Profile, or None'''
+    return _current_profile.get()
+
+@contextlib.contextmanager
+def profile():
+    '''Collect spans and counters in a new Profile, until the context ends'''
+    p = Profile()
+    token = _current_profile.set(p)
+    try:
+        yield p
+    finally:
+        _current_profile.reset(token)
+
+@contextlib.contextmanager
+def span(name):
+    '''Time a stage. The time is added to the span, also if the stage fails.'''
+    p = _current_profile.get()
+    if p is None:
+        yield
+        return
+    p.span_names.append(name)
+    full_name = '.'.join(p.span_names)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        p.add_span(full_name, time.perf_counter() - start)
+        p.span_names.pop()
+
+def count(name, n=1):
+    '''Add n to a counter'''
+    p = _current_profile.get()
+    if p is not None:
+        p.counters[name] = p.counters.get(name, 0) + n
+
+def maximum(name, v):
+    '''Keep the largest value seen'''
+    p = _current_profile.get()
+    if p is not None and v > p.values.get(name, v - 1):
+        p.values[name] = v
+
+def value(name, v):
+    '''Keep the last value seen'''
+    p = _current_profile.get()
+    if p is not None:
+        p.values[name] = v
+
+def observe(name, v):
+    '''Keep every value seen, like the size of each search'''
+    p = _current_profile.get()
+    if p is not None:
+        p.samples.setdefault(name, []).append(v)
+
+def log_profile(p: Profile, logger=log, level=logging.INFO, **context):
+    '''Write a profile as one JSON log record
+
+    :param context:  Extra members of the record, like a request id
+    '''
+    import json
+    logger.log(level, json.dumps(dict(event='profile', **context, **p.as_dict())))
@@ -0,0 +1,100 @@
+''' Progress reports from blueprint generation.
+
+Blueprint generation can take a long time. The spring layout and the path
+finding already have hooks for visualisation. This module turns calls to
+those hooks into progress events, and passes them on at a limited rate, so
+they can be streamed to a client.
+
+Primary interface:
+
+- :class:`Progress` - collects progress and passes events on
+'''
+
+import time
+
+#
+#  Classes
+#
+
+class Progress:
+    '''Collect progress from generation hooks, and pass it on as event dicts.
+
+    Each event has a member "event" with the kind of event, and members
+    that depend on the kind:
+
+    - stage: "stage", the name of the stage that starts
+    - spring: "iteration", "iteration_limit" and "movement"
+    - path: "expanded", nodes expanded by the current path search
+    - connections: "routed" and "total"
+
+    Stage events are always passed on. Other events are passed on at most
+    once per interval, except the last connection.
+
+    :param emit:  Function taking an event dict. It may raise
+        budget.Cancelled to stop the generation. None ignores all progress.
+    :param interval:  Minimum seconds between events that are not stages
+    '''
+
+    def __init__(self, emit=None, interval=0.25):
+        self.emit = emit
+        self.interval = interval
+        self.last_time = float('-inf')
+
+    def _throttled(self, event, force=False):
+        if self.emit is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_time >= self.interval:
+            self.last_time = now
+            self.emit(event)
+
+    def stage(self, name):
+        '''Report the start of a stage'''
+        if self.emit is not None:
+            self.emit(dict(event='stage', stage=name))
+
+    def spring_iteration(self, movement=None, iteration=None, iteration_limit=None):
+        '''Report a spring iteration. The signature matches the
+        iteration_visitor of solver.spring.'''
+        self._throttled(dict(event='spring', iteration=iteration, iteration_limit=iteration_limit,
+                             movement=float(movement)))
+
+    def connection(self, routed, total):
+        '''Report that a connection between machines is routed'''
+        self._throttled(dict(event='connections', routed=routed, total=total), force=routed == total)
+
+    def path_visualizer(self):
+        '''Return a visualizer for A_star.find_path, that reports the
+        number of nodes expanded'''
+        return _PathProgress(self)
+
+
+class _PathProgress:
+    '''Path finding visualizer, reporting search progress'''
+
+    # Nothing is shown, so the search may take any shortcut, see
+    # solver.draws_path
+    draws = False
+
+    def __init__(self, progress: Progress):
+        self.progress = progress
+        self.closed_list = []
+
+    def set_closed_list(self, closed_list):
+        self.closed_list = closed_list
+
+    def set_open_list(self, open_list):
+        pass
+
+    def set_start_squares(self, start_coordinates):
+        pass
+
+    def set_end_squares(self, end_coordinates):
+        pass
+
+    def reset(self):
+        pass
+
+    def show_frame(self, back_trace_steps=None):
+        if back_trace_steps is None:
+            self.progress._throttled(dict(event='path', expanded=len(self.closed_list)))
@@ -0,0 +1,117 @@
+'''
+Paths found before, for reuse when the same machines are routed again.
+
+Layouts that are retried, or run from several seeds, route the same
+machines through the same tiles again and again. A path is stored under
+the start and end positions of the search, the belt tier and search
+options, and a hash of the free tiles around them. A stored path is only
+used when all of its tiles are still free on the site, as the search may
+have left the area that was hashed. Its start positions are not checked,
+as the hash covers them, and a belt that is extended starts on its end.
+
+The cache holds a bounded number of paths, and drops the least recently
+used ones first. It can be shared by generations running in several
+threads.
+'''
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import logging
+import threading
+from typing import List
+
+from a_star_factorio import UNDERGROUND_REACH
+import layout
+import profiling
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+# Most paths kept
+CACHE_SIZE = 1024
+
+# Tiles around the start and end positions whose occupancy is hashed
+MARGIN = 2 * UNDERGROUND_REACH
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'stale', 'maxsize', 'currsize'])
+
+#
+#  Cache
+#
+
+class RouteCache:
+    '''Least recently used paths, keyed by the search and the tiles around it'''
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.paths = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Paths found, but with tiles reserved since they were stored
+        self.stale = 0
+
+    def key(self, site: layout.ConstructionSite, start_positions: List["tuple"],
+            end_positions: List["tuple"], *options) -> "tuple":
+        '''Return the key of a search on a site. Options are anything else
+        that changes the path found, like the belt tier.'''
+        runs = site.free_runs()
+        positions = start_positions + end_positions
+        x0 = max(0, min(x for x, _ in positions) - MARGIN)
+        y0 = max(0, min(y for _, y in positions) - MARGIN)
+        x1 = min(runs.width, max(x for x, _ in positions) + MARGIN + 1)
+        y1 = min(runs.height, max(y for _, y in positions) + MARGIN + 1)
+        occupancy = hashlib.blake2b(digest_size=16)
+        occupancy.update(f'{x0},{y0},{x1},{y1}'.encode())
+        for y in range(y0, y1):
+            occupancy.update(runs.free[y * runs.width + x0:y * runs.width + x1])
+        return (frozenset(start_positions), frozenset(end_positions), options, occupancy.digest())
+
+    def get(self, site: layout.ConstructionSite, key) -> List["tuple"]:
+        '''Return a copy of the path stored under key, or None if there is
+        none or one of its tiles after the start positions is reserved'''
+        with self.lock:
+            path = self.paths.get(key)
+            if path is not None:
+                self.paths.move_to_end(key)
+            else:
+                self.misses += 1
+        if path is None:
+            profiling.count('route_cache.misses')
+            return None
+        runs = site.free_runs()
+        start_positions = key[0]
+        if not all(runs.is_free(x, y) for x, y in path if (x, y) not in start_positions):
+            log.debug('Cached path is blocked')
+            with self.lock:
+                self.paths.pop(key, None)
+                self.stale += 1
+                self.misses += 1
+            profiling.count('route_cache.stale')
+            profiling.count('route_cache.misses')
+            return None
+        with self.lock:
+            self.hits += 1
+        profiling.count('route_cache.hits')
+        return list(path)
+
+    def put(self, key, path: List["tuple"]):
+        '''Store a path, dropping the least recently used one when full'''
+        with self.lock:
+            self.paths[key] = tuple(path)
+            self.paths.move_to_end(key)
+            while len(self.paths) > self.maxsize:
+                self.paths.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.paths.clear()
+            self.hits = self.misses = self.stale = 0
+
+    def cache_info(self) -> CacheInfo:
+        '''Return hits and misses, like functools.lru_cache'''
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.stale, self.maxsize, len(self.paths))
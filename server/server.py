@@ -1,19 +1,46 @@
+import contextvars
+import json
 import logging
+import os
+import queue
+import threading
+import time
 
-from flask import request, jsonify
+from flask import g, request, jsonify, Response
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import connexion
-import factoriocalc as fc
-import factoriocalc.presets as fcc
 
+import analyze
+import budget
 import layout
+import logging_setup
+import metrics
+import profiling
+import progress
+import route_cache
 import solver
+import tiers
 
-# Set up logging
-logging.basicConfig(filename='server.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Set up logging. Records are written to file by a separate thread.
+# FBG_LOG_LEVEL sets the overall level, and FBG_LOG_LEVELS the level per
+# module, like "solver=DEBUG,a_star_factorio=WARNING".
+logging_setup.setup_queue_logging(
+    'server.log',
+    level=os.environ.get('FBG_LOG_LEVEL', 'INFO'),
+    levels=logging_setup.parse_levels(os.environ.get('FBG_LOG_LEVELS', '')))
 logger = logging.getLogger()
 
+# Longest time a request may spend generating a blueprint, FBG_REQUEST_SECONDS.
+# Requests can ask for less.
+MAX_REQUEST_SECONDS = float(os.environ.get('FBG_REQUEST_SECONDS', '60'))
+
+# Generations reuse the paths of earlier ones, up to FBG_ROUTE_CACHE_SIZE
+# paths. 0 turns the route cache off.
+ROUTE_CACHE_SIZE = int(os.environ.get('FBG_ROUTE_CACHE_SIZE', '1024'))
+solver.use_route_cache = ROUTE_CACHE_SIZE > 0
+solver.routes = route_cache.RouteCache(ROUTE_CACHE_SIZE)
+
 # Initialize server
 app = connexion.FlaskApp(__name__)
     
@@ -28,9 +55,130 @@ app.add_middleware(
 
 app.add_api('fbg-api.yaml')
 
+# Metrics, exposed at /metrics. The registry belongs to this module, as
+# it is imported twice when run as a script.
+METRICS = metrics.Registry()
+REQUESTS = metrics.Counter('fbg_requests_total', 'HTTP requests handled', ['endpoint', 'status'], registry=METRICS)
+REQUEST_SECONDS = metrics.Histogram('fbg_request_seconds', 'HTTP request latency', ['endpoint'], registry=METRICS)
+REQUESTS_IN_PROGRESS = metrics.Gauge('fbg_requests_in_progress', 'HTTP requests being handled, waiting or running', registry=METRICS)
+STAGE_SECONDS = metrics.Histogram('fbg_stage_seconds', 'Time spent in each blueprint generation stage', ['stage'], registry=METRICS)
+ASTAR_EXPANDED = metrics.Histogram('fbg_astar_expanded_nodes', 'Nodes expanded by each A* search',
+                                   buckets=(10, 100, 1000, 10000, 100000, 1000000), registry=METRICS)
+ASTAR_SEARCHES = metrics.Counter('fbg_astar_searches_total', 'A* searches', ['result'], registry=METRICS)
+CONNECTIONS = metrics.Counter('fbg_connections_total', 'Belt connections between machines', ['result'], registry=METRICS)
+SPRING_ITERATIONS = metrics.Histogram('fbg_spring_iterations', 'Spring layout iterations for each generation',
+                                      buckets=(10, 25, 50, 100, 150, 200), registry=METRICS)
+ROUTE_CACHE_HIT_RATIO = metrics.Histogram('fbg_route_cache_hit_ratio', 'Share of paths of each generation found in the route cache',
+                                          buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 1.0), registry=METRICS)
+FAILURES = metrics.Counter('fbg_generation_failures_total', 'Failed blueprint generations', ['reason'], registry=METRICS)
+
+def lru_cache_info():
+    '''Hits and misses of the cached layout functions, and of the route
+    cache'''
+    result = {}
+    for function in [layout.factoriocalc_entity_size, layout.center_offset]:
+        info = function.cache_info()
+        result[(function.__name__, 'hit')] = info.hits
+        result[(function.__name__, 'miss')] = info.misses
+    info = solver.routes.cache_info()
+    result[('routes', 'hit')] = info.hits
+    result[('routes', 'miss')] = info.misses
+    result[('routes', 'stale')] = info.stale
+    return result
+CACHE_LOOKUPS = metrics.Counter('fbg_cache_lookups_total', 'Cache lookups', ['cache', 'result'],
+                                function=lru_cache_info, registry=METRICS)
+
+# Failure reasons, found in exception messages
+FAILURE_REASONS = {
+    'No possible path': 'no_path',
+    'Machines overlap': 'machines_overlap',
+    'already reserved': 'already_reserved',
+    'cannot go': 'underground_too_long',
+}
+
+def failure_reason(ex: Exception) -> str:
+    '''Classify a generation failure, for the failure metric'''
+    message = str(ex)
+    for text, reason in FAILURE_REASONS.items():
+        if text in message:
+            return reason
+    return type(ex).__name__
+
+def record_profile_metrics(profile: profiling.Profile):
+    '''Add the stage times and counters of a generation to the metrics'''
+    for stage, span in profile.spans.items():
+        STAGE_SECONDS.observe(span['seconds'], stage=stage)
+    for expanded in profile.samples.get('astar.expanded', []):
+        ASTAR_EXPANDED.observe(expanded)
+    searches = profile.counters.get('astar.searches', 0)
+    not_found = profile.counters.get('astar.not_found', 0)
+    ASTAR_SEARCHES.inc(searches - not_found, result='found')
+    ASTAR_SEARCHES.inc(not_found, result='not_found')
+    CONNECTIONS.inc(profile.counters.get('connections.routed', 0), result='routed')
+    CONNECTIONS.inc(profile.counters.get('connections.failed', 0), result='failed')
+    CONNECTIONS.inc(profile.counters.get('connections.overloaded', 0), result='overloaded')
+    hits = profile.counters.get('route_cache.hits', 0)
+    lookups = hits + profile.counters.get('route_cache.misses', 0)
+    if lookups:
+        ROUTE_CACHE_HIT_RATIO.observe(hits / lookups)
+    if 'spring.iterations' in profile.counters:
+        SPRING_ITERATIONS.observe(profile.counters['spring.iterations'])
+
+@app.app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    REQUESTS_IN_PROGRESS.inc()
 
-def GenerateBlueprint(blueprint_input):
-    '''This is copied from the mall_small test'''
+@app.app.after_request
+def finish_request_metrics(response):
+    if 'request_start' in g:
+        REQUESTS_IN_PROGRESS.dec()
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+
+# Game data of factoriocalc, see import_factoriocalc
+_game_info = None
+
+def import_factoriocalc():
+    '''Import factoriocalc, with its game data available in this context.
+    factoriocalc keeps the game data in a context variable, which is only
+    set in the context that imported it first, like one request thread.'''
+    global _game_info
+    import factoriocalc as fc
+    if _game_info is None:
+        _game_info = fc.config.gameInfo.get()
+    elif fc.config.gameInfo.get(None) is None:
+        fc.config.gameInfo.set(_game_info)
+    return fc
+
+def warm_up():
+    '''Import the slow modules and load the game data, so the first request
+    is as fast as the rest'''
+    start = time.perf_counter()
+    fc = import_factoriocalc()
+    import factoriocalc.presets as fcc
+    import networkx
+    fc.config.machinePrefs.set(fcc.MP_LATE_GAME)
+    fc.config.machinePrefs.set([fc.mch.AssemblingMachine2()])
+    fc.produce([fc.itm.electronic_circuit @ 1], using=[fc.itm.iron_plate, fc.itm.copper_plate], roundUp=True)
+    for kind in layout.MACHINES_WITH_RECIPE:
+        layout.entity_size(kind)
+    logger.info(f'Warmed up in {time.perf_counter() - start:.3f} s')
+
+def GenerateBlueprint(blueprint_input, reporter: progress.Progress = None, overloads: list = None):
+    '''This is copied from the mall_small test
+
+    :param reporter:  Receives the progress of the generation
+    :param overloads:  List that receives the belts and inserters that
+        carry less than their connection, as tiers.Overload
+    '''
+    fc = import_factoriocalc()
+    import factoriocalc.presets as fcc
+    if reporter is None:
+        reporter = progress.Progress()
     try:
         logger.info('Starting blueprint generation process')
         logger.debug('Initializing game configuration')
@@ -49,33 +197,91 @@ def GenerateBlueprint(blueprint_input):
         logger.debug('Generating blueprint')
 
         # Machines for construction - assembly types & smelting type
-        factory = fc.produce(
-            [desired_output @ throughput], using=input_items, roundUp=True
-        ).factory
+        with profiling.span('solve'):
+            reporter.stage('solve')
+            factory = fc.produce(
+                [desired_output @ throughput], using=input_items, roundUp=True
+            ).factory
 
+        # A bounded site, as the route cache, connectivity and chunk graph
+        # need one
         site = layout.ConstructionSite(WIDTH, HEIGHT)
         machines = solver.randomly_placed_machines(factory, site.size())
-        solver.add_connections(machines)
+        with profiling.span('add_connections'):
+            reporter.stage('add_connections')
+            solver.add_connections(machines)
 
-        solver.spring(machines, borders=((0, 0), (WIDTH, HEIGHT)))
-        logger.debug("Machines are at: " + str([machine.position for machine in machines]))
+        with profiling.span('spring'):
+            reporter.stage('spring')
+            solver.spring(machines, iteration_visitor=reporter.spring_iteration, borders=((0, 0), (WIDTH, HEIGHT)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Machines are at: " + str([machine.position for machine in machines]))
 
-        solver.machines_to_int(machines)
-        logger.debug("Machines as integers are at: " + str([machine.position for machine in machines]))
+        with profiling.span('machines_to_int'):
+            reporter.stage('machines_to_int')
+            solver.machines_to_int(machines)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Machines as integers are at: " + str([machine.position for machine in machines]))
 
         logger.debug("Placing on site")
-        solver.place_on_site(site, machines, None)
-        logger.debug(str(site))
+        with profiling.span('place_on_site'):
+            reporter.stage('place_on_site')
+            try:
+                report = solver.place_on_site(site, machines, reporter.path_visualizer(), progress=reporter.connection)
+            except budget.TimeBudgetExceeded as ex:
+                # The machines and connections routed so far
+                ex.details['partial_blueprint'] = layout.site_as_blueprint_string(site, label="partial blueprint")
+                raise
+        logger.debug('%s', site)
+        if overloads is not None:
+            overloads.extend(report)
 
-        blueprint_string = layout.site_as_blueprint_string(site, label="test of blueprint code")
-        logger.debug(f"Generated following blueprint string: {blueprint_string}")
+        with profiling.span('export'):
+            reporter.stage('export')
+            blueprint_string = layout.site_as_blueprint_string(site, label="test of blueprint code")
+        logger.debug('Generated following blueprint string: %s', blueprint_string)
         logger.info('Completed blueprint generation process')
 
         return f"Blueprint generation complete: {blueprint_string}"
+    except budget.Cancelled:
+        raise
     except Exception as e:
         logger.error(e)
+        FAILURES.inc(reason=failure_reason(e))
         return f"failed to {e}"
 
+def request_time_budget(seconds=None) -> float:
+    '''Time budget of a request: the requested seconds, but no more than
+    the server allows'''
+    if seconds is None:
+        return MAX_REQUEST_SECONDS
+    return min(seconds, MAX_REQUEST_SECONDS)
+
+def run_generation(input_string, seconds, reporter=None, job_budget=None, endpoint='process'):
+    '''Generate a blueprint within a time budget, and record its profile
+
+    :param job_budget:  Budget to use, so it can be cancelled from another
+        thread. By default a new one of the given seconds.
+    :return:  (output string or None, TimeBudgetExceeded or None, profile,
+        overloads as dicts)
+    '''
+    output_string = None
+    overloads = []
+    timeout = None
+    with profiling.profile() as profile:
+        try:
+            with budget.limit(job_budget or budget.Budget(seconds)):
+                with profiling.span('generate'):
+                    blueprint_output = GenerateBlueprint(input_string, reporter, overloads)
+            output_string = f"Hi again! {blueprint_output} input: {input_string}"
+        except budget.TimeBudgetExceeded as ex:
+            logger.warning(f'Generation stopped: {ex}')
+            FAILURES.inc(reason='timeout')
+            timeout = ex
+    profiling.log_profile(profile, logger, endpoint=endpoint)
+    record_profile_metrics(profile)
+    return output_string, timeout, profile, [tiers.overload_as_dict(overload) for overload in overloads]
+
 #@app.route('/process', methods=['POST'])
 # with Connexion, the fbg-api.yaml file specifies how to route endpoints to functions 
 def process_string():
@@ -85,27 +291,91 @@ def process_string():
         return jsonify({'error': 'No input string provided'}), 400
 
     # Process the input string
-    blueprint_output = GenerateBlueprint(input_string)
-    output_string = f"Hi again! {blueprint_output} input: {input_string}"
+    output_string, timeout, profile, overloads = run_generation(input_string, request_time_budget(data.get('time_budget')))
+    if timeout is not None:
+        return jsonify({'error': str(timeout), 'timeout': timeout.as_dict(), 'profile': profile.as_dict()}), 503
+
+    return jsonify({'output_string': output_string, 'profile': profile.as_dict(), 'overloads': overloads})
+
+def server_sent_event(event: dict) -> str:
+    '''Format an event dict as a server-sent event'''
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+def process_string_stream(input_string, time_budget=None):
+    '''Generate a blueprint, streaming progress as server-sent events.
+    The last event is "result", with the same members as the response of
+    /process, or "timeout". Closing the stream cancels the generation.'''
+    events = queue.SimpleQueue()
+    job_budget = budget.Budget(request_time_budget(time_budget))
+
+    def generate():
+        try:
+            output_string, timeout, profile, overloads = run_generation(
+                input_string, None, progress.Progress(events.put), job_budget, endpoint='process-stream')
+        except budget.Cancelled as ex:
+            logger.info(f'Generation cancelled: {ex}')
+            return
+        if timeout is not None:
+            events.put(dict(event='timeout', **timeout.as_dict(), profile=profile.as_dict()))
+        else:
+            events.put(dict(event='result', output_string=output_string, profile=profile.as_dict(),
+                            overloads=overloads))
+        events.put(None)
+
+    def stream():
+        try:
+            while (event := events.get()) is not None:
+                yield server_sent_event(event)
+        finally:
+            # Reached on normal end, and when the client disconnects
+            job_budget.cancel('Progress stream was closed')
 
-    return jsonify({'output_string': output_string})
+    # Generation runs in its own thread, as the progress hooks are called
+    # deep inside it. The thread gets the context of the request, as new
+    # threads start with an empty one.
+    threading.Thread(target=contextvars.copy_context().run, args=(generate,), daemon=True).start()
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 def find_blueprint_flow():
     data = request.json
     blueprint_export_string = data.get('input_string')
     if not blueprint_export_string:
         return jsonify({'error': 'No input string provided'}), 400
-    # TODO call analyze.extract_flow_from_blueprint(blueprint_export_string)
-    # Mock result is for an input area with a single assembling machine 1, with recipe "inserter"
-    result = {
-        'inputs':
-            [dict(kind='electronic-circuit', rate=1/60),
-             dict(kind='iron-gear-wheel', rate=1/60),
-             dict(kind='iron-plate', rate=1/60)],
-        'outputs':
-            [dict(kind='inserter', rate=1/60)],
-    }
+    try:
+        G = analyze.extract_flow_from_exchange_string(blueprint_export_string)
+        result = analyze.flow_report(G)
+    except ValueError as e:
+        logger.info(f'Flow analysis failed: {e}')
+        return jsonify({'error': str(e)}), 400
     return jsonify(result)
 
+def get_log_levels():
+    '''Log levels of the root logger and the modules that have their own'''
+    return jsonify(logging_setup.get_levels())
+
+def set_log_levels():
+    '''Change log levels per module, while the server runs'''
+    levels = request.json
+    if not isinstance(levels, dict):
+        return jsonify({'error': 'Expected an object from logger name to level'}), 400
+    try:
+        logging_setup.set_levels(levels)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    logger.info(f'Log levels changed: {levels}')
+    return jsonify(logging_setup.get_levels())
+
+def get_metrics():
+    '''Metrics in the Prometheus text format'''
+    return metrics.render(METRICS), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+# Worker processes warm up before they handle requests
+if os.environ.get('FBG_WARM') == '1' and __name__ != '__main__':
+    warm_up()
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    # FBG_WORKERS worker processes are started, that each import this
+    # module as "server" and warm up, unless FBG_WARM is 0
+    os.environ.setdefault('FBG_WARM', '1')
+    app.run('server:app', host='0.0.0.0', port=5000, workers=int(os.environ.get('FBG_WORKERS', '1')))
@@ -7,18 +7,27 @@ amount of space in Factorio.
 import logging
 import math
 import random
-from typing import List, Dict
+from typing import List, Dict, TYPE_CHECKING
 
 # Third party imports
-from factoriocalc import Machine, Item
+if TYPE_CHECKING:
+    # factoriocalc is slow to import, and only needed by its callers
+    from factoriocalc import Machine
 
 # First party imports
 from vector import Vector
-from a_star_factorio import A_star
+from a_star_factorio import A_star, UNDERGROUND_MAX_GAP, find_path_bidirectional, is_belt_path
 
 from layout import ConstructionSite
 
+import budget
+import connectivity
+import hierarchy
 import layout
+import nets
+import profiling
+import route_cache
+import windowed
 
 
 #
@@ -54,6 +63,8 @@ class FactoryNode:
         self.position = position
         self.input_nodes = []
         self.output_nodes = []
+        # Items per second taken from each input node, by item
+        self.input_rates = {}
         self.missing_input = dict(item_input)
         self.unused_output = dict(item_output)
 
@@ -133,6 +144,7 @@ class FactoryNode:
             flow_rate = min(source.unused_output[item_type],
                             target.missing_input[item_type])
             flow_sum += flow_rate
+            change_key_value(target.input_rates.setdefault(source, {}), item_type, flow_rate)
             source.change_flow_request('output', item_type, -flow_rate)
             target.change_flow_request('input', item_type, -flow_rate)
         assert flow_sum > 0
@@ -187,7 +199,7 @@ class Port(FactoryNode):
 class LocatedMachine(FactoryNode):
     "A data class to store a machine and its position"
 
-    def __init__(self, machine: Machine, position=None):
+    def __init__(self, machine: 'Machine', position=None):
         # Items pr second - True to make it calculate actual value.
         flow_by_item = machine.flows(True).byItem
 
@@ -262,7 +274,7 @@ def add_connections(machines: List[LocatedMachine]):
             if connection_count >= 4:
                 del port_for[item_type]
         if item_type not in port_for:
-            log.debug(f'Create Port for {item_type}')
+            log.debug('Create Port for %s', item_type)
             new_ports.append(Port(pos))
             port_for[item_type] = new_ports[-1]
         return port_for[item_type]
@@ -391,7 +403,14 @@ def spring_1(
 
         if max_dist < iteration_threshold:
             break
+        if budget.expired():
+            # The positions so far are a usable layout
+            log.info('Spring layout stopped after %d iterations, out of time', iteration_no + 1)
+            profiling.count('spring.out_of_time')
+            break
 
+    profiling.count('spring.iterations', iteration_no + 1)
+    profiling.value('spring.movement', max_dist)
     return machines
 
 # Select which spring function to use
@@ -404,7 +423,7 @@ else:
 
 def find_machine_with_unused_output(machines: List[LocatedMachine], item_type):
     '''Find a machine with excess production'''
-    log.debug("looking for machine that has unused " + str(item_type))
+    log.debug('looking for machine that has unused %s', item_type)
 
     # Each candidate is a pair (unused_output, machine)
     machine_candidates = [(m.unused_output[item_type], m)
@@ -412,25 +431,65 @@ def find_machine_with_unused_output(machines: List[LocatedMachine], item_type):
             if m.unused_output.get(item_type, 0) > 0]
 
     if len(machine_candidates) == 0:
-        log.debug(f" no machine has unused {item_type}")
+        log.debug(' no machine has unused %s', item_type)
         return None
 
     unused_output = lambda candidate: candidate[0]
     return min(machine_candidates, key=unused_output)[1]
 
 
+def spread_machines(machines: List[LocatedMachine], gap=3) -> float:
+    """
+    Move machines apart from their common center, all by the same factor, so
+    that the spring layout is kept, and there are at least gap tiles between
+    any two machines, also after machines_to_int. Spring layout pulls
+    connected machines close, and can leave them overlapping.
+
+    Machines at the same center stay there.
+
+    :returns: The factor the distances from the center are scaled by, at
+        least 1
+    """
+    centers = [machine.center() for machine in machines]
+    scale = 1
+    for i, a in enumerate(machines):
+        for j in range(i):
+            b = machines[j]
+            # Rounding to int can take a tile off the gap
+            needed = [(a.size()[d] + b.size()[d]) / 2 + gap + 1 for d in range(2)]
+            offset = [abs(centers[i][d] - centers[j][d]) for d in range(2)]
+            if offset == [0, 0]:
+                continue
+            # Apart along either axis is enough
+            scale = max(scale, min(needed[d] / offset[d] if offset[d] > 0 else math.inf for d in range(2)))
+    if scale > 1:
+        center = sum(centers, Vector(0, 0)) / len(centers)
+        for machine, machine_center in zip(machines, centers):
+            machine.move((machine_center - center) * (scale - 1))
+    profiling.value('spread.scale', scale)
+    return scale
+
 def machines_to_int(machines: List[LocatedMachine]):
     "Assumes that the machines are not overlapping in any way"
     for machine in machines:
         machine.position = machine.position.as_int()
 
 
-def place_on_site(site: 'ConstructionSite', machines: List[LocatedMachine], path_visiualizer = None):
+def place_on_site(site: 'ConstructionSite', machines: List[LocatedMachine], path_visiualizer = None,
+                  progress=None):
     """
     Place machines on the construction site
 
-    :param site:  A ConstructionSite that is sufficiently large
+    :param site:  A ConstructionSite that is sufficiently large, or an
+        unbounded one
     :param machines:  A list of LocatedMachine
+    :param progress:  Function called with (routed, total) after each
+        connection is routed
+    :returns:  The belts and inserters that carry less than the items per
+        second of their connection, as tiers.Overload
+    :raises budget.TimeBudgetExceeded:  When the active time budget runs
+        out. Connections routed so far stay on the site, and the one that
+        failed is rolled back.
     """
     for lm in machines:
         if hasattr(lm, 'machine'):
@@ -438,17 +497,67 @@ def place_on_site(site: 'ConstructionSite', machines: List[LocatedMachine], path
             site.add_entity(machine.name, lm.position, 0, machine.recipe.name)
         else:
             site.add_entity(lm.name, lm.position, 0)
-    for target in machines:
-        for source in target.getConnections():
-            try:
+    net_list = nets.find_nets(machines, use_belt_sharing)
+    total = sum(len(net.targets) for net in net_list)
+    routed = 0
+    # Long belts on large sites are routed over chunks, which are kept up to
+    # date as belts are placed
+    chunks = None
+    if site.is_bounded() and min(site.size()) >= hierarchy_min_side:
+        chunks = hierarchy.ChunkGraph(site)
+    # Machines that no belt can join are found without a search. All
+    # machines of an unbounded site can be joined around what is built.
+    components = None
+    if site.is_bounded():
+        components = connectivity.Components(site)
+    def connect(source, target, trunk, belt, inserter, source_inserter):
+        nonlocal routed
+        budget.check('place_on_site', routed=routed, total=total)
+        try:
+            # Drawing the site is slow, so only do it when it will be logged
+            before_string = None
+            if log.isEnabledFor(logging.DEBUG):
                 before_string = layout.site_to_test(site, source, target)
-                connect_machines(site, source, target, visualizer=path_visiualizer)
-            except Exception as ex:
-                log.error(ex)
-                log.debug("Error was thrown at place on site, this is the scenario")
-                log.debug(before_string)
-                log.debug('This is the exception traceback', exc_info=True)
-                raise
+            # A connection that fails leaves the site as it was
+            with site.transaction():
+                entities = connect_machines(site, source, target, visualizer=path_visiualizer, inserter=inserter,
+                                            belt=belt, chunks=chunks, components=components, trunk=trunk,
+                                            source_inserter=source_inserter)
+            profiling.count('connections.routed')
+        except budget.TimeBudgetExceeded as ex:
+            ex.details.update(routed=routed, total=total)
+            raise
+        except budget.Cancelled:
+            raise
+        except Exception as ex:
+            profiling.count('connections.failed')
+            log.error(ex)
+            log.debug("Error was thrown at place on site, this is the scenario")
+            log.debug(before_string)
+            log.debug('This is the exception traceback', exc_info=True)
+            raise
+        routed += 1
+        if progress:
+            progress(routed, total)
+        return entities
+
+    # Belts and inserters of the tiers that carry the items of each connection
+    belt, inserter = (None, None) if use_tier_selection else ("transport-belt", "inserter")
+    report = []
+    for net in net_list:
+        report += nets.route(net, lambda target, *args: connect(net.source, target, *args), belt, inserter)
+    if chunks is not None:
+        chunks.close()
+    if components is not None:
+        components.close()
+    for overload in report:
+        profiling.count('connections.overloaded')
+        log.debug('%s %s at %s from %s to %s carries %.2f of %.2f items/s', overload.role, overload.kind,
+                  overload.position, overload.source.position, overload.target.position,
+                  overload.capacity, overload.rate)
+    if report:
+        log.info(f'{len(report)} belts and inserters carry less than their connection')
+    return report
 
 
 
@@ -459,7 +568,11 @@ def connect_machines(
     visualizer=None,
     inserter="inserter",
     belt="transport-belt",
-):
+    chunks=None,
+    components=None,
+    trunk=None,
+    source_inserter=None,
+) -> List[dict]:
     """Connect two machines by adding a transport belt to the
     construction site.
 
@@ -469,14 +582,69 @@ def connect_machines(
     :param visualizer: Path visualizer, forwarded to find_path
     :param inserter: Type of inserter to use
     :param belt: Type of belt to use
+    :param chunks: A hierarchy.ChunkGraph of the site, forwarded to find_path
+    :param components: A connectivity.Components of the site, forwarded to
+        find_path
+    :param trunk: Entities of a belt from source, as returned for another
+        target but for the inserter at that target. The belt is extended to target, which takes items off it
+        with an inserter, or a new belt is added when it cannot be.
+    :param source_inserter: Type of inserter at source, by default inserter
+    :returns: The entities of the belt from source, up to and with the
+        inserter at target
     """
     # Check for unsupported configuration
     if target.overlaps(source):
         raise ValueError("Machines overlap")
+    if trunk:
+        try:
+            with site.transaction():
+                return extend_belt(site, source, target, trunk, visualizer, inserter, belt, chunks, components,
+                                   source_inserter)
+        except ValueError as ex:
+            log.debug(f'Belt not extended: {ex}')
+            profiling.count('nets.fallbacks')
     # Find an open path between machines
-    pos_list = find_path(site, source, target, path_visualizer = visualizer)
-    if len(pos_list) == 0:
+    pos_list = find_path(site, source, target, path_visualizer = visualizer, chunks=chunks,
+                         components=components, belt=belt)
+    if not pos_list:
         raise ValueError("No possible path")
+    return place_belt(site, pos_list, inserter, belt, source_inserter=source_inserter)
+
+def extend_belt(site: ConstructionSite, source: FactoryNode, target: FactoryNode, trunk: List[dict],
+                visualizer=None, inserter="inserter", belt="transport-belt", chunks=None,
+                components=None, source_inserter=None) -> List[dict]:
+    """Extend a belt from source to target, see connect_machines
+
+    :raises ValueError:  When the end of the belt cannot reach target
+    """
+    end = trunk[-1]['pos']
+    # The belt may not turn back onto itself
+    start = ([end], {end: [entity['pos'] for entity in trunk[-2:-1]]}, {})
+    if len(trunk) > 2:
+        # The belt comes to its end from the tile before, not an inserter
+        (px, py), (x, y) = trunk[-2]['pos'], end
+        distance = abs(x - px) + abs(y - py)
+        start[2][end] = (((x - px) // distance, (y - py) // distance), distance > 1)
+    pos_list = find_path(site, source, target, path_visualizer = visualizer, chunks=chunks,
+                         components=components, belt=belt, start=start)
+    if not pos_list:
+        raise ValueError("No possible path")
+    pos_list = [entity['pos'] for entity in trunk] + pos_list[1:]
+    # The search does not know how the belt comes to its end
+    if not is_belt_path(pos_list[1:-1], reach=UNDERGROUND_MAX_GAP[belt] + 2):
+        raise ValueError(f'Path from {end} does not join the belt')
+    return place_belt(site, pos_list, inserter, belt, trunk, source_inserter)
+
+def place_belt(site: ConstructionSite, pos_list: List[tuple], inserter="inserter",
+               belt="transport-belt", placed=(), source_inserter=None) -> List[dict]:
+    """Add the inserters at both ends of a path, and belts between them,
+    to the construction site
+
+    :param placed: Entities of the first positions that are on the site
+        already. Their kind and direction are updated.
+    :param source_inserter: Type of the first inserter, by default inserter
+    :returns: The entities, in the order of the path
+    """
     assert len(pos_list) >= 3, "Path below length 3 is not supported"
     # Find proper orientation of belt cells
     dir_list = []
@@ -504,9 +672,12 @@ def connect_machines(
     # First and last is inserter, rest is transport belt
     kind_list = [inserter if i == 0 or i + 1 == len(dir_list) else belt
             for i, _ in enumerate(pos_list)]
+    if source_inserter is not None:
+        kind_list[0] = source_inserter
+    inserters = {kind_list[0], kind_list[-1]}
     # Convert kind to underground input or output when there is a gap
     for i, kind in enumerate(kind_list):
-        if kind == inserter: continue
+        if kind in inserters: continue
         underground_length = step_size(i) - 1
         if underground_length > 0:
             # Check max length underground
@@ -525,23 +696,68 @@ def connect_machines(
             dir_list[i] = dir_list[i-1] # if inserter on the side
 
     # Add belt and inserters to site
+    entities = list(placed)
     for i in range(len(dir_list)):
         kind = kind_list[i]
         dir = dir_list[i]
         kwarg = dict()
-        if kind == inserter:
+        if kind in inserters:
             dir = (dir + 4) % 8
         if kind == underground_belt:
             kwarg['type'] = 'input' if step_size(i) == 1 else 'output'
-        log.debug(f'{kind} at {pos_list[i]} dir {dir} type {kwarg.get("type")}')
+        log.debug('%s at %s dir %s type %s', kind, pos_list[i], dir, kwarg.get('type'))
+        if i < len(placed):
+            site.update_entity(placed[i], kind=kind, direction=dir, type=kwarg.get('type'))
+            continue
         site.add_entity(kind, pos_list[i], dir, **kwarg)
-
+        entities.append(site.entities[-1])
+    return entities
+
+
+# Path finding heuristic, one of a_star_factorio.HEURISTICS
+route_heuristic = 'manhattan'
+# Path finding searches from both machines at once
+use_bidirectional = False
+# Path finding tracks the heading of belts, see A_star.find_path_directional
+use_directional_search = True
+# The directional search expands straight runs of free tiles in one step,
+# see A_star.jump
+use_straight_runs = True
+# Paths found before are reused for the same search on the same tiles, see
+# route_cache. Searches with a path visualizer that draws are always run.
+use_route_cache = False
+routes = route_cache.RouteCache()
+# Path finding searches a window around the machines first, and grows it
+# until a path is found, see windowed. Searches with a path visualizer
+# that draws cover the whole site.
+use_windowed_search = True
+# Machines that take the same item from a machine share one belt, which
+# passes each of them in turn, see nets
+use_belt_sharing = True
+# Belts and inserters are of the cheapest tiers that carry the items of a
+# connection, see tiers. Otherwise transport belts and inserters.
+use_tier_selection = True
+# Sites at least this wide and high are routed on a hierarchy of chunks
+hierarchy_min_side = 512
+
+def draws_path(path_visualizer) -> bool:
+    '''Whether a path visualizer draws the search, so the search must be
+    run on the whole site. Visualizers without a member "draws" do.'''
+    return path_visualizer is not None and getattr(path_visualizer, 'draws', True)
 
 def find_path(
     site: ConstructionSite,
     source: FactoryNode,
     target: FactoryNode,
-    path_visualizer=None
+    path_visualizer=None,
+    heuristic=None,
+    bidirectional=None,
+    chunks=None,
+    directional=None,
+    components=None,
+    belt="transport-belt",
+    start=None,
+    straight_runs=None,
 ) -> List[tuple]:
     """Generates a list of coordinates, to walk from one machine to the other
 
@@ -549,13 +765,29 @@ def find_path(
     :param source: Source machine
     :param target: Target machine
     :param path_visualizer: Visualizer forwarded to fac_finder.find_path
+    :param heuristic: Path finding heuristic, one of a_star_factorio.HEURISTICS.
+        None uses route_heuristic.
+    :param bidirectional: Search from both machines until the searches meet.
+        None uses use_bidirectional.
+    :param chunks: A hierarchy.ChunkGraph of the site. The route is planned
+        on the chunks first, and the whole site is only searched when that
+        fails.
+    :param directional: Search tiles by the heading of the belt on them, so
+        a tile reached in the wrong heading does not hide the path. None uses
+        use_directional_search, unless searching from both machines.
+    :param components: A connectivity.Components of the site. Machines
+        that no belt can join are rejected without a search.
+    :param belt: Tier of belt, which sets the longest underground belt.
+        Only the search of the whole site uses longer underground belts
+        than those of transport belts.
+    :param start: (positions, illegal neighbors, headings) where the path
+        starts instead of the tiles around source, like the end of a belt
+        that is extended, with the headings of the belt as A_star
+        start_headings. No inserter is added at the start then.
+    :param straight_runs: Expand straight runs of free tiles in one step in
+        the directional search. None uses use_straight_runs.
     :returns: a list of site coordinates between the two machines
     """
-    #TODO - rewrite this, as we don't need an entire map anymore
-    map = []
-    BLOCKED = 0
-    NORMAL = 1
-    EXPENSIVE = 2
     # TODO - make inserter nodes expensive to hint at undergrounding under those, to
     # enable that scenarioes like
     # x x e o o x
@@ -566,11 +798,8 @@ def find_path(
     # x x b b b x
     # s u i u b x
     # a a a x x x
-    for r in range(site.size()[1]):
-        row = []
-        for c in range(site.size()[0]):
-            row.append(BLOCKED if site.is_reserved(c, r) else NORMAL)
-        map.append(row)
+    def is_free(x, y):
+        return site.in_bounds(x, y) and not site.is_reserved(x, y)
 
     # Make source and target machines expensive, but not impossible to travel
     # For each direction in the two dimensions, create starting squares
@@ -580,11 +809,10 @@ def find_path(
         an entry list and list of dictionaries. The entry list will be appended the square
         where the inserter picks up from, and the illegal list the
         square where the inserter is placed for this to be possible.'''
-        x, y = inserter_pos
-        if not is_in_bounds(x, y, map) or map[y][x] == BLOCKED:
+        if not is_free(*inserter_pos):
             return
         x, y = (Vector(*inserter_pos) + Vector(*step)).values
-        if not is_in_bounds(x, y, map) or map[y][x] == BLOCKED:
+        if not is_free(x, y):
             return
         entry_list.append((x,y))
         if illegal_coordinate_dictionary.get((x,y)):
@@ -599,6 +827,10 @@ def find_path(
     # On all sides of source and target, add possible start/end squares.
     # TODO add support for longhanded inserters.
     for i, m in enumerate([source, target]):
+        if i == 0 and start is not None:
+            fac_coordinates[0] = list(start[0])
+            illegal_coordinates_dicts[0] = dict(start[1])
+            continue
         pos = m.position.as_int()
 
         for row in range(m.size()[1]):
@@ -630,11 +862,66 @@ def find_path(
             log.debug(f"Could not find any valid {'start' if i == 0 else 'end'} square")
             return None
 
-    fac_finder = A_star(site,fac_coordinates[0],fac_coordinates[1], illegal_coordinates_dicts[0], illegal_coordinates_dicts[1])
-    fac_path = fac_finder.find_path(True, path_visualizer)
-    log.debug("nodecount: " + str(len(fac_path)))
-    for node in fac_path:
-        log.debug(node)
+    start_tiles = fac_coordinates[0]
+    if components is not None and start is not None:
+        # The start of a belt that is extended is reserved
+        start_tiles = [tile for position in start_tiles for tile in components.hop_neighbors(*position)]
+    if (components is not None and components.reach >= UNDERGROUND_MAX_GAP[belt] + 2
+            and not components.connected(start_tiles, fac_coordinates[1])):
+        log.debug("Machines are in different components of the site")
+        profiling.count('connectivity.rejected')
+        return None
+
+    if heuristic is None:
+        heuristic = route_heuristic
+    if bidirectional is None:
+        bidirectional = use_bidirectional
+    if directional is None:
+        directional = use_directional_search and not bidirectional
+    if straight_runs is None:
+        straight_runs = use_straight_runs
+    fac_path = None
+    cache_key = None
+    if use_route_cache and not draws_path(path_visualizer) and site.is_bounded():
+        cache_key = routes.key(site, fac_coordinates[0], fac_coordinates[1], belt, heuristic, bidirectional, directional,
+                               straight_runs, chunks is not None, start and tuple(sorted(start[2].items())))
+        fac_path = routes.get(site, cache_key)
+    if fac_path is None and chunks is not None:
+        fac_path = hierarchy.find_path(chunks, fac_coordinates[0], fac_coordinates[1],
+                                       illegal_coordinates_dicts[0], illegal_coordinates_dicts[1],
+                                       heuristic, directional, straight_runs)
+        if fac_path is None:
+            profiling.count('hierarchy.fallbacks')
+    if fac_path is None and not site.is_bounded():
+        # Only windows of an unbounded site can be searched
+        fac_path = windowed.find_path(site, fac_coordinates[0], fac_coordinates[1],
+                                      illegal_coordinates_dicts[0], illegal_coordinates_dicts[1],
+                                      belt, heuristic, directional,
+                                      start_headings=start and start[2],
+                                      visualizer=None if draws_path(path_visualizer) else path_visualizer,
+                                      straight_runs=straight_runs)
+    elif fac_path is None and bidirectional:
+        fac_path = find_path_bidirectional(site, fac_coordinates[0], fac_coordinates[1],
+                                           illegal_coordinates_dicts[0], illegal_coordinates_dicts[1],
+                                           True, path_visualizer, heuristic)
+    elif fac_path is None and use_windowed_search and not draws_path(path_visualizer):
+        fac_path = windowed.find_path(site, fac_coordinates[0], fac_coordinates[1],
+                                      illegal_coordinates_dicts[0], illegal_coordinates_dicts[1],
+                                      belt, heuristic, directional,
+                                      start_headings=start and start[2], visualizer=path_visualizer,
+                                      straight_runs=straight_runs)
+    elif fac_path is None:
+        fac_finder = A_star(site,fac_coordinates[0],fac_coordinates[1], illegal_coordinates_dicts[0], illegal_coordinates_dicts[1],
+                            belt, start and start[2])
+        fac_path = fac_finder.find_path(True, path_visualizer, heuristic, directional, straight_runs)
+    if fac_path is None:
+        return None
+    if cache_key is not None:
+        routes.put(cache_key, fac_path)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'nodecount: {len(fac_path)}')
+        for node in fac_path:
+            log.debug(node)
 
     # Add inserter at both ends of path
     sign = lambda x: 1 if x > 0 else -1
@@ -651,7 +938,8 @@ def find_path(
         return (next_pos[0], next_pos[1])
     xypath = fac_path
     if len(xypath) > 0:
-        xypath.insert(0, step_towards(source, xypath[0]))
+        if start is None:
+            xypath.insert(0, step_towards(source, xypath[0]))
         xypath.append(step_towards(target, xypath[-1]))
 
     return xypath
@@ -1 +1,9 @@
 from .direction import *
+from .heuristic import *
+from .bidirectional import *
+from .chunks import *
+from .directional import *
+from .components import *
+from .windows import *
+from .lazy_nodes import *
+from .straight_runs import *
@@ -0,0 +1,95 @@
+'''
+Searching from both ends at once must find paths that can be built, as
+short as those of the forward search, with fewer expansions on long routes
+through cluttered sites.
+'''
+
+import logging
+import random
+import unittest
+
+import a_star_factorio
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+class TestBidirectional(unittest.TestCase):
+    '''Bidirectional path finding'''
+
+    def find_path(self, site, source, target, bidirectional):
+        with profiling.profile() as profile:
+            path = solver.find_path(site, source, target, bidirectional=bidirectional,
+                                    directional=False)
+        log.debug(f'bidirectional={bidirectional} {profile.counters} {path}')
+        self.assertIsNotNone(path)
+        # Without the inserters at both ends
+        self.assertTrue(a_star_factorio.is_belt_path(path[1:-1]), path)
+        return path, profile.counters['astar.expanded']
+
+    def test_belt_path(self):
+        self.assertTrue(a_star_factorio.is_belt_path([(0, 0), (1, 0), (5, 0), (6, 0), (6, 1)]))
+        # Underground belts are entered and left in line
+        self.assertFalse(a_star_factorio.is_belt_path([(1, 1), (1, 0), (5, 0), (6, 0)]))
+        self.assertFalse(a_star_factorio.is_belt_path([(0, 0), (1, 0), (5, 0), (5, 1)]))
+        # The exit of one underground belt is not the entry of the next
+        self.assertFalse(a_star_factorio.is_belt_path([(0, 0), (1, 0), (5, 0), (9, 0), (10, 0)]))
+        self.assertFalse(a_star_factorio.is_belt_path([(0, 0), (6, 0)]))
+        self.assertFalse(a_star_factorio.is_belt_path([(0, 0), (1, 0), (0, 0)]))
+        self.assertFalse(a_star_factorio.is_belt_path([(0, 0), (1, 0)], [(1, 0)]))
+
+    def test_inserters(self):
+        '''The path goes around the inserters at both ends'''
+        site = layout.ConstructionSite(5, 5)
+        start_illegal = {(2, 2): [(2, 1)]}
+        end_illegal = {(2, 0): [(1, 0)]}
+        path = a_star_factorio.find_path_bidirectional(
+            site, [(2, 2)], [(2, 0)], start_illegal, end_illegal, underground_belts=True)
+        self.assertEqual(path, [(2, 2), (3, 2), (3, 1), (3, 0), (2, 0)])
+
+    def test_open_site(self):
+        '''As short a path on an open site'''
+        side = 48
+        site = layout.ConstructionSite(side, side)
+        source = solver.FakeMachine(Vector(1, 1), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(side - 4, side - 4), MACHINE_SIZE)
+        path, _ = self.find_path(site, source, target, bidirectional=False)
+        both_path, _ = self.find_path(site, source, target, bidirectional=True)
+        self.assertEqual(len(both_path), len(path))
+
+    def test_cluttered_site(self):
+        '''Fewer expansions on a long route through scattered obstacles'''
+        side = 32
+        site = layout.ConstructionSite(side, side)
+        source = solver.FakeMachine(Vector(1, 1), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(side - 4, side - 4), MACHINE_SIZE)
+        keep_free = set()
+        for m in [source, target]:
+            x0, y0 = m.position.as_int()
+            keep_free.update((x, y) for x in range(x0 - 1, x0 + 4) for y in range(y0 - 1, y0 + 4))
+        rng = random.Random(1)
+        for y in range(side):
+            for x in range(side):
+                if (x, y) not in keep_free and rng.random() < 0.3:
+                    site.add_entity(WOOD_CHEST, (x, y), 0)
+        path, expanded = self.find_path(site, source, target, bidirectional=False)
+        both_path, both_expanded = self.find_path(site, source, target, bidirectional=True)
+        self.assertLessEqual(len(both_path), len(path))
+        self.assertLess(both_expanded * 2, expanded)
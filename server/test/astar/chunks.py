@@ -0,0 +1,103 @@
+'''
+Routes planned over chunks of the site, then refined within each chunk,
+must be paths that can be built. The chunk graph follows tiles reserved on
+the site.
+'''
+
+import logging
+import unittest
+
+import a_star_factorio
+import hierarchy
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+class TestHierarchy(unittest.TestCase):
+    '''Hierarchical path finding'''
+
+    def test_entrances(self):
+        '''Runs of free tiles along a border get entrances'''
+        site = layout.ConstructionSite(16, 8)
+        graph = hierarchy.ChunkGraph(site, chunk_size=8)
+        self.assertEqual(graph.borders[((0, 0), (1, 0))], [((7, 4), (8, 4))])
+        self.assertNotIn(((0, 0), (0, 1)), graph.borders)
+        # Reserved tiles split a run, and update the entrances
+        site.add_entity(WOOD_CHEST, (8, 3), 0)
+        site.add_entity(WOOD_CHEST, (7, 4), 0)
+        self.assertEqual(graph.borders[((0, 0), (1, 0))], [((7, 4), (8, 4))])
+        graph.update()
+        self.assertEqual(graph.borders[((0, 0), (1, 0))], [((7, 1), (8, 1)), ((7, 6), (8, 6))])
+        self.assertEqual(sorted(graph.entrances[(1, 0)]), [(8, 1), (8, 6)])
+        graph.close()
+        site.add_entity(WOOD_CHEST, (8, 6), 0)
+        self.assertFalse(graph.dirty)
+
+    def test_route(self):
+        '''A route through a gap in a wall across the site'''
+        side = 96
+        site = layout.ConstructionSite(side, side)
+        source = solver.FakeMachine(Vector(1, 1), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(side - 4, side - 4), MACHINE_SIZE)
+        for x in range(side):
+            if x not in range(70, 74):
+                site.add_entity(WOOD_CHEST, (x, 50), 0)
+                site.add_entity(WOOD_CHEST, (x, 51), 0)
+                site.add_entity(WOOD_CHEST, (x, 52), 0)
+        graph = hierarchy.ChunkGraph(site)
+        with profiling.profile() as profile:
+            path = solver.find_path(site, source, target, chunks=graph)
+        log.debug(f'{profile.counters} {path}')
+        self.assertNotIn('hierarchy.fallbacks', profile.counters)
+        self.assertTrue(a_star_factorio.is_belt_path(path[1:-1]), path)
+        self.assertTrue(any(x in range(70, 74) for x, y in path if y == 51))
+        flat_path = solver.find_path(site, source, target)
+        self.assertLessEqual(len(path), len(flat_path) + 8)
+
+    def test_updates(self):
+        '''Belts placed on the site are routed around'''
+        side = 64
+        site = layout.ConstructionSite(side, side)
+        graph = hierarchy.ChunkGraph(site)
+        left = solver.FakeMachine(Vector(2, 30), MACHINE_SIZE)
+        right = solver.FakeMachine(Vector(side - 5, 30), MACHINE_SIZE)
+        top = solver.FakeMachine(Vector(30, 2), MACHINE_SIZE)
+        bottom = solver.FakeMachine(Vector(30, side - 5), MACHINE_SIZE)
+        for m in [left, right, top, bottom]:
+            site.add_entity(WOOD_CHEST, m.position.as_int(), 0)
+        solver.connect_machines(site, left, right, chunks=graph)
+        with profiling.profile() as profile:
+            solver.connect_machines(site, top, bottom, chunks=graph)
+        self.assertGreater(profile.counters['hierarchy.chunks_updated'], 0)
+        self.assertNotIn('hierarchy.fallbacks', profile.counters)
+
+    def test_start_at_end(self):
+        '''A start position that is an end position is the whole path'''
+        site = layout.ConstructionSite(64, 64)
+        graph = hierarchy.ChunkGraph(site, chunk_size=16)
+        start_positions, end_positions = [(5, 5), (6, 6)], [(6, 6), (40, 40)]
+        start_illegal, end_illegal = {(6, 6): [(6, 7)]}, {(6, 6): [(7, 6)]}
+        for directional in [False, True]:
+            path = hierarchy.find_path(graph, start_positions, end_positions, start_illegal, end_illegal,
+                                       'manhattan', directional)
+            finder = a_star_factorio.A_star(site, start_positions, end_positions, start_illegal, end_illegal)
+            self.assertEqual(path, finder.find_path(True, heuristic='manhattan', directional=directional))
+            self.assertEqual(path, [(6, 6)])
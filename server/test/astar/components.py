@@ -0,0 +1,90 @@
+'''
+Connected components of the free tiles must never tell machines apart
+that a belt can join, and must follow the site as tiles are reserved, so
+impossible connections are rejected without a search.
+'''
+
+import logging
+import unittest
+
+import connectivity
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+def wall(site, x0, x1):
+    '''Reserve all tiles of columns x0 up to x1, excluded'''
+    for x in range(x0, x1):
+        for y in range(site.size()[1]):
+            site.add_entity(WOOD_CHEST, (x, y), 0)
+
+class TestComponents(unittest.TestCase):
+    '''Connectivity of the free tiles of a site'''
+
+    def test_underground_reach(self):
+        '''Walls thin enough to pass under do not split the site'''
+        site = layout.ConstructionSite(20, 5)
+        wall(site, 5, 9)
+        components = connectivity.Components(site)
+        self.assertTrue(components.connected([(4, 2)], [(9, 0)]))
+        wall(site, 9, 10)
+        self.assertFalse(components.connected([(4, 2)], [(10, 0)]))
+        self.assertTrue(components.connected([(0, 0)], [(10, 0), (4, 4)]))
+        self.assertIsNone(components.label((7, 2)))
+        components.close()
+
+    def test_updates(self):
+        '''Only tiles that may split a component find the labels again'''
+        site = layout.ConstructionSite(30, 30)
+        components = connectivity.Components(site)
+        self.assertTrue(components.connected([(0, 0)], [(29, 29)]))
+        with profiling.profile() as profile:
+            # A belt across the middle, with gaps too wide to pass under
+            for x in range(0, 30, 6):
+                for dx in range(5):
+                    site.reserve(x + dx, 15)
+                self.assertTrue(components.connected([(0, 0)], [(29, 29)]))
+            # A wall too thick to pass under
+            for y in range(10, 15):
+                for x in range(30):
+                    if not site.is_reserved(x, y):
+                        site.reserve(x, y)
+            self.assertFalse(components.connected([(0, 0)], [(29, 29)]))
+            self.assertTrue(components.connected([(0, 0)], [(29, 9)]))
+        log.debug(f'{profile.counters}')
+        self.assertLess(profile.counters['connectivity.relabels'], 3)
+        components.close()
+        site.reserve(0, 0)
+        self.assertEqual(components.label((0, 0)), components.label((1, 0)))
+
+    def test_reject(self):
+        '''No search between machines that no belt can join'''
+        site = layout.ConstructionSite(30, 9)
+        source = solver.FakeMachine(Vector(1, 3), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(26, 3), MACHINE_SIZE)
+        wall(site, 10, 16)
+        components = connectivity.Components(site)
+        with profiling.profile() as profile:
+            path = solver.find_path(site, source, target, components=components)
+        self.assertIsNone(path)
+        self.assertEqual(profile.counters['connectivity.rejected'], 1)
+        self.assertNotIn('astar.searches', profile.counters)
+        components.close()
@@ -67,8 +67,8 @@ class Test_find_underground_entry(unittest.TestCase):
         counter = 0
         for end in end_positions:
             node = finder.find_entrance_node(
-                finder.nodes[start_position[1]][start_position[0]],
-                finder.nodes[end[1]][end[0]],
+                finder.node(*start_position),
+                finder.node(*end),
             )
             self.assertEqual(node.position, correct_directions[counter])
             counter += 1
@@ -91,8 +91,8 @@ class Test_find_underground_entry(unittest.TestCase):
         counter = 0
         for end in end_positions:
             direction = finder.find_normalized_direction(
-                finder.nodes[start_position[1]][start_position[0]],
-                finder.nodes[end[1]][end[0]],
+                finder.node(*start_position),
+                finder.node(*end),
             )
             self.assertEqual(direction, correct_directions[counter])
             counter += 1
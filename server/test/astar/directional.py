@@ -0,0 +1,75 @@
+'''
+Searching tiles by the heading of the belt on them must find every path
+the belt rules allow, where the tile search closes a tile reached in the
+wrong heading and gives up.
+'''
+
+import logging
+import random
+import unittest
+
+import a_star_factorio
+import layout
+import profiling
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+
+#
+#  Test
+#
+
+class TestDirectional(unittest.TestCase):
+    '''Path finding on tiles and headings'''
+
+    def test_chained_undergrounds(self):
+        '''The exit of one underground belt is followed by the entry of the next'''
+        site = layout.ConstructionSite(18, 1)
+        for x in list(range(5, 9)) + list(range(11, 15)):
+            site.add_entity(WOOD_CHEST, (x, 0), 0)
+        finder = a_star_factorio.A_star(site, [(3, 0)], [(16, 0)], {}, {})
+        path = finder.find_path(True, directional=True)
+        self.assertEqual(path, [(3, 0), (4, 0), (9, 0), (10, 0), (15, 0), (16, 0)])
+
+    def test_inserters(self):
+        '''The path goes around the inserters at both ends'''
+        site = layout.ConstructionSite(5, 5)
+        finder = a_star_factorio.A_star(site, [(2, 2)], [(2, 0)], {(2, 2): [(2, 1)]}, {(2, 0): [(1, 0)]})
+        path = finder.find_path(True, directional=True)
+        self.assertEqual(path, [(2, 2), (3, 2), (3, 1), (3, 0), (2, 0)])
+
+    def test_cluttered_sites(self):
+        '''Every path of the tile search is found, and some more'''
+        side = 24
+        found = {False: 0, True: 0}
+        for seed in range(40):
+            rng = random.Random(seed)
+            site = layout.ConstructionSite(side, side)
+            start = (0, rng.randrange(side))
+            end = (side - 1, rng.randrange(side))
+            for y in range(side):
+                for x in range(side):
+                    if (x, y) not in [start, end] and rng.random() < 0.4:
+                        site.add_entity(WOOD_CHEST, (x, y), 0)
+            paths = {}
+            for directional in [False, True]:
+                finder = a_star_factorio.A_star(site, [start], [end], {}, {})
+                with profiling.profile() as profile:
+                    paths[directional] = finder.find_path(True, directional=directional)
+                log.debug(f'seed={seed} directional={directional} {profile.counters}')
+                if paths[directional] is not None:
+                    found[directional] += 1
+                    self.assertTrue(a_star_factorio.is_belt_path(paths[directional]), paths[directional])
+            if paths[False] is not None:
+                self.assertIsNotNone(paths[True], seed)
+        log.debug(f'found {found}')
+        self.assertGreater(found[True], found[False])
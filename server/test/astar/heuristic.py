@@ -0,0 +1,90 @@
+'''
+Heuristics computed for the whole site before a search. They must never
+overestimate the cost of a path, and should cut the number of expanded
+nodes where obstacles are in the way.
+'''
+
+import logging
+import unittest
+
+import a_star_factorio
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+class TestHeuristic(unittest.TestCase):
+    '''Heuristic fields for path finding'''
+
+    def test_manhattan(self):
+        estimate = a_star_factorio.manhattan_estimate([(0, 0), (3, 2)])
+        field = [[estimate(x, y) for x in range(4)] for y in range(3)]
+        self.assertEqual(field, [
+            [0, 1, 2, 2],
+            [1, 2, 2, 1],
+            [2, 2, 1, 0],
+        ])
+
+    def test_obstacles(self):
+        '''Belts go around obstacles, or under them for a higher cost'''
+        free = [[True] * 9 for _ in range(3)]
+        for y in range(3):
+            free[y][4] = False
+        field = a_star_factorio.obstacle_field(free, [(0, 1)])
+        self.assertEqual(field[1][:4], [0, 1, 2, 3])
+        # Under the wall, with an underground belt as long as possible
+        self.assertEqual(field[1][6], a_star_factorio.UNDERGROUND_COST)
+        self.assertEqual(field[1][8], a_star_factorio.UNDERGROUND_COST + 2)
+        self.assertEqual(field[1][4], a_star_factorio.UNREACHABLE)
+
+    def test_thick_wall(self):
+        '''Around a wall too thick for underground belts'''
+        side = 40
+        site = layout.ConstructionSite(side, side)
+        source = solver.FakeMachine(Vector(15, 2), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(15, side - 5), MACHINE_SIZE)
+        for y in range(15, 23):
+            for x in range(side - 3):
+                site.add_entity(WOOD_CHEST, (x, y), 0)
+        expanded = {}
+        lengths = set()
+        for heuristic in a_star_factorio.HEURISTICS:
+            with profiling.profile() as profile:
+                path = solver.find_path(site, source, target, heuristic=heuristic)
+            log.debug(f'{heuristic} {profile.counters}')
+            lengths.add(len(path))
+            expanded[heuristic] = profile.counters['astar.expanded']
+        self.assertEqual(len(lengths), 1)
+        self.assertLess(expanded['obstacles'] * 10, expanded['euclidean'])
+
+    def test_unreachable(self):
+        '''No search when the end cannot be reached'''
+        site = layout.ConstructionSite(20, 9)
+        source = solver.FakeMachine(Vector(1, 3), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(16, 3), MACHINE_SIZE)
+        for x in range(7, 14):
+            for y in range(9):
+                site.add_entity(WOOD_CHEST, (x, y), 0)
+        finder = a_star_factorio.A_star(site, [(5, 4)], [(14, 4)], {}, {})
+        with profiling.profile() as profile:
+            self.assertIsNone(finder.find_path(True, heuristic='obstacles'))
+        self.assertEqual(profile.counters['astar.expanded'], 0)
+        with self.assertRaises(ValueError):
+            finder.find_path(True, heuristic='straight')
@@ -0,0 +1,45 @@
+'''
+Setting up a search must not depend on the size of the site: nodes are
+made for the tiles reached, and heuristics for the tiles asked for.
+'''
+
+import unittest
+
+from a_star_factorio import A_star
+import layout
+import profiling
+
+#
+#  Test
+#
+
+class TestLazyNodes(unittest.TestCase):
+    '''Search setup on small and large sites'''
+
+    def search(self, side, directional):
+        '''Search a short path on a site of the given side
+
+        :return:  (nodes made, nodes expanded)
+        '''
+        site = layout.ConstructionSite(side, side)
+        finder = A_star(site, [(10, 10)], [(20, 10)], {(10, 10): [(9, 10)]}, {(20, 10): [(21, 10)]})
+        with profiling.profile() as profile:
+            path = finder.find_path(True, heuristic='manhattan', directional=directional)
+        self.assertEqual(path[0], (10, 10))
+        self.assertEqual(path[-1], (20, 10))
+        return len(finder.nodes), profile.counters['astar.expanded']
+
+    def test_tiles(self):
+        small = self.search(32, directional=False)
+        large = self.search(512, directional=False)
+        self.assertEqual(small, large)
+        nodes, expanded = large
+        self.assertLess(nodes, 32 * 32)
+        self.assertLess(expanded, nodes)
+
+    def test_directional(self):
+        '''The directional search only has nodes for the start positions'''
+        small = self.search(32, directional=True)
+        large = self.search(512, directional=True)
+        self.assertEqual(small, large)
+        self.assertEqual(large[0], 1)
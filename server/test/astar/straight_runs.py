@@ -0,0 +1,88 @@
+'''
+Expanding straight runs of free tiles in one step must find paths as cheap
+as expanding every state of the directional search, with far fewer
+expansions on open sites.
+'''
+
+import logging
+import random
+import unittest
+
+import a_star_factorio
+import layout
+import profiling
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+BELT = "transport-belt"
+
+#
+#  Test
+#
+
+def path_cost(path):
+    '''Cost of a path in the search: one per belt, and UNDERGROUND_COST per
+    underground belt'''
+    return sum(1 if abs(ax - bx) + abs(ay - by) == 1 else a_star_factorio.UNDERGROUND_COST
+               for (ax, ay), (bx, by) in zip(path, path[1:]))
+
+
+class TestStraightRuns(unittest.TestCase):
+    '''Straight run expansion in the directional search'''
+
+    def find_path(self, site, start, end, straight_runs, heuristic='euclidean'):
+        finder = a_star_factorio.A_star(site, [start], [end], {}, {})
+        with profiling.profile() as profile:
+            path = finder.find_path(True, heuristic=heuristic, directional=True, straight_runs=straight_runs)
+        log.debug(f'straight_runs={straight_runs} {profile.counters} {path}')
+        if path is not None:
+            self.assertTrue(a_star_factorio.is_belt_path(path), path)
+        return path, profile.counters.get('astar.expanded', 0)
+
+    def test_open_site(self):
+        '''Far fewer expansions, and as cheap a path'''
+        site = layout.ConstructionSite(64, 64)
+        path, expanded = self.find_path(site, (5, 5), (58, 58), straight_runs=False)
+        run_path, run_expanded = self.find_path(site, (5, 5), (58, 58), straight_runs=True)
+        self.assertEqual(path_cost(run_path), path_cost(path))
+        self.assertLess(run_expanded * 10, expanded)
+
+    def test_main_belt(self):
+        '''Underground belts still cross a wide main belt'''
+        width, height = 40, 9
+        site = layout.ConstructionSite(width, height)
+        for x in range(15, 19):
+            for y in range(height):
+                site.add_entity(BELT, (x, y), 0)
+        path, _ = self.find_path(site, (4, 4), (width - 5, 4), straight_runs=False)
+        run_path, _ = self.find_path(site, (4, 4), (width - 5, 4), straight_runs=True)
+        self.assertEqual(path_cost(run_path), path_cost(path))
+
+    def test_cluttered_sites(self):
+        '''Paths are found on the same sites, at the same cost'''
+        for seed in range(40):
+            rng = random.Random(seed)
+            side = rng.choice([16, 32])
+            density = rng.choice([0.02, 0.1, 0.3])
+            heuristic = rng.choice(a_star_factorio.HEURISTICS)
+            site = layout.ConstructionSite(side, side)
+            start, end = (rng.randrange(side), 0), (rng.randrange(side), side - 1)
+            for y in range(side):
+                for x in range(side):
+                    if (x, y) not in [start, end] and rng.random() < density:
+                        site.add_entity(WOOD_CHEST, (x, y), 0)
+            path, _ = self.find_path(site, start, end, False, heuristic)
+            run_path, _ = self.find_path(site, start, end, True, heuristic)
+            if path is None:
+                self.assertIsNone(run_path, seed)
+            else:
+                self.assertEqual(path_cost(run_path), path_cost(path), seed)
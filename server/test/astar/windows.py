@@ -0,0 +1,77 @@
+'''
+Searches in a window around the machines must grow the window until a
+path is found, so no path of the site is missed, and should only set up
+the tiles of the window for short connections.
+'''
+
+import unittest
+
+import a_star_factorio
+import layout
+import profiling
+import solver
+import windowed
+from vector import Vector
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+class TestWindows(unittest.TestCase):
+    '''Path finding in growing windows of a site'''
+
+    def find_path(self, site, source, target):
+        source = solver.FakeMachine(Vector(*source), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(*target), MACHINE_SIZE)
+        with profiling.profile() as profile:
+            path = solver.find_path(site, source, target)
+        return path, profile.counters
+
+    def test_windows(self):
+        areas = windowed.windows((0, 0, 100, 50), [(40, 20), (45, 22)], padding=4)
+        self.assertEqual(areas, [(36, 16, 50, 27), (32, 12, 54, 31), (24, 4, 62, 39),
+                                 (8, 0, 78, 50), (0, 0, 100, 50)])
+
+    def test_short(self):
+        '''Only the tiles close to the machines are searched'''
+        site = layout.ConstructionSite(200, 200)
+        path, counters = self.find_path(site, (100, 100), (110, 100))
+        self.assertEqual(counters['window.searches'], 1)
+        self.assertLess(counters['window.tiles'], 40 * 40)
+        self.assertTrue(a_star_factorio.is_belt_path(path[1:-1]))
+
+    def test_growth(self):
+        '''A wall around the machines is passed in a larger window'''
+        site = layout.ConstructionSite(80, 80)
+        for x in range(10, 16):
+            for y in range(70):
+                site.add_entity(WOOD_CHEST, (x, y), 0)
+        path, counters = self.find_path(site, (2, 30), (25, 30))
+        self.assertGreater(counters['window.searches'], 1)
+        self.assertTrue(a_star_factorio.is_belt_path(path[1:-1]))
+        self.assertTrue(any(y >= 70 for _, y in path))
+        solver.use_windowed_search = False
+        try:
+            whole, _ = self.find_path(site, (2, 30), (25, 30))
+        finally:
+            solver.use_windowed_search = True
+        self.assertEqual(len(path), len(whole))
+
+    def test_no_path(self):
+        '''All windows are searched before giving up'''
+        site = layout.ConstructionSite(120, 20)
+        for x in range(20, 30):
+            for y in range(20):
+                site.add_entity(WOOD_CHEST, (x, y), 0)
+        path, counters = self.find_path(site, (2, 8), (50, 8))
+        self.assertIsNone(path)
+        self.assertGreater(counters['window.searches'], 1)
+        # The last window is the whole site
+        self.assertGreater(counters['window.tiles'], 120 * 20)
@@ -1 +1,2 @@
 from .examples import *
+from .bottlenecks import *
@@ -0,0 +1,85 @@
+# Test bottleneck analysis of flow graphs and blueprints
+import unittest
+import logging
+
+import analyze
+import flow
+import layout
+from test.flow import examples
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+INSERTER_SPEED = 60/72 # 0.83 items/sec
+
+#
+#  Test
+#
+
+class TestBottlenecks(unittest.TestCase):
+    '''Find what limits the flow'''
+
+    def test_transport_belt_factory(self):
+        '''Gear production is limited by the inserter feeding iron plates to it'''
+        g = examples.TestTransportBelt.build_graph(None)
+        flow.compute_max_flow(g)
+        bottlenecks = flow.find_bottlenecks(g)
+        log.debug(bottlenecks)
+
+        nodes = {b['id']: b for b in bottlenecks if b['kind'] == 'node'}
+        self.assertEqual(set(nodes.keys()), set(['A', 'C']))
+        self.assertEqual(nodes['C']['cause'], 'upstream')
+        edges = [(b['source'], b['target']) for b in bottlenecks if b['kind'] == 'edge']
+        self.assertEqual(edges, [('E', 'C')])
+        lost = [b['lost'] for b in bottlenecks]
+        self.assertEqual(lost, sorted(lost, reverse=True))
+
+    def test_gear_machine_blueprint(self):
+        '''A single inserter cannot keep a gear assembler busy
+
+        b - belt moving south, fed from outside
+        i - inserter from belt to machine
+        o - inserter from machine to belt
+        e - belt moving east
+
+        a a a i b
+        a a a
+        a a a
+          o
+          e e
+        '''
+        site = layout.ConstructionSite(5, 5)
+        site.add_entity('assembling-machine-1', (0, 0), 0, 'iron-gear-wheel')
+        site.add_entity('transport-belt', (4, 0), 4)
+        site.add_entity('inserter', (3, 0), 2)
+        site.add_entity('inserter', (1, 3), 0)
+        site.add_entity('transport-belt', (1, 4), 2)
+        site.add_entity('transport-belt', (2, 4), 2)
+
+        G = analyze.extract_flow_from_site(site)
+        report = analyze.flow_report(G)
+        log.debug(report)
+
+        # Assembler 1 crafts one gear per second from two plates
+        throttle = INSERTER_SPEED / 2
+        self.assertEqual([e['kind'] for e in report['inputs']], ['iron-plate'])
+        self.assertAlmostEqual(report['inputs'][0]['rate'], INSERTER_SPEED)
+        self.assertEqual([e['kind'] for e in report['outputs']], ['iron-gear-wheel'])
+        self.assertAlmostEqual(report['outputs'][0]['rate'], throttle)
+
+        machine, inserter = report['bottlenecks']
+        self.assertEqual(machine['kind'], 'node')
+        self.assertEqual(machine['name'], 'assembling-machine-1')
+        self.assertEqual(machine['cause'], 'upstream')
+        self.assertAlmostEqual(machine['throttle'], throttle)
+        self.assertAlmostEqual(machine['lost'], 1 - throttle)
+        self.assertEqual(inserter['kind'], 'edge')
+        self.assertEqual(inserter['target'], machine['id'])
+        self.assertEqual(G.nodes[inserter['source']].name, 'inserter')
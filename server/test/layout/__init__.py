@@ -1,2 +1,9 @@
 from .underground import *
 from .route_finding import *
+from .streaming import *
+from .encoding import *
+from .book import *
+from .free_runs import *
+from .chunked_site import *
+from .checkpoints import *
+from .batch import *
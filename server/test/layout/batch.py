@@ -0,0 +1,127 @@
+'''
+The batch command analyzes many blueprint files, found from files,
+directories and glob patterns, and writes one record per blueprint, also
+for files that fail.
+'''
+
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cli
+import layout
+from test.layout.book import belt_blueprint, nested_book
+
+#
+#  Constants
+#
+
+SERVER_FOLDER = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#
+#  Test
+#
+
+class TestBatch(unittest.TestCase):
+    '''Batch analysis of blueprint files'''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+        os.mkdir(self.path('books'))
+        self.write('belt.txt', layout.export_blueprint_dict(belt_blueprint(5, 'belt')))
+        self.write('books/book.txt', layout.export_blueprint_book(nested_book(), processes=1))
+        self.write('books/notes.md', 'Not a blueprint')
+        self.write('broken.txt', '0not a blueprint')
+
+    def path(self, name):
+        return os.path.join(self.dir, *name.split('/'))
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as fo:
+            fo.write(text)
+
+    def test_expand_directory(self):
+        '''Directories are searched recursively for the pattern'''
+        files = cli.expand_blueprint_paths([self.dir])
+        self.assertEqual(files, [(self.path(name), True) for name in ['belt.txt', 'books/book.txt', 'broken.txt']])
+        files = cli.expand_blueprint_paths([self.dir], pattern='*.md')
+        self.assertEqual(files, [(self.path('books/notes.md'), True)])
+
+    def test_expand_glob(self):
+        '''Glob patterns and files are expanded, and paths that match nothing are kept'''
+        missing = self.path('missing.txt')
+        files = cli.expand_blueprint_paths([self.path('b*.txt'), self.path('books/book.txt'), missing])
+        self.assertEqual(files, [(self.path('belt.txt'), True), (self.path('broken.txt'), True),
+                                 (self.path('books/book.txt'), True), (missing, False)])
+
+    def test_records(self):
+        '''One record per blueprint of a book'''
+        _, records = cli._batch_records((self.path('books/book.txt'), True, 'stats'))
+        self.assertEqual([r['page'] for r in records], ['0', '1.0', '2'])
+        self.assertEqual([r['title'] for r in records], ['first', 'inner', 'last'])
+        self.assertEqual([r['entities'] for r in records], [5, 3, 7])
+        self.assertEqual(records[0]['width'], 4)
+        self.assertTrue(all(r['file'] == self.path('books/book.txt') for r in records))
+
+    def test_errors(self):
+        '''A file that fails to parse, or is missing, gives one record with the error'''
+        size, records = cli._batch_records((self.path('broken.txt'), True, 'stats'))
+        self.assertEqual(size, os.path.getsize(self.path('broken.txt')))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['file'], self.path('broken.txt'))
+        self.assertEqual(records[0]['page'], '')
+        self.assertTrue(records[0]['error'])
+        size, records = cli._batch_records(('missing.txt', False, 'stats'))
+        self.assertEqual((size, records), (0, [dict(file='missing.txt', page='', error='No such file')]))
+
+    def records(self):
+        return [dict(file='a.txt', page='0', title='A', entities=5, width=4, height=0),
+                dict(file='b.txt', page='', error='Broken', extra='dropped')]
+
+    def test_jsonl(self):
+        '''One JSON object per line, with the fields in order'''
+        fo = io.StringIO()
+        fields = cli.BATCH_FIELDS['stats']
+        cli.write_batch_records(self.records(), fo, fields, 'jsonl')
+        lines = [json.loads(line) for line in fo.getvalue().splitlines()]
+        self.assertEqual([list(line) for line in lines], [fields, fields])
+        self.assertEqual(lines[0]['entities'], 5)
+        self.assertIsNone(lines[0]['error'])
+        self.assertEqual(lines[1]['error'], 'Broken')
+
+    def test_csv(self):
+        '''A header with the fields in order, and dicts as JSON'''
+        fo = io.StringIO()
+        fields = cli.BATCH_FIELDS['maxflow']
+        records = [dict(file='a.txt', page='0', title='A', inputs={'iron-plate': 1.5}, bottlenecks=2)]
+        cli.write_batch_records(records, fo, fields, 'csv')
+        rows = list(csv.reader(io.StringIO(fo.getvalue())))
+        self.assertEqual(rows[0], fields)
+        self.assertEqual(dict(zip(rows[0], rows[1])), dict(file='a.txt', page='0', title='A',
+                         inputs='{"iron-plate": 1.5}', outputs='', bottlenecks='2', error=''))
+        fo = io.StringIO()
+        cli.write_batch_records(self.records(), fo, cli.BATCH_FIELDS['stats'], 'csv')
+        rows = list(csv.reader(io.StringIO(fo.getvalue())))
+        self.assertEqual(rows[0], cli.BATCH_FIELDS['stats'])
+        self.assertEqual(rows[2], ['b.txt', '', '', '', '', '', '', 'Broken'])
+
+    def test_command(self):
+        '''Standard output only has the records, also when blueprints fail'''
+        unknown = belt_blueprint(2, 'unknown')
+        unknown['blueprint']['snap-to-grid'] = {'x': 1, 'y': 1}
+        self.write('unknown.txt', layout.export_blueprint_dict(unknown))
+        result = subprocess.run([sys.executable, 'cli.py', 'batch', '-j', '1', self.dir],
+                                cwd=SERVER_FOLDER, capture_output=True, text=True, check=True)
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual([(os.path.basename(r['file']), r['page']) for r in records],
+                         [('belt.txt', ''), ('book.txt', '0'), ('book.txt', '1.0'), ('book.txt', '2'),
+                          ('broken.txt', ''), ('unknown.txt', '')])
+        self.assertIn('snap-to-grid', records[-1]['error'])
+        self.assertIn('Processed 4 files', result.stderr)
@@ -0,0 +1,75 @@
+'''
+Blueprint books hold many blueprints. The blueprints are independent, so
+they are encoded and analyzed in parallel.
+'''
+
+import logging
+import unittest
+
+import analyze
+import layout
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+BELT = 'transport-belt'
+
+#
+#  Test
+#
+
+def belt_blueprint(length, label):
+    site = layout.ConstructionSite(length, 1)
+    for x in range(length):
+        site.add_entity(BELT, (x, 0), 2)
+    bp_dict = layout.empty_blueprint_dict()
+    bp_dict['blueprint']['entities'] = site.get_entity_list()
+    bp_dict['blueprint']['label'] = label
+    return bp_dict
+
+def nested_book():
+    '''A book with two blueprints, and a book with one blueprint'''
+    inner = layout.blueprint_book_dict([belt_blueprint(3, 'inner')], label='inner book')
+    return layout.blueprint_book_dict([belt_blueprint(5, 'first'), inner, belt_blueprint(7, 'last')])
+
+
+class TestBlueprintBook(unittest.TestCase):
+    '''Import and export blueprint books'''
+
+    def test_pages(self):
+        '''Blueprints in nested books are found'''
+        pages = list(layout.iter_book_blueprints(nested_book()))
+        self.assertEqual([indexes for indexes, _ in pages], [(0,), (1, 0), (2,)])
+        self.assertEqual([bp['blueprint']['label'] for _, bp in pages], ['first', 'inner', 'last'])
+        bp_dict = belt_blueprint(2, 'single')
+        self.assertEqual(list(layout.iter_book_blueprints(bp_dict)), [((), bp_dict)])
+
+    def test_roundtrip(self):
+        '''Books encoded in parallel decode to the same book'''
+        book = nested_book()
+        for level in [0, 1, 6, 9]:
+            bp_string = layout.export_blueprint_book(book, level=level, processes=1)
+            self.assertEqual(layout.import_blueprint_dict(bp_string), book)
+            self.assertEqual(layout.export_blueprint_book(book, level=level, processes=2), bp_string)
+        empty = layout.blueprint_book_dict([])
+        self.assertEqual(layout.import_blueprint_dict(layout.export_blueprint_book(empty)), empty)
+        with self.assertRaises(ValueError):
+            layout.export_blueprint_book(belt_blueprint(2, 'single'))
+
+    def test_analyze(self):
+        '''Each blueprint is analyzed on its own'''
+        book = nested_book()
+        book['blueprint_book']['blueprints'][2]['blueprint']['entities'].append(
+            dict(entity_number=8, name='nuclear-reactor', position=dict(x=9.5, y=0.5)))
+        results = analyze.analyze_blueprint_book(book, processes=2)
+        self.assertEqual([r['index'] for r in results], [[0], [1, 0], [2]])
+        self.assertEqual(results[0]['label'], 'first')
+        self.assertIn('report', results[1])
+        self.assertIn('nuclear-reactor', results[2]['error'])
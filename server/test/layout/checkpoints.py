@@ -0,0 +1,92 @@
+'''
+Changes to a site since a checkpoint should be undone by a rollback, and
+the structures that follow the site should see the cells freed again.
+'''
+
+import unittest
+
+import layout
+import solver
+from vector import Vector
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+BELT = "transport-belt"
+MACHINE = "assembling-machine-1"
+
+#
+#  Test
+#
+
+class TestCheckpoints(unittest.TestCase):
+    '''Rollback of the changes to a site'''
+
+    def test_rollback(self):
+        site = layout.ConstructionSite(20, 20)
+        site.add_entity(WOOD_CHEST, (1, 1), 0)
+        runs = site.free_runs()
+        before = (str(site), bytes(runs.free), dict((d, list(r)) for d, r in runs.runs.items()))
+        checkpoint = site.checkpoint()
+        site.add_entity(MACHINE, (5, 5), 0)
+        site.add_entity(WOOD_CHEST, (19, 19), 0)
+        site.update_entity(site.entities[0], kind=BELT, direction=4)
+        self.assertEqual(site.bounding_box(), (1, 1, 20, 20))
+        site.rollback(checkpoint)
+        self.assertEqual((str(site), bytes(runs.free), dict((d, list(r)) for d, r in runs.runs.items())), before)
+        self.assertEqual(site.entities, [dict(kind=WOOD_CHEST, pos=(1, 1), direction=0)])
+        self.assertEqual(site.bounding_box(), (1, 1, 2, 2))
+        self.assertEqual(len(site.chunks), 1)
+        self.assertIsNone(site.journal)
+
+    def test_nested(self):
+        '''An inner checkpoint that is kept is undone with the outer one'''
+        site = layout.ConstructionSite()
+        outer = site.checkpoint()
+        site.add_entity(WOOD_CHEST, (-3, 0), 0)
+        inner = site.checkpoint()
+        site.add_entity(WOOD_CHEST, (0, 0), 0)
+        site.commit(inner)
+        inner = site.checkpoint()
+        site.add_entity(WOOD_CHEST, (1, 0), 0)
+        site.rollback(inner)
+        self.assertEqual(site.reserved, {(-3, 0), (0, 0)})
+        site.rollback(outer)
+        self.assertEqual(site.reserved, set())
+        self.assertEqual(site.entities, [])
+
+    def test_transaction(self):
+        '''A connection without a path leaves the site as it was'''
+        site = layout.ConstructionSite(20, 20)
+        source = solver.FakeMachine(Vector(1, 1), (3, 3))
+        target = solver.FakeMachine(Vector(14, 1), (3, 3))
+        for y in range(20):
+            for x in range(8, 13):
+                site.add_entity(WOOD_CHEST, (x, y), 0)
+        entities = list(site.entities)
+        with self.assertRaises(ValueError):
+            with site.transaction():
+                site.add_entity(BELT, (5, 5), 0)
+                solver.connect_machines(site, source, target)
+        self.assertEqual(site.entities, entities)
+        self.assertFalse(site.is_reserved(5, 5))
+
+    def test_nested_transactions(self):
+        '''An inner transaction that fails, from an empty journal, keeps the
+        outer one recording'''
+        site = layout.ConstructionSite(10, 10)
+        with self.assertRaises(RuntimeError):
+            with site.transaction():
+                try:
+                    with site.transaction():
+                        site.reserve(1, 1)
+                        raise ValueError('No possible path')
+                except ValueError:
+                    pass
+                site.reserve(2, 2)
+                raise RuntimeError()
+        self.assertEqual(site.reserved, set())
+        self.assertIsNone(site.journal)
+        self.assertEqual(site.checkpoints, [])
@@ -0,0 +1,62 @@
+'''
+A site without fixed dimensions should only take memory and time for what
+is built on it, wherever that is, including at negative coordinates.
+'''
+
+import unittest
+
+import a_star_factorio
+import layout
+import solver
+from vector import Vector
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+class TestChunkedSite(unittest.TestCase):
+    '''Occupancy in chunks allocated on demand'''
+
+    def test_reserve(self):
+        site = layout.ConstructionSite()
+        site.add_entity(WOOD_CHEST, (-40, 3), 0)
+        site.add_entity(WOOD_CHEST, (100000, -7), 0)
+        self.assertTrue(site.is_reserved(-40, 3))
+        self.assertFalse(site.is_reserved(-39, 3))
+        self.assertFalse(site.is_reserved(-40 + layout.CHUNK_SIZE, 3))
+        self.assertTrue(site.in_bounds(-1000, -1000))
+        self.assertEqual(len(site.chunks), 2)
+        self.assertEqual(site.bounding_box(), (-40, -7, 100001, 4))
+        self.assertEqual(site.reserved, {(-40, 3), (100000, -7)})
+        self.assertEqual(list(site.reserved_cells(-50, 0, 0, 10)), [(-40, 3)])
+        with self.assertRaises(ValueError):
+            site.reserve(-40, 3)
+
+    def test_bounded(self):
+        '''A site of fixed dimensions keeps them'''
+        site = layout.ConstructionSite(10, 5)
+        site.add_entity(WOOD_CHEST, (3, 2), 0)
+        self.assertEqual(site.size(), (10, 5))
+        self.assertFalse(site.in_bounds(10, 0))
+        self.assertFalse(site.in_bounds(0, -1))
+        self.assertEqual(str(site), '..........\n' * 2 + '...#......\n' + '..........\n' * 2)
+
+    def test_find_path(self):
+        '''Paths go around what is built, at any coordinates'''
+        site = layout.ConstructionSite()
+        for y in range(-30, 10):
+            site.add_entity(WOOD_CHEST, (-5, y), 0)
+        source = solver.FakeMachine(Vector(-20, -8), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(5, -8), MACHINE_SIZE)
+        site.add_entity(WOOD_CHEST, source.position, 0)
+        site.add_entity(WOOD_CHEST, target.position, 0)
+        path = solver.find_path(site, source, target)
+        self.assertTrue(a_star_factorio.is_belt_path(path[1:-1]))
+        self.assertTrue(all(not site.is_reserved(*position) for position in path))
@@ -0,0 +1,86 @@
+'''
+Blueprint exchange strings are encoded for every generated blueprint.
+All encoder settings must give strings that decode to the same blueprint.
+'''
+
+import logging
+import unittest
+
+import layout
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+BELT = 'transport-belt'
+UNDERGROUND = 'underground-belt'
+ASSEMBLER = 'assembling-machine-1'
+
+#
+#  Test
+#
+
+def small_factory():
+    site = layout.ConstructionSite(12, 6)
+    site.add_entity(ASSEMBLER, (0, 0), 0, recipe='iron-gear-wheel')
+    site.add_entity(ASSEMBLER, (4, 0), 0, recipe='copper-cable')
+    site.add_entity(UNDERGROUND, (0, 4), 2, type='input')
+    site.add_entity(UNDERGROUND, (4, 4), 2, type='output')
+    for x in range(5, 12):
+        site.add_entity(BELT, (x, 4), 2)
+    return site
+
+
+class TestEncoder(unittest.TestCase):
+    '''Encode blueprints with different settings'''
+
+    def expected(self, site, label):
+        bp_dict = layout.empty_blueprint_dict()
+        bp_dict['blueprint']['entities'] = site.get_entity_list()
+        bp_dict['blueprint']['label'] = label
+        return bp_dict
+
+    def test_site_encoder(self):
+        '''Writing from site entities gives the same blueprint as the entity list'''
+        site = small_factory()
+        expected = self.expected(site, 'factory')
+        for backend in ['json', None]:
+            for level in [0, 1, 6, 9]:
+                for strategy in layout.COMPRESSION_STRATEGIES:
+                    bp_string = layout.site_as_blueprint_string(
+                        site, label='factory', level=level, strategy=strategy, json_backend=backend)
+                    self.assertEqual(layout.import_blueprint_dict(bp_string), expected)
+
+    def test_dict_encoder(self):
+        '''Compression settings do not change the blueprint'''
+        expected = self.expected(small_factory(), 'factory')
+        lengths = {}
+        for level in [1, 9]:
+            bp_string = layout.export_blueprint_dict(expected, level=level, json_backend='json')
+            self.assertEqual(layout.import_blueprint_dict(bp_string), expected)
+            lengths[level] = len(bp_string)
+        self.assertLessEqual(lengths[9], lengths[1])
+
+    def test_many_entities(self):
+        '''Entities are written in batches'''
+        site = layout.ConstructionSite(64, 64)
+        for y in range(64):
+            for x in range(32):
+                site.add_entity(BELT, (x, y), 2)
+        bp_string = layout.site_as_blueprint_string(site)
+        self.assertEqual(layout.import_blueprint_dict(bp_string),
+                         self.expected(site, 'Unnamed ConstructionSite'))
+
+    def test_invalid_settings(self):
+        '''Unknown settings raise ValueError'''
+        site = small_factory()
+        with self.assertRaises(ValueError):
+            layout.site_as_blueprint_string(site, strategy='fastest')
+        with self.assertRaises(ValueError):
+            layout.site_as_blueprint_string(site, json_backend='yaml')
@@ -0,0 +1,89 @@
+'''
+Runs of free and reserved cells must follow the site as cells are
+reserved, and let path finding use longer underground belts of faster
+belt tiers.
+'''
+
+import random
+import unittest
+
+import a_star_factorio
+import layout
+import solver
+from vector import Vector
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+BELT = "transport-belt"
+
+#
+#  Test
+#
+
+class TestFreeRuns(unittest.TestCase):
+    '''Runs of free cells along rows and columns'''
+
+    def test_runs(self):
+        site = layout.ConstructionSite(8, 3)
+        for x in [2, 3, 6]:
+            site.reserve(x, 1)
+        runs = site.free_runs()
+        self.assertEqual([runs.run(x, 1, 1, 0) for x in range(8)], [2, 1, 2, 1, 2, 1, 1, 1])
+        self.assertEqual([runs.run(x, 1, -1, 0) for x in range(8)], [1, 2, 1, 2, 1, 2, 1, 1])
+        self.assertEqual(runs.run(2, 0, 0, 1), 1)
+        self.assertEqual(runs.free_cells(0, 1, 1, 0, 1, 7), [1, 4, 5, 7])
+        self.assertEqual(runs.free_cells(0, 1, 1, 0, 2, 4), [4])
+
+    def test_updates(self):
+        '''Runs kept up to date are the same as runs found again'''
+        site = layout.ConstructionSite(23, 17)
+        runs = site.free_runs()
+        rng = random.Random(3)
+        for _ in range(150):
+            x, y = rng.randrange(23), rng.randrange(17)
+            if not site.is_reserved(x, y):
+                site.reserve(x, y)
+        found = layout.FreeRuns(site)
+        self.assertEqual(runs.runs, found.runs)
+        self.assertEqual(runs.free, found.free)
+
+    def test_belt_tiers(self):
+        '''Faster belts go under wider obstacles'''
+        site = layout.ConstructionSite(20, 5)
+        for x in range(5, 11):
+            for y in range(5):
+                site.add_entity(BELT, (x, y), 0)
+        for belt in a_star_factorio.UNDERGROUND_MAX_GAP:
+            for directional in [False, True]:
+                finder = a_star_factorio.A_star(site, [(3, 2)], [(15, 2)], {}, {}, belt)
+                path = finder.find_path(True, directional=directional)
+                if belt == 'transport-belt':
+                    self.assertIsNone(path)
+                else:
+                    reach = a_star_factorio.UNDERGROUND_MAX_GAP[belt] + 2
+                    self.assertTrue(a_star_factorio.is_belt_path(path, reach=reach), path)
+                    self.assertEqual((path[0], path[-1]), ((3, 2), (15, 2)))
+        source = solver.Port()
+        target = solver.Port()
+        source.position = Vector(1, 2)
+        target.position = Vector(17, 2)
+        site.add_entity(WOOD_CHEST, source.position, 0)
+        site.add_entity(WOOD_CHEST, target.position, 0)
+        solver.connect_machines(site, source, target, belt='fast-transport-belt')
+        self.assertEqual(site.entities[-1]['kind'], 'inserter')
+
+    def test_unbounded(self):
+        '''An unbounded site is only searched in windows'''
+        site = layout.ConstructionSite()
+        site.add_entity(WOOD_CHEST, (-5, -5), 0)
+        with self.assertRaises(ValueError):
+            site.free_runs()
+        with self.assertRaises(ValueError):
+            a_star_factorio.A_star(site, [(-8, -10)], [(3, 5)], {}, {})
+        source = solver.FakeMachine(Vector(-12, -10), (3, 3))
+        target = solver.FakeMachine(Vector(4, 5), (3, 3))
+        path = solver.find_path(site, source, target)
+        self.assertTrue(a_star_factorio.is_belt_path(path[1:-1]))
@@ -0,0 +1,118 @@
+'''
+Blueprints can be huge. Decoding them one entity at a time keeps
+memory use bounded.
+'''
+
+import io
+import logging
+import unittest
+
+import jsonstream
+import layout
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+BELT = 'transport-belt'
+INSERTER = 'inserter'
+
+#
+#  Test
+#
+
+def belt_site(width, height):
+    '''A site filled with rows of belts'''
+    site = layout.ConstructionSite(width, height)
+    for y in range(height):
+        for x in range(width):
+            site.add_entity(BELT, (x, y), 2)
+    return site
+
+def chunked(text, size):
+    return [text[i:i+size] for i in range(0, len(text), size)]
+
+
+class TestJsonStream(unittest.TestCase):
+    '''Incremental JSON parsing'''
+
+    def test_split_everywhere(self):
+        '''Values split at any position between chunks are decoded'''
+        text = '{"a": [1, 23.5e1, {"b": "x\\"y"}], "c": {"d": [true, null]}, "e": []}'
+        expected = [
+            (('a', 0), 1),
+            (('a', 1), 235.0),
+            (('a', 2), {'b': 'x"y'}),
+            (('c',), {'d': [True, None]}),
+            (('e',), []),
+        ]
+        for size in range(1, len(text) + 1):
+            events = list(jsonstream.iter_events(chunked(text, size), [('a', jsonstream.ANY), ('e', jsonstream.ANY)]))
+            self.assertEqual(events, expected, f'chunk size {size}')
+
+    def test_invalid(self):
+        '''Broken JSON raises ValueError'''
+        for text in ['', '{"a": [1, 2}', '{"a": 1', '{"a": 1} x', '{1: 2}']:
+            with self.assertRaises(ValueError, msg=text):
+                list(jsonstream.iter_events(chunked(text, 3), [('a', jsonstream.ANY)]))
+
+
+class TestStreamingDecoder(unittest.TestCase):
+    '''Decode exchange strings in chunks'''
+
+    def test_entities(self):
+        '''Streamed entities are the same as the exported entities'''
+        site = belt_site(20, 10)
+        bp_string = layout.site_as_blueprint_string(site, label='belts')
+        expected = site.get_entity_list()
+        for chunk_size in [1, 7, 100, 1 << 16]:
+            entities = layout.iter_exchange_string_json(bp_string, chunk_size=chunk_size)
+            events = list(jsonstream.iter_events(entities, layout.BLUEPRINT_STREAM_PATHS))
+            found = [value for path, value in events if path[:2] == ('blueprint', 'entities')]
+            self.assertEqual(found, expected)
+            self.assertIn((('blueprint', 'label'), 'belts'), events)
+
+    def test_same_as_import(self):
+        '''Streamed and imported blueprints are equal'''
+        site = belt_site(5, 5)
+        bp_string = layout.site_as_blueprint_string(site)
+        bp_dict = layout.import_blueprint_dict(bp_string)
+        blueprint = {}
+        for path, value in layout.iter_blueprint_events(io.StringIO(bp_string + '\n')):
+            if path[1] == 'entities':
+                blueprint.setdefault('entities', []).append(value)
+            else:
+                blueprint[path[1]] = value
+        self.assertEqual({'blueprint': blueprint}, bp_dict)
+        self.assertEqual(list(layout.iter_blueprint_entities(bp_string)),
+                         bp_dict['blueprint']['entities'])
+
+    def test_truncated(self):
+        '''Damaged exchange strings raise ValueError'''
+        bp_string = layout.site_as_blueprint_string(belt_site(5, 5))
+        for broken in [bp_string[:-8], bp_string[:-1], '1' + bp_string[1:], bp_string[:40] + '!' + bp_string[41:]]:
+            with self.assertRaises(ValueError):
+                list(layout.iter_blueprint_entities(broken))
+
+    def test_bounded_memory(self):
+        '''Streaming uses much less memory than importing the whole blueprint'''
+        import tracemalloc
+        bp_string = layout.site_as_blueprint_string(belt_site(100, 100))
+
+        tracemalloc.start()
+        layout.import_blueprint_dict(bp_string)
+        _, import_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        count = sum(1 for _ in layout.iter_blueprint_entities(bp_string))
+        _, stream_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        log.debug(f'Peak memory import {import_peak} bytes, stream {stream_peak} bytes')
+        self.assertEqual(count, 100 * 100)
+        self.assertLess(stream_peak * 5, import_peak)
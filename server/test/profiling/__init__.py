@@ -0,0 +1,8 @@
+from .spans import *
+from .metrics import *
+from .log_levels import *
+from .import_time import *
+from .progress import *
+from .budget import *
+from .generations import *
+from .benchmarks import *
@@ -0,0 +1,47 @@
+'''
+The workloads of the benchmark suite must run to the end with the default
+options, or the suite times only their first stages. Spring layout can
+leave machines overlapping, so they are spread apart before placing them.
+'''
+
+import logging
+import unittest
+
+from benchmark import suite
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Test
+#
+
+class TestBenchmarkSuite(unittest.TestCase):
+    '''Workloads of benchmark.suite'''
+
+    def test_spread(self):
+        '''Overlapping machines get apart, in the same directions'''
+        machines = [solver.FakeMachine(Vector(*position), (3, 3)) for position in [(10, 10), (12, 11), (10, 30)]]
+        scale = solver.spread_machines(machines, gap=2)
+        self.assertGreater(scale, 1)
+        solver.machines_to_int(machines)
+        (ax, ay), (bx, by), (cx, cy) = [machine.position.values for machine in machines]
+        self.assertGreaterEqual(bx - ax, 3 + 2)
+        self.assertGreater(by, ay)
+        self.assertEqual(cx, ax)
+        self.assertEqual(solver.spread_machines(machines, gap=2), 1)
+
+    def test_default_workloads(self):
+        '''Every stage of the default workloads finishes without errors'''
+        defaults = {param.name: param.default for param in suite.main.params}
+        for name, _, stages in suite.workloads(defaults['machine_counts'], defaults['sides'],
+                                               defaults['densities']):
+            results = suite.run_stages(stages, defaults['seed'], trace_memory=False)
+            log.debug(f'{name} {[(r["stage"], round(r["seconds"], 3)) for r in results]}')
+            self.assertEqual([(r['stage'], r['error']) for r in results], [(stage, None) for stage, _ in stages],
+                             name)
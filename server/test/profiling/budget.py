@@ -0,0 +1,74 @@
+'''
+Time budgets bound how long a generation runs. Loops must stop when the
+time is up, with a partial result or an error telling how far they got.
+'''
+
+import logging
+import unittest
+
+import budget
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Test
+#
+
+class TestBudget(unittest.TestCase):
+    '''Deadlines and cancellation'''
+
+    def test_check(self):
+        '''Checks do nothing without a budget, and raise when it runs out'''
+        budget.check('stage')
+        self.assertFalse(budget.expired())
+        with budget.limit(3600) as b:
+            budget.check('stage')
+            self.assertGreater(b.remaining(), 0)
+        with budget.limit(0):
+            with self.assertRaises(budget.TimeBudgetExceeded) as cm:
+                budget.check('stage', routed=2, total=5)
+        result = cm.exception.as_dict()
+        self.assertEqual(result['error'], 'timeout')
+        self.assertEqual(result['stage'], 'stage')
+        self.assertEqual((result['routed'], result['total']), (2, 5))
+        self.assertIsNone(budget.current_budget())
+
+    def test_cancel(self):
+        '''A cancelled budget raises Cancelled, also before the deadline'''
+        b = budget.Budget()
+        self.assertIsNone(b.remaining())
+        with budget.limit(b):
+            b.cancel('Client left')
+            with self.assertRaises(budget.Cancelled) as cm:
+                budget.expired()
+        self.assertNotIsInstance(cm.exception, budget.TimeBudgetExceeded)
+        self.assertEqual(str(cm.exception), 'Client left')
+
+    def test_path_search(self):
+        '''Path finding raises when out of time'''
+        site = layout.ConstructionSite(30, 30)
+        source = solver.FakeMachine(Vector(0, 0), (3, 3))
+        target = solver.FakeMachine(Vector(27, 27), (3, 3))
+        with budget.limit(0):
+            with self.assertRaises(budget.TimeBudgetExceeded) as cm:
+                # A plain search, that expands enough nodes to check the budget
+                solver.find_path(site, source, target, heuristic='euclidean', directional=False)
+        self.assertEqual(cm.exception.stage, 'find_path')
+        self.assertGreater(cm.exception.details['expanded'], 0)
+
+    def test_spring(self):
+        '''Spring layout stops with the positions found so far'''
+        machines = [solver.FakeMachine(Vector(x, 5), (3, 3)) for x in [5, 5.5, 6]]
+        with profiling.profile() as profile:
+            with budget.limit(0):
+                solver.spring(machines, borders=((0, 0), (20, 20)))
+        self.assertEqual(profile.counters['spring.iterations'], 1)
+        self.assertEqual(profile.counters['spring.out_of_time'], 1)
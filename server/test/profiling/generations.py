@@ -0,0 +1,62 @@
+'''
+Generations of the server use the shortcuts of the path finding, like the
+route cache, while reporting their progress. The server is run in a new
+Python process, as importing it sets up logging and the route cache.
+'''
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import unittest
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Constants
+#
+
+SERVER_FOLDER = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Posts one request to /process, and prints the counters of its profile
+PROCESS_SCRIPT = '''
+import json
+import server
+response = server.app.test_client().post('/process', json={'input_string': 'test'})
+print(json.dumps(response.json()['profile']['counters']))
+'''
+
+#
+#  Test
+#
+
+def process_counters():
+    '''Generate a blueprint with /process in a new Python process
+
+    :return:  Profile counters of the generation
+    '''
+    result = subprocess.run([sys.executable, '-c', PROCESS_SCRIPT],
+                            cwd=SERVER_FOLDER, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class TestGenerations(unittest.TestCase):
+    '''Path finding shortcuts in generations of the server'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.counters = process_counters()
+        log.debug(cls.counters)
+
+    def test_route_cache(self):
+        '''Paths are looked up in the route cache'''
+        self.assertGreater(self.counters.get('route_cache.hits', 0) + self.counters.get('route_cache.misses', 0), 0)
+
+    def test_windowed_search(self):
+        '''Paths are searched in windows around the machines first'''
+        self.assertGreater(self.counters.get('window.searches', 0), 0)
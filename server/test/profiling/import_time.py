@@ -0,0 +1,63 @@
+'''
+Command line tools start fast when slow dependencies are imported by the
+code that needs them. Import times are measured with python -X importtime.
+'''
+
+import logging
+import os
+import subprocess
+import sys
+import unittest
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Constants
+#
+
+SERVER_FOLDER = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules that take a noticeable time to import
+SLOW_MODULES = ['factoriocalc', 'networkx', 'numpy', 'pandas', 'connexion', 'flask']
+
+#
+#  Test
+#
+
+def import_times(module):
+    '''Import a module in a new Python process
+
+    :return:  Dict from name of each imported module to cumulative import
+        time in microseconds
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=SERVER_FOLDER, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    '''Slow modules are not imported at startup'''
+
+    def check_module(self, module):
+        times = import_times(module)
+        log.debug(f'import {module} took {times[module] / 1000:.1f} ms')
+        self.assertEqual([m for m in SLOW_MODULES if m in times], [])
+
+    def test_cli(self):
+        self.check_module('cli')
+
+    def test_analyze(self):
+        self.check_module('analyze')
+
+    def test_solver(self):
+        self.check_module('solver')
@@ -0,0 +1,63 @@
+'''
+The server logs through a queue, and log levels can be changed per module
+while it runs.
+'''
+
+import logging
+import os
+import tempfile
+import unittest
+
+import logging_setup
+
+#
+#  Test
+#
+
+class TestLogLevels(unittest.TestCase):
+    '''Queue logging and levels per module'''
+
+    def setUp(self):
+        self.saved_levels = {name: logging.getLogger(name).level for name in ['fbg.test.a', 'fbg.test.b']}
+
+    def tearDown(self):
+        logging_setup.stop_queue_logging()
+        for name, level in self.saved_levels.items():
+            logging.getLogger(name).setLevel(level)
+
+    def test_parse(self):
+        self.assertEqual(logging_setup.parse_levels('solver=debug, flow=WARNING,'),
+                         {'solver': 'DEBUG', 'flow': 'WARNING'})
+        self.assertEqual(logging_setup.parse_levels(''), {})
+        with self.assertRaises(ValueError):
+            logging_setup.parse_levels('solver')
+
+    def test_set_levels(self):
+        '''Invalid levels change nothing'''
+        logging_setup.set_levels({'fbg.test.a': 'DEBUG', 'fbg.test.b': logging.ERROR})
+        levels = logging_setup.get_levels()
+        self.assertEqual(levels['fbg.test.a'], 'DEBUG')
+        self.assertEqual(levels['fbg.test.b'], 'ERROR')
+        with self.assertRaises(ValueError):
+            logging_setup.set_levels({'fbg.test.a': 'INFO', 'fbg.test.b': 'LOUD'})
+        self.assertEqual(logging.getLogger('fbg.test.a').level, logging.DEBUG)
+        logging_setup.set_levels({'fbg.test.b': None})
+        self.assertNotIn('fbg.test.b', logging_setup.get_levels())
+
+    def test_queue(self):
+        '''Records are written by the listener, at the levels set'''
+        root = logging.getLogger()
+        root_level = root.level
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'test.log')
+            try:
+                logging_setup.setup_queue_logging(filename, level='WARNING', levels={'fbg.test.a': 'DEBUG'})
+                logging.getLogger('fbg.test.a').debug('shown %s', 'a')
+                logging.getLogger('fbg.test.b').info('hidden')
+                logging_setup.stop_queue_logging()
+            finally:
+                root.setLevel(root_level)
+            with open(filename, encoding='utf-8') as fi:
+                lines = fi.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(' - DEBUG - fbg.test.a - shown a\n'))
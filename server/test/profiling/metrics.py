@@ -0,0 +1,74 @@
+'''
+Metrics are scraped from the server in the Prometheus text format.
+'''
+
+import logging
+import unittest
+
+import metrics
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Test
+#
+
+class TestMetrics(unittest.TestCase):
+    '''Metric types and the text format'''
+
+    def test_counter_and_gauge(self):
+        registry = metrics.Registry()
+        requests = metrics.Counter('requests_total', 'Requests', ['endpoint'], registry=registry)
+        depth = metrics.Gauge('queue_depth', 'Waiting\nrequests', registry=registry)
+        requests.inc(endpoint='/process')
+        requests.inc(2, endpoint='/process')
+        requests.inc(endpoint='/a"b')
+        depth.inc()
+        depth.dec(3)
+        self.assertEqual(requests.get(endpoint='/process'), 3)
+        with self.assertRaises(ValueError):
+            requests.inc(-1, endpoint='/process')
+        with self.assertRaises(ValueError):
+            requests.inc(status=200)
+        with self.assertRaises(ValueError):
+            metrics.Counter('requests_total', 'Again', registry=registry)
+        text = registry.render()
+        log.debug(text)
+        self.assertEqual(text.split('\n'), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{endpoint="/a\\"b"} 1',
+            'requests_total{endpoint="/process"} 3',
+            '# HELP queue_depth Waiting\\nrequests',
+            '# TYPE queue_depth gauge',
+            'queue_depth -2',
+            '',
+        ])
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        latency = metrics.Histogram('latency_seconds', 'Latency', ['stage'], registry=registry, buckets=[0.1, 1])
+        for seconds in [0.05, 0.1, 0.5, 3]:
+            latency.observe(seconds, stage='spring')
+        self.assertEqual(latency.get(stage='spring'), (4, 3.65))
+        lines = registry.render().split('\n')
+        self.assertEqual(lines[2:8], [
+            'latency_seconds_bucket{stage="spring",le="0.1"} 2',
+            'latency_seconds_bucket{stage="spring",le="1"} 3',
+            'latency_seconds_bucket{stage="spring",le="+Inf"} 4',
+            'latency_seconds_sum{stage="spring"} 3.65',
+            'latency_seconds_count{stage="spring"} 4',
+            '',
+        ])
+
+    def test_function(self):
+        '''Counts kept elsewhere are read when rendering'''
+        registry = metrics.Registry()
+        hits = {('layout', 'hit'): 5}
+        metrics.Counter('cache_total', 'Cache', ['cache', 'result'], registry=registry, function=lambda: hits)
+        hits[('layout', 'miss')] = 1
+        self.assertIn('cache_total{cache="layout",result="miss"} 1', registry.render())
@@ -0,0 +1,70 @@
+'''
+Progress events are sent to clients while blueprints are generated. They
+must be throttled, and a client must be able to stop the generation.
+'''
+
+import logging
+import unittest
+
+import budget
+import layout
+import progress
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Test
+#
+
+class TestProgress(unittest.TestCase):
+    '''Progress events from generation hooks'''
+
+    def test_throttle(self):
+        '''Stages and the last connection are always sent, other events
+        at most once per interval'''
+        events = []
+        reporter = progress.Progress(events.append, interval=3600)
+        reporter.stage('spring')
+        for iteration in range(10):
+            reporter.spring_iteration(movement=1.0, iteration=iteration, iteration_limit=200)
+        reporter.stage('place_on_site')
+        for routed in range(1, 6):
+            reporter.connection(routed, 5)
+        self.assertEqual(events, [
+            dict(event='stage', stage='spring'),
+            dict(event='spring', iteration=0, iteration_limit=200, movement=1.0),
+            dict(event='stage', stage='place_on_site'),
+            dict(event='connections', routed=5, total=5),
+        ])
+
+    def test_no_emit(self):
+        '''Without a function to send events to, progress is ignored'''
+        reporter = progress.Progress()
+        reporter.stage('solve')
+        reporter.connection(1, 1)
+
+    def test_path_search(self):
+        '''Path finding reports nodes expanded, and can be cancelled'''
+        site = layout.ConstructionSite(12, 5)
+        source = solver.FakeMachine(Vector(0, 1), (3, 3))
+        target = solver.FakeMachine(Vector(9, 1), (3, 3))
+        events = []
+        reporter = progress.Progress(events.append, interval=0)
+        path = solver.find_path(site, source, target, path_visualizer=reporter.path_visualizer())
+        log.debug(events)
+        self.assertGreater(len(path), 0)
+        self.assertGreater(len(events), 0)
+        self.assertEqual(set(event['event'] for event in events), set(['path']))
+        self.assertGreater(events[-1]['expanded'], 0)
+
+        def cancel(event):
+            raise budget.Cancelled('Stop')
+        reporter = progress.Progress(cancel, interval=0)
+        with self.assertRaises(budget.Cancelled):
+            solver.find_path(site, source, target, path_visualizer=reporter.path_visualizer())
@@ -0,0 +1,69 @@
+'''
+Profiling shows where time is spent in the generation pipeline. It must
+record nothing when no profile is active.
+'''
+
+import logging
+import unittest
+
+import layout
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Test
+#
+
+class TestProfiling(unittest.TestCase):
+    '''Spans and counters'''
+
+    def test_spans(self):
+        '''Nested spans get dotted names, and repeated spans are summed'''
+        with profiling.profile() as profile:
+            with profiling.span('generate'):
+                for _ in range(3):
+                    with profiling.span('connect'):
+                        profiling.count('connections.routed')
+                profiling.maximum('open_peak', 5)
+                profiling.maximum('open_peak', 2)
+                profiling.value('movement', 0.5)
+        result = profile.as_dict()
+        self.assertEqual(set(result['spans']), set(['generate', 'generate.connect']))
+        self.assertEqual(result['spans']['generate.connect']['calls'], 3)
+        self.assertGreaterEqual(result['spans']['generate']['seconds'],
+                                result['spans']['generate.connect']['seconds'])
+        self.assertEqual(result['counters'], {'connections.routed': 3})
+        self.assertEqual(result['values'], {'open_peak': 5, 'movement': 0.5})
+
+    def test_inactive(self):
+        '''Without a profile, instrumentation does nothing'''
+        self.assertIsNone(profiling.current_profile())
+        with profiling.span('stage'):
+            profiling.count('counter')
+            profiling.value('value', 1)
+        with self.assertRaises(ZeroDivisionError):
+            with profiling.profile() as profile:
+                with profiling.span('failing'):
+                    1 / 0
+        self.assertIsNone(profiling.current_profile())
+        self.assertEqual(profile.spans['failing']['calls'], 1)
+
+    def test_path_search(self):
+        '''Path finding counts expanded nodes'''
+        site = layout.ConstructionSite(12, 5)
+        source = solver.FakeMachine(Vector(0, 1), (3, 3))
+        target = solver.FakeMachine(Vector(9, 1), (3, 3))
+        with profiling.profile() as profile:
+            path = solver.find_path(site, source, target)
+        log.debug(profile.as_dict())
+        self.assertGreater(len(path), 0)
+        self.assertEqual(profile.counters['astar.searches'], 1)
+        self.assertGreater(profile.counters['astar.expanded'], 0)
+        self.assertGreater(profile.values['astar.open_peak'], 0)
@@ -1,3 +1,6 @@
 from .electronic_circuit import *
 from .mall_small import *
 from .iron_gearwheels import *
+from .routes import *
+from .shared_belts import *
+from .connection_tiers import *
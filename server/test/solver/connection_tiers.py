@@ -0,0 +1,75 @@
+'''
+Belts and inserters must be of the cheapest tiers that carry the items
+of a connection, and connections that no tier carries are reported.
+'''
+
+import unittest
+
+import layout
+import nets
+import solver
+import tiers
+from test.solver.shared_belts import machine, consume, IRON
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+
+#
+#  Test
+#
+
+class TestConnectionTiers(unittest.TestCase):
+    '''Tiers of belts and inserters for the rate of a connection'''
+
+    def test_cheapest(self):
+        self.assertEqual(tiers.belt_for(15), 'transport-belt')
+        self.assertEqual(tiers.belt_for(20), 'fast-transport-belt')
+        self.assertEqual(tiers.belt_for(100), 'express-transport-belt')
+        self.assertEqual(tiers.inserter_for(0.5), 'inserter')
+        self.assertEqual(tiers.inserter_for(2), 'fast-inserter')
+
+    def test_underground(self):
+        '''A fast connection goes under a wall that transport belts cannot'''
+        site = layout.ConstructionSite(30, 9)
+        source = machine(site, (1, 3), IRON, 20)
+        target = machine(site, (24, 3), None)
+        consume(target, source, IRON, 20)
+        for x in range(10, 16):
+            for y in range(9):
+                site.add_entity(WOOD_CHEST, (x, y), 0)
+        [net] = nets.find_nets([source])
+        overloads = nets.route(net, lambda target, trunk, belt, inserter, source_inserter:
+                               solver.connect_machines(site, source, target, inserter=inserter, belt=belt,
+                                                       trunk=trunk, source_inserter=source_inserter))
+        kinds = {entity['kind'] for entity in site.entities}
+        self.assertIn('fast-underground-belt', kinds)
+        self.assertIn('fast-inserter', kinds)
+        # No inserter puts 20 items per second on a belt, or takes them off
+        self.assertEqual(sorted((o.role, o.kind, o.rate) for o in overloads),
+                         [(tiers.SOURCE_INSERTER, 'fast-inserter', 20), (tiers.TARGET_INSERTER, 'fast-inserter', 20)])
+        self.assertTrue(all(o.target is target for o in overloads))
+        [at_target] = [o for o in overloads if o.role == tiers.TARGET_INSERTER]
+        self.assertEqual(tiers.overload_as_dict(at_target),
+                         dict(source=[1, 3], target=[24, 3], kind='fast-inserter', rate=20,
+                              capacity=tiers.INSERTER_SPEED['fast-inserter'], role=tiers.TARGET_INSERTER,
+                              position=list(site.entities[-1]['pos'])))
+
+    def test_shared_source_inserter(self):
+        '''The inserter at the source of a shared belt is reported once, for
+        the items of all its targets'''
+        site = layout.ConstructionSite(40, 20)
+        source = machine(site, (2, 12), IRON, 3)
+        targets = [machine(site, (x, 2), None) for x in [12, 20, 28]]
+        for target in targets:
+            consume(target, source, IRON, 0.8)
+        [net] = nets.find_nets([source])
+        overloads = nets.route(net, lambda target, trunk, belt, inserter, source_inserter:
+                               solver.connect_machines(site, source, target, inserter=inserter, belt=belt,
+                                                       trunk=trunk, source_inserter=source_inserter))
+        self.assertEqual([(o.role, o.kind) for o in overloads], [(tiers.SOURCE_INSERTER, 'fast-inserter')])
+        self.assertAlmostEqual(overloads[0].rate, 2.4)
+        self.assertEqual(overloads[0].position, site.entities[4]['pos'])
+        self.assertIn('inserter', site.entities[4]['kind'])
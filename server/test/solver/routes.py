@@ -0,0 +1,112 @@
+'''
+Paths found before are reused when the same machines are routed again
+over the same tiles, and never when one of their tiles was taken since.
+'''
+
+import unittest
+
+import layout
+import profiling
+import route_cache
+import solver
+from vector import Vector
+
+#
+#  Game constants
+#
+
+WOOD_CHEST = "wooden-chest"
+BELT = "transport-belt"
+MACHINE_SIZE = (3, 3)
+
+#
+#  Test
+#
+
+class TestRouteCache(unittest.TestCase):
+    '''Reuse of paths between generations'''
+
+    def setUp(self):
+        self.use_route_cache = solver.use_route_cache
+        self.routes = solver.routes
+        solver.use_route_cache = True
+        solver.routes = route_cache.RouteCache(maxsize=2)
+
+    def tearDown(self):
+        solver.use_route_cache = self.use_route_cache
+        solver.routes = self.routes
+
+    def site(self):
+        site = layout.ConstructionSite(40, 40)
+        for x in range(5, 30):
+            site.add_entity(WOOD_CHEST, (x, 12), 0)
+        return site
+
+    def find_path(self, site, source=(1, 1), target=(20, 20), start=None):
+        source = solver.FakeMachine(Vector(*source), MACHINE_SIZE)
+        target = solver.FakeMachine(Vector(*target), MACHINE_SIZE)
+        with profiling.profile() as profile:
+            path = solver.find_path(site, source, target, start=start)
+        return path, profile.counters
+
+    def test_retry(self):
+        '''The same machines on a new site of the same tiles'''
+        path, counters = self.find_path(self.site())
+        self.assertEqual(counters['route_cache.misses'], 1)
+        again, counters = self.find_path(self.site())
+        self.assertEqual(again, path)
+        self.assertEqual(counters['route_cache.hits'], 1)
+        self.assertNotIn('astar.searches', counters)
+        self.assertEqual(solver.routes.cache_info().hits, 1)
+
+    def test_changed_tiles(self):
+        '''Reserved tiles close to the machines, or on the path, are a miss'''
+        path, _ = self.find_path(self.site())
+        site = self.site()
+        site.add_entity(WOOD_CHEST, (2, 5), 0)
+        _, counters = self.find_path(site)
+        self.assertNotIn('route_cache.hits', counters)
+        # The cache key only covers the tiles around the machines, not a
+        # path around a long wall
+        def walled_site():
+            site = layout.ConstructionSite(40, 60)
+            for x in range(10, 16):
+                for y in range(54):
+                    site.add_entity(WOOD_CHEST, (x, y), 0)
+            return site
+        path, _ = self.find_path(walled_site(), (1, 20), (25, 20))
+        far = [p for p in path if p[1] > 50][0]
+        site = walled_site()
+        site.add_entity(WOOD_CHEST, far, 0)
+        _, counters = self.find_path(site, (1, 20), (25, 20))
+        self.assertEqual(counters['route_cache.stale'], 1)
+        self.assertIn('astar.searches', counters)
+
+    def test_eviction(self):
+        '''The least recently used paths are dropped'''
+        site = self.site()
+        self.find_path(site, target=(20, 20))
+        self.find_path(site, target=(30, 20))
+        self.find_path(site, target=(20, 20))
+        self.find_path(site, target=(20, 30))
+        self.assertEqual(solver.routes.cache_info().currsize, 2)
+        _, counters = self.find_path(site, target=(20, 20))
+        self.assertEqual(counters['route_cache.hits'], 1)
+        _, counters = self.find_path(site, target=(30, 20))
+        self.assertNotIn('route_cache.hits', counters)
+
+    def test_extension(self):
+        '''A belt that is extended starts on its end, which is reserved'''
+        def belt_site():
+            site = self.site()
+            for x in [8, 9]:
+                site.add_entity(BELT, (x, 5), 0)
+            return site
+        start = ([(9, 5)], {(9, 5): [(8, 5)]}, {(9, 5): ((1, 0), False)})
+        path, counters = self.find_path(belt_site(), start=start)
+        self.assertEqual(path[0], (9, 5))
+        self.assertEqual(counters['route_cache.misses'], 1)
+        again, counters = self.find_path(belt_site(), start=start)
+        self.assertEqual(again, path)
+        self.assertEqual(counters['route_cache.hits'], 1)
+        self.assertNotIn('route_cache.stale', counters)
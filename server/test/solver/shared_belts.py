@@ -0,0 +1,100 @@
+'''
+Machines that take the same item from one machine should share a belt
+that passes each of them, as long as the belt carries enough items.
+'''
+
+import unittest
+
+import layout
+import nets
+import profiling
+import solver
+from vector import Vector
+
+#
+#  Game constants
+#
+
+MACHINE = "assembling-machine-1"
+INSERTER = "inserter"
+IRON = "iron-plate"
+COPPER = "copper-plate"
+
+#
+#  Test
+#
+
+def machine(site, position, output=None, rate=1):
+    '''Add a machine to the site, which supplies rate of an item when output is given'''
+    node = solver.FakeMachine(Vector(*position), (3, 3))
+    if output:
+        node.unused_output = {output: rate}
+    site.add_entity(MACHINE, position, 0)
+    return node
+
+def consume(target, source, item, rate):
+    target.missing_input = {item: rate}
+    target.consume_from(source, item)
+
+class TestSharedBelts(unittest.TestCase):
+    '''Belts shared by the connections of a net'''
+
+    def route(self, site, source, belt="transport-belt"):
+        with profiling.profile() as profile:
+            for net in nets.find_nets([source]):
+                nets.route(net, lambda target, trunk, belt, inserter, source_inserter: solver.connect_machines(
+                    site, source, target, inserter=inserter, belt=belt, trunk=trunk,
+                    source_inserter=source_inserter), belt)
+        return profile.counters
+
+    def test_nets(self):
+        site = layout.ConstructionSite(30, 30)
+        source = machine(site, (1, 1), IRON, 10)
+        source.unused_output[COPPER] = 10
+        targets = [machine(site, (x, 10), None) for x in [1, 6, 11]]
+        consume(targets[0], source, IRON, 2)
+        consume(targets[1], source, COPPER, 3)
+        consume(targets[2], source, IRON, 4)
+        found = nets.find_nets([source] + targets)
+        self.assertEqual([(net.item, net.targets) for net in found],
+                         [(IRON, [targets[0], targets[2]]), (COPPER, [targets[1]])])
+        self.assertEqual(found[0].rates[targets[2]], 4)
+
+    def test_trunk(self):
+        '''One belt passes machines in a row, and fewer tiles are used'''
+        tiles = {}
+        for share in [False, True]:
+            site = layout.ConstructionSite(40, 20)
+            source = machine(site, (2, 12), IRON, 10)
+            targets = [machine(site, (x, 2), None) for x in [12, 20, 28]]
+            for target in targets:
+                consume(target, source, IRON, 1)
+            if share:
+                counters = self.route(site, source)
+                self.assertEqual(counters['nets.taps'], 2)
+                self.assertNotIn('nets.fallbacks', counters)
+            else:
+                for target in targets:
+                    solver.connect_machines(site, source, target)
+            tiles[share] = len(site.reserved)
+        inserters = [e for e in site.entities if e['kind'].endswith(INSERTER)]
+        self.assertEqual(len(inserters), 4)
+        self.assertLess(tiles[True], tiles[False])
+
+    def test_throughput(self):
+        '''A new belt is started when the belt is full'''
+        site = layout.ConstructionSite(40, 20)
+        source = machine(site, (2, 12), IRON, 30)
+        targets = [machine(site, (x, 2), None) for x in [12, 20, 28]]
+        for target in targets:
+            consume(target, source, IRON, 10)
+        counters = self.route(site, source)
+        self.assertEqual(counters['nets.full'], 2)
+        self.assertNotIn('nets.taps', counters)
+        site = layout.ConstructionSite(40, 20)
+        source = machine(site, (2, 12), IRON, 30)
+        targets = [machine(site, (x, 2), None) for x in [12, 20, 28]]
+        for target in targets:
+            consume(target, source, IRON, 10)
+        counters = self.route(site, source, belt="express-transport-belt")
+        self.assertEqual(counters['nets.taps'], 2)
@@ -0,0 +1,92 @@
+'''
+Tiers of belts and inserters for the items per second of a connection.
+
+Each connection carries the rate its target takes from its source, see
+FactoryNode.input_rates. The cheapest tier of belt, and of inserter, that
+carries the rate is used. Faster belts also have longer underground
+belts, which the path finding uses. When even the fastest tier cannot
+carry a rate, the fastest is used and the connection is reported as an
+Overload.
+'''
+
+from collections import namedtuple
+import logging
+from typing import List
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+#
+#  Game constants
+#
+
+# Information from https://wiki.factorio.com/
+# Items per second on a full belt, both lanes
+BELT_SPEED = {
+    'transport-belt': 15,
+    'fast-transport-belt': 30,
+    'express-transport-belt': 45,
+}
+# Items per second, chest to chest
+INSERTER_SPEED = {
+    'burner-inserter': 0.6,
+    'inserter': 60/72,
+    'long-handed-inserter': 1.2,
+    'fast-inserter': 60/26,
+}
+
+# From the cheapest to the fastest. Burner inserters need fuel, and long
+# handed inserters do not reach the belt next to the machine.
+BELT_TIERS = ['transport-belt', 'fast-transport-belt', 'express-transport-belt']
+INSERTER_TIERS = ['inserter', 'fast-inserter']
+
+# A belt or inserter of a connection that carries less than its rate. The
+# role is the entity of the connection: the source inserter, the belt, or
+# the target inserter, at position. The source inserter and belt carry the
+# items of all targets of a shared belt, of which target is the last.
+Overload = namedtuple('Overload', ['source', 'target', 'kind', 'rate', 'capacity', 'role', 'position'])
+
+SOURCE_INSERTER = 'source-inserter'
+BELT = 'belt'
+TARGET_INSERTER = 'target-inserter'
+
+#
+#  Tiers
+#
+
+def speed(kind) -> float:
+    '''Return the items per second a belt or inserter carries'''
+    return BELT_SPEED.get(kind) or INSERTER_SPEED[kind]
+
+def cheapest(tiers: List[str], rate) -> str:
+    '''Return the first tier that carries rate, or else the last'''
+    for kind in tiers:
+        if speed(kind) >= rate:
+            return kind
+    return tiers[-1]
+
+def belt_for(rate) -> str:
+    return cheapest(BELT_TIERS, rate)
+
+def inserter_for(rate) -> str:
+    return cheapest(INSERTER_TIERS, rate)
+
+def connection_rate(source, target) -> float:
+    '''Return the items per second target takes from source'''
+    return float(sum(target.input_rates.get(source, {}).values()))
+
+def overload_as_dict(overload: Overload) -> dict:
+    '''Return an overload in a form ready for JSON'''
+    return dict(source=list(overload.source.position), target=list(overload.target.position),
+                kind=overload.kind, rate=overload.rate, capacity=overload.capacity,
+                role=overload.role, position=list(overload.position))
+
+def check(source, target, rate, kind, role, position) -> List[Overload]:
+    '''Return the overload of a belt or inserter of a connection, if any'''
+    if speed(kind) >= rate:
+        return []
+    log.debug('%s %s at %s carries %.2f/s of %.2f/s', role, kind, position, speed(kind), rate)
+    return [Overload(source, target, kind, rate, speed(kind), role, position)]
@@ -0,0 +1,117 @@
+'''
+Path finding in a window around the machines to connect.
+
+Most connections of a good layout are short, yet a search of the whole
+site may wander far from them when the way between is blocked, and the
+obstacles heuristic is found for every tile of it. The search is first
+made on a copy of the tiles in the bounding box of the
+start and end positions, with some padding. When no path is found there,
+the padding grows by a factor until the window covers the whole site, so
+no path is missed. A path found in a window is a path of the site too,
+as the tiles outside it are treated as reserved.
+
+The cost of the failed searches is at most a constant factor of that of
+the search of the whole site, as windows grow geometrically.
+
+An unbounded site has no whole site to fall back to. Its last window is
+the bounding box of what is built on it and of the positions, with a ring
+of free tiles around it, which a belt can always go around in.
+'''
+
+import logging
+from typing import Dict, List
+
+from a_star_factorio import A_star, UNDERGROUND_REACH
+from hierarchy import window_site
+import layout
+import profiling
+
+#
+#  Logging
+#
+
+log = logging.getLogger(__name__)
+
+# Tiles around the start and end positions in the first window, enough to
+# go around a machine with an underground belt to spare
+WINDOW_PADDING = 2 * UNDERGROUND_REACH
+
+# Factor the padding grows by after each failed search
+WINDOW_GROWTH = 2
+
+#
+#  Windows
+#
+
+def site_area(site: layout.ConstructionSite, positions: List["tuple"]) -> "tuple":
+    '''Return the area (x0, y0, x1, y1) of the last window of a site'''
+    if site.is_bounded():
+        return site.bounds()
+    x0, y0, x1, y1 = site.bounding_box() if site.reserved_count else positions[0] * 2
+    for x, y in positions:
+        x0, y0, x1, y1 = min(x0, x), min(y0, y), max(x1, x + 1), max(y1, y + 1)
+    return (x0 - UNDERGROUND_REACH, y0 - UNDERGROUND_REACH, x1 + UNDERGROUND_REACH, y1 + UNDERGROUND_REACH)
+
+def windows(area, positions: List["tuple"], padding=WINDOW_PADDING,
+            growth=WINDOW_GROWTH) -> List["tuple"]:
+    '''Return the areas (x0, y0, x1, y1) to search in, around positions,
+    from the smallest to the whole area'''
+    area_x0, area_y0, area_x1, area_y1 = area
+    left = min(x for x, _ in positions)
+    top = min(y for _, y in positions)
+    right = max(x for x, _ in positions) + 1
+    bottom = max(y for _, y in positions) + 1
+    areas = []
+    while True:
+        window = (max(area_x0, left - padding), max(area_y0, top - padding),
+                  min(area_x1, right + padding), min(area_y1, bottom + padding))
+        areas.append(window)
+        if window == tuple(area):
+            return areas
+        padding *= growth
+
+def find_path(
+    site: layout.ConstructionSite,
+    start_positions: List["tuple"],
+    end_positions: List["tuple"],
+    start_node_illegal_neighbors: Dict["tuple", List["tuple"]],
+    end_node_illegal_neighbors: Dict["tuple", List["tuple"]],
+    belt="transport-belt",
+    heuristic='euclidean',
+    directional=False,
+    padding=WINDOW_PADDING,
+    start_headings: Dict["tuple", "tuple"] = None,
+    visualizer=None,
+    straight_runs=False,
+) -> List["tuple"]:
+    """
+    Search for a path in windows of the site that grow until one is found
+
+    :param start_headings:  Belts that come to the start positions, see
+        A_star
+    :param visualizer:  Visualizer of each window search, that does not
+        draw, as the positions are those of the window, see
+        solver.draws_path
+    :return:  List of positions from a start to an end position, like
+        A_star.find_path, or None if there is no path on the site
+    """
+    start_headings = start_headings or {}
+    positions = start_positions + end_positions
+    for x0, y0, x1, y1 in windows(site_area(site, positions), positions, padding):
+        if (x0, y0, x1, y1) == (0, 0, *site.size()) and site.is_bounded():
+            window = site
+        else:
+            window = window_site(site, x0, y0, x1, y1)
+        moved = lambda positions: [(x - x0, y - y0) for x, y in positions]
+        moved_illegal = lambda illegal: {(x - x0, y - y0): moved(tiles) for (x, y), tiles in illegal.items()}
+        finder = A_star(window, moved(start_positions), moved(end_positions),
+                        moved_illegal(start_node_illegal_neighbors),
+                        moved_illegal(end_node_illegal_neighbors), belt,
+                        {(x - x0, y - y0): heading for (x, y), heading in start_headings.items()})
+        path = finder.find_path(True, visualizer, heuristic, directional, straight_runs)
+        profiling.count('window.searches')
+        profiling.count('window.tiles', (x1 - x0) * (y1 - y0))
+        if path is not None:
+            return [(x + x0, y + y0) for x, y in path]
+        log.debug(f'No path in window {(x0, y0, x1, y1)}')
+    return None